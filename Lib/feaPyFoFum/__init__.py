@@ -1,4 +1,12 @@
 from __future__ import absolute_import
-from .feaPyFoFum import compileFeatures
+from .feaPyFoFum import compileFeatures, compileFeaturesTo, iterCompileFeatures, compileFeaturesForFonts, compileFeaturesToAST, FeaPyTemplate
+from .cache import CodeBlockCache, BytecodeCache, TableCache
+from .incremental import IncrementalCompiler
+from .glyphIndex import GlyphIndex
+from .snapshot import FontSnapshot
+from .profiling import CompileProfile
+from .dependencies import TrackingFont
+from .building import compileFeaturesToFont, buildFeatures
+from .workerPool import WorkerPool
 
 __version__ = "0.1"
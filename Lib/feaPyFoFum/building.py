@@ -0,0 +1,139 @@
+from __future__ import unicode_literals
+
+import os
+from io import StringIO
+
+from .feaPyFoFum import compileFeatures, _buildIncludeGraph, _findReferencedFilesInLines
+
+
+# --------
+# Building
+# --------
+
+# the tables that only depend on the features and the
+# glyph order, so they can be stored in a TableCache.
+cacheableTables = ("BASE", "GDEF", "GPOS", "GSUB")
+
+# tables in the font that change how the features are built
+_keyTables = ("fvar", "avar")
+
+
+def compileFeaturesToFont(text, font, ttFont, tables=cacheableTables, tableCache=None, verbose=False, compileReferencedFiles=False, cache=None, workers=None, bytecodeCache=None, snapshot=False, errors=None):
+    """
+    Compile the dynamic features in the given text and
+    build them into ttFont, a fontTools TTFont, with
+    feaLib. The compiled text is returned.
+
+    Relative include statements are resolved against
+    the directory containing the font. tables and
+    tableCache are the same as the arguments for
+    buildFeatures. The other arguments are the same
+    as the arguments for compileFeatures.
+    """
+    text = compileFeatures(
+        text,
+        font,
+        verbose=verbose,
+        compileReferencedFiles=compileReferencedFiles,
+        cache=cache,
+        workers=workers,
+        bytecodeCache=bytecodeCache,
+        snapshot=snapshot,
+        errors=errors
+    )
+    includeDir = None
+    if font.path:
+        includeDir = os.path.dirname(font.path)
+    buildFeatures(text, ttFont, tables=tables, tableCache=tableCache, includeDir=includeDir)
+    return text
+
+
+def buildFeatures(text, ttFont, tables=cacheableTables, tableCache=None, includeDir=None):
+    """
+    Build the compiled feature text into ttFont, a
+    fontTools TTFont, with feaLib. Only the given
+    tables are built. includeDir is the directory
+    relative include statements are resolved against.
+    If it is None, the current directory is used.
+
+    If a TableCache is given as tableCache, the built
+    tables are stored in it and reused when the text,
+    the files it includes, the glyph order of ttFont
+    and the version of fontTools are the same as in an
+    earlier build. Only the tables in cacheableTables
+    can be cached. If any other table is requested,
+    everything is built.
+    """
+    from fontTools.feaLib.parser import Parser
+    from fontTools.feaLib.builder import Builder
+
+    tables = sorted(set(tables))
+    key = None
+    if tableCache is not None and all(tag in cacheableTables for tag in tables):
+        key = _makeTableKey(tableCache, text, ttFont, tables, includeDir)
+        entry = tableCache.get(key)
+        if entry is not None:
+            _restoreTables(ttFont, tables, entry)
+            return
+    glyphNames = ttFont.getGlyphOrder()
+    featureFile = Parser(StringIO(text), glyphNames=glyphNames, includeDir=includeDir).parse()
+    Builder(ttFont, featureFile).build(tables=tables)
+    if key is not None:
+        tableCache.set(key, _makeEntry(ttFont, tables))
+
+
+def _makeTableKey(tableCache, text, ttFont, tables, includeDir):
+    from fontTools import version
+
+    parts = [version, " ".join(tables), text]
+    # the included files, as they are now
+    if includeDir is None:
+        includeDir = os.getcwd()
+    referencedFiles = _findReferencedFilesInLines(text.splitlines(), includeDir)
+    for inPath, outPath in _buildIncludeGraph(referencedFiles, includeDir):
+        parts.append(inPath)
+        try:
+            with open(inPath, "rb") as f:
+                parts.append(f.read())
+        except (IOError, OSError):
+            parts.append(None)
+    parts.append("\0".join(ttFont.getGlyphOrder()))
+    for tag in _keyTables:
+        if tag in ttFont:
+            parts.append(tag)
+            parts.append(ttFont.getTableData(tag))
+    return tableCache.makeKey(*parts)
+
+
+def _makeEntry(ttFont, tables):
+    from fontTools.otlLib.maxContextCalc import maxCtxFont
+
+    data = {}
+    for tag in tables:
+        if tag in ttFont:
+            data[tag] = ttFont[tag].compile(ttFont)
+    # the builder updates OS/2 with this
+    maxContext = None
+    if "GSUB" in data or "GPOS" in data:
+        if "OS/2" in ttFont:
+            maxContext = ttFont["OS/2"].usMaxContext
+        else:
+            maxContext = maxCtxFont(ttFont)
+    return dict(tables=data, maxContext=maxContext)
+
+
+def _restoreTables(ttFont, tables, entry):
+    from fontTools.ttLib import newTable
+
+    data = entry["tables"]
+    for tag in tables:
+        if tag in data:
+            table = newTable(tag)
+            table.decompile(data[tag], ttFont)
+            ttFont[tag] = table
+        elif tag in ttFont:
+            # the features build no such table
+            del ttFont[tag]
+    maxContext = entry["maxContext"]
+    if maxContext is not None and "OS/2" in ttFont:
+        ttFont["OS/2"].usMaxContext = maxContext
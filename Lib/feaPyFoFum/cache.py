@@ -0,0 +1,717 @@
+from __future__ import unicode_literals
+
+import os
+import json
+import time
+import marshal
+import hashlib
+import tempfile
+import threading
+import importlib.util
+from collections import OrderedDict
+from .dependencies import withoutRedundantDependencies
+
+try:
+    from fontTools.ufoLib import fontInfoAttributesVersion3
+except ImportError:
+    fontInfoAttributesVersion3 = None
+
+
+# bump this when the stored data or the
+# key composition changes in a way that
+# makes old entries invalid.
+cacheFormatVersion = "2"
+
+
+# ------------------
+# Code Block Caching
+# ------------------
+
+class CodeBlockCache(object):
+
+    """
+    A persistent, content addressed store for the
+    output of code blocks.
+
+    Entries are keyed on the path of the font, the
+    extracted code, the whitespace settings of the
+    block and the code blocks that precede it in the
+    same file. While a block is executed, the font
+    data it reads is recorded and stored with its
+    output. On a hit the values of that data are
+    compared with the font and, if they are the same,
+    the stored output is reused and nothing is
+    executed. Changing data that a block didn't read
+    doesn't invalidate it.
+
+    directory is the location of the cache on disk.
+    It will be created if it doesn't exist.
+
+    maxSize is the maximum number of bytes the stored
+    entries may occupy. maxAge is the maximum number
+    of seconds an entry may go unused. The least
+    recently used entries are evicted first when
+    the cache is trimmed. Either may be None.
+
+    If enabled is False, the cache is bypassed:
+    nothing will be read from or written to it.
+    """
+
+    def __init__(self, directory, maxSize=256 * 1024 * 1024, maxAge=30 * 24 * 60 * 60, enabled=True):
+        self.directory = directory
+        self.maxSize = maxSize
+        self.maxAge = maxAge
+        self.enabled = enabled
+
+    def __repr__(self):
+        return "<CodeBlockCache %s>" % self.directory
+
+    # ----
+    # Keys
+    # ----
+
+    def makeKey(self, *parts):
+        """
+        Make a key from the given strings.
+        """
+        h = hashlib.sha256()
+        h.update(cacheFormatVersion.encode("utf-8"))
+        for part in parts:
+            if part is None:
+                part = ""
+            h.update(b"\0")
+            h.update(part.encode("utf-8"))
+        return h.hexdigest()
+
+    def _pathForKey(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    # -------
+    # Storage
+    # -------
+
+    def get(self, key):
+        """
+        Get the output stored for key. If nothing is
+        stored or the entry has expired, None will be
+        returned.
+        """
+        if not self.enabled:
+            return None
+        path = self._pathForKey(key)
+        try:
+            modified = os.path.getmtime(path)
+            if self.maxAge is not None and time.time() - modified > self.maxAge:
+                os.remove(path)
+                return None
+            with open(path, "rb") as f:
+                data = f.read()
+            # mark the entry as recently used
+            os.utime(path, None)
+        except (IOError, OSError):
+            return None
+        return data.decode("utf-8")
+
+    def set(self, key, output):
+        """
+        Store output for key.
+        """
+        if not self.enabled:
+            return
+        path = self._pathForKey(key)
+        directory = os.path.dirname(path)
+        try:
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            # write to a temporary file and move it into
+            # place so that a concurrent reader never
+            # sees a partially written entry.
+            fd, tempPath = tempfile.mkstemp(dir=directory)
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(output.encode("utf-8"))
+                os.replace(tempPath, path)
+            except Exception:
+                os.remove(tempPath)
+                raise
+        except (IOError, OSError):
+            # a cache that can't be written is not fatal
+            pass
+
+    # --------
+    # Eviction
+    # --------
+
+    def _entries(self):
+        entries = []
+        if not os.path.exists(self.directory):
+            return entries
+        for subdirectory in os.listdir(self.directory):
+            subdirectory = os.path.join(self.directory, subdirectory)
+            if not os.path.isdir(subdirectory):
+                continue
+            for fileName in os.listdir(subdirectory):
+                path = os.path.join(subdirectory, fileName)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def trim(self):
+        """
+        Evict expired entries and, if the cache is
+        larger than maxSize, the least recently
+        used entries until it fits.
+        """
+        if not self.enabled:
+            return
+        entries = sorted(self._entries())
+        now = time.time()
+        totalSize = sum(size for modified, size, path in entries)
+        for modified, size, path in entries:
+            expired = self.maxAge is not None and now - modified > self.maxAge
+            tooBig = self.maxSize is not None and totalSize > self.maxSize
+            if not expired and not tooBig:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            totalSize -= size
+
+    def clear(self):
+        """
+        Remove all entries.
+        """
+        for modified, size, path in self._entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    # --------
+    # Sessions
+    # --------
+
+    def session(self, font):
+        """
+        Get a session for compiling against font.
+        """
+        return _CodeBlockCacheSession(self, font.path)
+
+
+class _CodeBlockCacheSession(object):
+
+    """
+    The values of the dependencies are computed once
+    per session. They are not sent to other processes.
+    """
+
+    def __init__(self, cache, fontPath):
+        self.cache = cache
+        self.fontPath = fontPath
+        self._values = {}
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["_values"] = {}
+        return state
+
+    def chain(self, font):
+        """
+        Get a new chain for the code blocks in one file.
+        """
+        return _CodeBlockChain(self.cache, self.fontPath, font, self._values)
+
+
+class _CodeBlockChain(object):
+
+    """
+    The code blocks in a file share a namespace, so
+    the output of a block may depend on the blocks
+    that were executed before it. Each key includes
+    the key of the previous block to account for this.
+
+    Blocks that were served from the cache must be
+    recorded as pending with addPending. If a later block
+    has to be executed, the pending blocks must be
+    replayed first so that the namespace is in the
+    expected state.
+
+    For the same reason, a block depends on everything
+    the blocks before it read. Each entry only stores
+    the dependencies of its own block, so once a block
+    misses, the blocks after it miss too. A block must
+    be executed while recording into blockDependencies.
+    """
+
+    def __init__(self, cache, fontPath, font, values):
+        self.cache = cache
+        self.fontPath = fontPath
+        self.font = font
+        self.values = values
+        self.blockDependencies = None
+        self.previousKey = None
+        self.currentKey = None
+        self.missed = False
+        self.pending = []
+
+    def get(self, code, whitespace, constantIndent):
+        self.currentKey = self.cache.makeKey(
+            self.fontPath,
+            self.previousKey,
+            whitespace,
+            constantIndent,
+            code
+        )
+        self.previousKey = self.currentKey
+        self.blockDependencies = set()
+        entry = None
+        if not self.missed:
+            entry = _parseEntry(self.cache.get(self.currentKey))
+        if entry is not None:
+            dependencies, fingerprint, output = entry
+            if dependencyFingerprint(self.font, dependencies, self.values) == fingerprint:
+                self.blockDependencies.update(dependencies)
+                return output
+        self.missed = True
+        return None
+
+    def set(self, output):
+        fingerprint = dependencyFingerprint(self.font, self.blockDependencies, self.values)
+        self.cache.set(self.currentKey, _formatEntry(self.blockDependencies, fingerprint, output))
+
+    def addPending(self, block):
+        self.pending.append(block)
+
+    def popPending(self):
+        pending = self.pending
+        self.pending = []
+        return pending
+
+
+def _formatEntry(dependencies, fingerprint, output):
+    header = json.dumps(
+        dict(dependencies=_sortedDependencies(dependencies), fingerprint=fingerprint),
+        separators=(",", ":")
+    )
+    return header + "\n" + output
+
+
+def _parseEntry(text):
+    if text is None:
+        return None
+    header, _, output = text.partition("\n")
+    try:
+        header = json.loads(header)
+        dependencies = [_thaw(dependency) for dependency in header["dependencies"]]
+        fingerprint = header["fingerprint"]
+    except (ValueError, KeyError, TypeError):
+        return None
+    return dependencies, fingerprint, output
+
+
+def _thaw(obj):
+    # JSON turns the tuples in dependencies into lists
+    if isinstance(obj, list):
+        return tuple([_thaw(i) for i in obj])
+    return obj
+
+
+# ----------------
+# Font Fingerprint
+# ----------------
+
+class _FingerprintPointPen(object):
+
+    def __init__(self, data):
+        self.data = data
+
+    def beginPath(self, identifier=None, **kwargs):
+        self.data.append("beginPath")
+
+    def endPath(self):
+        self.data.append("endPath")
+
+    def addPoint(self, pt, segmentType=None, smooth=False, name=None, identifier=None, **kwargs):
+        self.data.append((tuple(pt), segmentType, smooth, name))
+
+    def addComponent(self, baseGlyphName, transformation, identifier=None, **kwargs):
+        self.data.append((baseGlyphName, tuple(transformation)))
+
+
+def _canonical(obj):
+    """
+    Convert obj to a structure with a stable repr.
+    """
+    if isinstance(obj, dict) or hasattr(obj, "items"):
+        return sorted((repr(k), _canonical(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return [_canonical(i) for i in obj]
+    return obj
+
+
+def _anchorData(glyph):
+    data = []
+    for anchor in glyph.anchors:
+        if isinstance(anchor, dict):
+            data.append((anchor.get("name"), anchor.get("x"), anchor.get("y")))
+        else:
+            data.append((anchor.name, anchor.x, anchor.y))
+    return data
+
+
+def _glyphFingerprintData(glyph):
+    data = [
+        glyph.name,
+        list(glyph.unicodes),
+        glyph.width,
+        getattr(glyph, "height", None),
+        getattr(glyph, "note", None),
+    ]
+    data.extend(_anchorData(glyph))
+    outline = []
+    # snapshots don't have outlines
+    if hasattr(glyph, "drawPoints"):
+        glyph.drawPoints(_FingerprintPointPen(outline))
+    data.append(outline)
+    data.append(_canonical(getattr(glyph, "lib", {})))
+    return data
+
+
+def fontFingerprint(font):
+    """
+    Get a hash of all of the data in the font
+    that is visible to code blocks.
+    """
+    h = hashlib.sha256()
+
+    def add(obj):
+        h.update(repr(_canonical(obj)).encode("utf-8"))
+        h.update(b"\0")
+
+    add(font.path)
+    add(list(getattr(font, "glyphOrder", [])))
+    for name in sorted(font.keys()):
+        add(_glyphFingerprintData(font[name]))
+    add(font.groups)
+    add(font.kerning)
+    add(font.lib)
+    info = font.info
+    if fontInfoAttributesVersion3 is not None:
+        attributes = sorted(fontInfoAttributesVersion3)
+    else:
+        attributes = sorted(attr for attr in vars(info) if not attr.startswith("_"))
+    add([(attr, getattr(info, attr, None)) for attr in attributes])
+    return h.hexdigest()
+
+
+# ----------------------
+# Dependency Fingerprint
+# ----------------------
+
+_missing = "<missing>"
+
+
+def _sortedDependencies(dependencies):
+    return [dependency for key, dependency in _keyedDependencies(dependencies)]
+
+
+def _keyedDependencies(dependencies):
+    # reprs are unique, so the dependencies
+    # themselves are never compared.
+    dependencies = withoutRedundantDependencies(dependencies)
+    return sorted((repr(dependency), dependency) for dependency in dependencies)
+
+
+def _dependencyValue(font, dependency):
+    """
+    Get the current value of a dependency recorded
+    by the objects in the dependencies module.
+    """
+    kind = dependency[0]
+    if kind == "font":
+        return fontFingerprint(font)
+    if kind == "glyphOrder":
+        return list(getattr(font, "glyphOrder", None) or [])
+    if kind == "glyphNames":
+        return sorted(font.keys())
+    if kind == "unicodes":
+        return [(name, list(font[name].unicodes)) for name in sorted(font.keys())]
+    if kind == "glyph":
+        name = dependency[1]
+        if name not in font:
+            return _missing
+        if len(dependency) == 2:
+            return True
+        glyph = font[name]
+        attr = dependency[2]
+        if attr == "*":
+            return _glyphFingerprintData(glyph)
+        if attr == "anchors":
+            return _anchorData(glyph)
+        if attr == "unicodes":
+            return list(glyph.unicodes)
+        return _canonical(getattr(glyph, attr, None))
+    if kind == "info":
+        return getattr(font.info, dependency[1], None)
+    # groups, kerning and lib
+    mapping = getattr(font, kind)
+    if len(dependency) == 1:
+        return _canonical(mapping)
+    key = dependency[1]
+    if key not in mapping:
+        return _missing
+    return _canonical(mapping[key])
+
+
+def dependencyFingerprint(font, dependencies, values=None):
+    """
+    Get a hash of the values of the dependencies
+    in the font. If values is given, it must be a
+    dict, it will be used to memoize the values
+    and the font must not change while it is used.
+    """
+    if values is None:
+        values = {}
+    h = hashlib.sha256()
+    for key, dependency in _keyedDependencies(dependencies):
+        value = values.get(dependency)
+        if value is None:
+            value = values[dependency] = repr(_canonical(_dependencyValue(font, dependency)))
+        h.update(key.encode("utf-8"))
+        h.update(b"\0")
+        h.update(value.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+# -------------
+# Table Caching
+# -------------
+
+class TableCache(object):
+
+    """
+    A store for the binary tables built from compiled
+    features by buildFeatures.
+
+    The maxItems most recently used entries are kept
+    in memory. If directory is given, entries are also
+    stored there and reused by other processes.
+    """
+
+    def __init__(self, directory=None, maxItems=8):
+        self.directory = directory
+        self.maxItems = maxItems
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<TableCache %s>" % self.directory
+
+    def __getstate__(self):
+        # locks can't be pickled
+        state = dict(self.__dict__)
+        del state["_items"]
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def makeKey(self, *parts):
+        """
+        Make a key from the given strings or bytes.
+        """
+        h = hashlib.sha256()
+        h.update(cacheFormatVersion.encode("utf-8"))
+        for part in parts:
+            if part is None:
+                part = ""
+            if not isinstance(part, bytes):
+                part = part.encode("utf-8")
+            h.update(b"\0")
+            h.update(str(len(part)).encode("ascii"))
+            h.update(b"\0")
+            h.update(part)
+        return h.hexdigest()
+
+    def get(self, key):
+        """
+        Get the entry stored for key, a dict with the
+        data of the built tables keyed by tag as
+        "tables" and the maximum context of the
+        lookups as "maxContext", or None.
+        """
+        items = self._items
+        with self._lock:
+            entry = items.get(key)
+            if entry is not None:
+                items.move_to_end(key)
+                return entry
+        entry = self._load(key)
+        if entry is not None:
+            self._remember(key, entry)
+        return entry
+
+    def set(self, key, entry):
+        """
+        Store entry for key.
+        """
+        self._remember(key, entry)
+        self._store(key, entry)
+
+    def clear(self):
+        """
+        Remove all entries from memory.
+        """
+        with self._lock:
+            self._items.clear()
+
+    def _remember(self, key, entry):
+        items = self._items
+        with self._lock:
+            items[key] = entry
+            items.move_to_end(key)
+            while len(items) > self.maxItems:
+                items.popitem(last=False)
+
+    def _pathForKey(self, key):
+        return os.path.join(self.directory, key + ".tables")
+
+    def _load(self, key):
+        if self.directory is None:
+            return None
+        try:
+            with open(self._pathForKey(key), "rb") as f:
+                return marshal.loads(f.read())
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+
+    def _store(self, key, entry):
+        if self.directory is None:
+            return
+        try:
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+            fd, tempPath = tempfile.mkstemp(dir=self.directory)
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(marshal.dumps(entry))
+                os.replace(tempPath, self._pathForKey(key))
+            except Exception:
+                os.remove(tempPath)
+                raise
+        except (IOError, OSError):
+            pass
+
+
+# ----------------
+# Bytecode Caching
+# ----------------
+
+class BytecodeCache(object):
+
+    """
+    A memoizing layer for compiling code blocks.
+
+    Code objects are kept in memory, keyed by a hash of
+    the source, the file name and the line offset. The
+    maxItems least recently used code objects are kept.
+
+    If directory is given, code objects are also stored
+    there with marshal and reused by other processes.
+    The entries are specific to the version of Python
+    that wrote them.
+    """
+
+    def __init__(self, directory=None, maxItems=512):
+        self.directory = directory
+        self.maxItems = maxItems
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<BytecodeCache %s>" % self.directory
+
+    def __getstate__(self):
+        # code objects and locks can't be pickled
+        state = dict(self.__dict__)
+        del state["_items"]
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def compile(self, source, fileName="", lineOffset=0):
+        """
+        Compile source as if it started on the line
+        after lineOffset in the file fileName.
+        """
+        h = hashlib.sha256()
+        h.update(importlib.util.MAGIC_NUMBER)
+        for part in (fileName, str(lineOffset), source):
+            h.update(b"\0")
+            h.update(part.encode("utf-8"))
+        key = h.hexdigest()
+        items = self._items
+        with self._lock:
+            code = items.get(key)
+            if code is not None:
+                items.move_to_end(key)
+                return code
+        code = self._load(key)
+        if code is None:
+            # padding the source keeps line numbers, including
+            # the ones in syntax errors, pointing into the file.
+            code = compile("\n" * lineOffset + source, fileName, "exec", 0, True)
+            self._store(key, code)
+        with self._lock:
+            items[key] = code
+            if len(items) > self.maxItems:
+                items.popitem(last=False)
+        return code
+
+    def clear(self):
+        """
+        Remove all code objects from memory.
+        """
+        with self._lock:
+            self._items.clear()
+
+    def _pathForKey(self, key):
+        return os.path.join(self.directory, key + ".pyc")
+
+    def _load(self, key):
+        if self.directory is None:
+            return None
+        try:
+            with open(self._pathForKey(key), "rb") as f:
+                return marshal.loads(f.read())
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+
+    def _store(self, key, code):
+        if self.directory is None:
+            return
+        try:
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+            fd, tempPath = tempfile.mkstemp(dir=self.directory)
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(marshal.dumps(code))
+                os.replace(tempPath, self._pathForKey(key))
+            except Exception:
+                os.remove(tempPath)
+                raise
+        except (IOError, OSError):
+            pass
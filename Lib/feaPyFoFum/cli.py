@@ -0,0 +1,206 @@
+from __future__ import print_function, unicode_literals
+
+import os
+import sys
+import glob
+import time
+import argparse
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+from .feaPyFoFum import compileFeatures, _atomicOutput, _compiledFileSuffix, _iterScanFeatureLines
+from .cache import CodeBlockCache
+
+
+# -----------------
+# Command Line Tool
+# -----------------
+
+description = """
+Compile the FeaPy features in UFOs. The compiled features of
+each UFO are written to a file next to it, with "-c.fea" in
+place of ".ufo", and the referenced files are compiled for
+each UFO to files next to themselves, with "-<UFO name>-c"
+before the extension, so UFOs that include the same file
+don't overwrite each other's compiled file. With -o, the
+include statements in the compiled features are rewritten to
+point from the output directory to the compiled referenced
+files.
+""".strip()
+
+
+def main(args=None):
+    """
+    Run the command line tool. args are the
+    arguments, without the program name. If it
+    is None, sys.argv is used. Returns the
+    exit status: 0 if everything compiled
+    without errors, 1 otherwise.
+    """
+    parser = argparse.ArgumentParser(prog="feapyfofum", description=description)
+    parser.add_argument("paths", nargs="+", metavar="UFO", help="paths or glob patterns of the UFOs to compile")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="the number of UFOs to compile at the same time")
+    parser.add_argument("-o", "--output-directory", help="write the compiled features to this directory instead")
+    parser.add_argument("-v", "--verbose", action="store_true", help="keep the code blocks in the compiled features")
+    parser.add_argument("--cache", metavar="DIRECTORY", help="store the output of code blocks in this directory")
+    args = parser.parse_args(args)
+    paths = _expandPaths(args.paths)
+    if not paths:
+        print("feapyfofum: no UFOs were found.", file=sys.stderr)
+        return 1
+    # the UFO names are used in the names of the compiled files
+    names = {}
+    for path in paths:
+        name = _fontName(path)
+        if name in names:
+            print("feapyfofum: %s and %s have the same name, so their compiled files would overwrite each other." % (names[name], path), file=sys.stderr)
+            return 1
+        names[name] = path
+    if args.output_directory and not os.path.exists(args.output_directory):
+        os.makedirs(args.output_directory)
+    jobs = [
+        (path, _outputPath(path, args.output_directory), args.verbose, args.cache)
+        for path in paths
+    ]
+    start = time.perf_counter()
+    if args.jobs > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            futures = [pool.submit(compileUFO, *job) for job in jobs]
+            results = [future.result() for future in futures]
+    else:
+        results = [compileUFO(*job) for job in jobs]
+    totalTime = time.perf_counter() - start
+    # report
+    failed = False
+    for result in results:
+        for fileName, line, text in result["errors"]:
+            failed = True
+            if fileName.startswith("<"):
+                # the features in the UFO
+                fileName = os.path.join(result["path"], "features.fea")
+            print("%s:%d: error in code block" % (fileName, line), file=sys.stderr)
+            for textLine in text.splitlines():
+                print("    " + textLine, file=sys.stderr)
+        if result["failure"]:
+            failed = True
+            print("%s: %s" % (result["path"], result["failure"]), file=sys.stderr)
+    print(_formatSummary(results, totalTime))
+    if failed:
+        return 1
+    return 0
+
+
+def compileUFO(path, outPath, verbose=False, cacheDirectory=None):
+    """
+    Compile the features in the UFO at path, including
+    referenced files, and write them to outPath. The
+    file is written to a temporary file and moved into
+    place, so outPath is either left alone or complete.
+    The compiled referenced files are named after the
+    UFO, so that every UFO gets its own.
+
+    Returns a dict with the path, the output path,
+    the time needed in seconds, the errors written by
+    code blocks as (fileName, line, text) tuples and,
+    if the UFO couldn't be compiled at all, a
+    description of the failure.
+    """
+    from defcon import Font
+
+    start = time.perf_counter()
+    errors = []
+    failure = None
+    cache = None
+    if cacheDirectory is not None:
+        cache = CodeBlockCache(cacheDirectory)
+    token = _compiledFileSuffix.set("-%s-c" % _fontName(path))
+    try:
+        font = Font(path)
+        text = compileFeatures(
+            font.features.text or "",
+            font,
+            verbose=verbose,
+            compileReferencedFiles=True,
+            cache=cache,
+            errors=errors
+        )
+        text = _relocateIncludes(text, os.path.dirname(path), os.path.dirname(outPath))
+        with _atomicOutput(outPath) as f:
+            f.write(text)
+    except Exception:
+        failure = traceback.format_exc(limit=1).strip().splitlines()[-1]
+    finally:
+        _compiledFileSuffix.reset(token)
+    return dict(
+        path=path,
+        outPath=outPath,
+        time=time.perf_counter() - start,
+        errors=errors,
+        failure=failure
+    )
+
+
+def _expandPaths(patterns):
+    paths = []
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            found = sorted(glob.glob(pattern))
+        else:
+            found = [pattern]
+        for path in found:
+            path = os.path.normpath(path)
+            if path not in paths:
+                paths.append(path)
+    return paths
+
+
+def _fontName(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def _outputPath(path, outputDirectory=None):
+    directory = os.path.dirname(path)
+    if outputDirectory is not None:
+        directory = outputDirectory
+    return os.path.join(directory, _fontName(path) + "-c.fea")
+
+
+def _relocateIncludes(text, fromDirectory, toDirectory):
+    """
+    Rewrite the relative paths in the include statements
+    in text, which are relative to fromDirectory, so that
+    they are relative to toDirectory. Include statements
+    in comments, strings and code blocks are left alone.
+    """
+    fromDirectory = os.path.abspath(fromDirectory)
+    toDirectory = os.path.abspath(toDirectory)
+    if fromDirectory == toDirectory:
+        return text
+
+    def relocate(match):
+        path = match.group("path")
+        if not os.path.isabs(path):
+            path = os.path.relpath(os.path.join(fromDirectory, path), toDirectory)
+        return "include" + match.group("open") + path + match.group("close")
+
+    scanned = _iterScanFeatureLines(text.split("\n"), rewriteInclude=relocate)
+    return "\n".join(line for kind, line in scanned)
+
+
+def _formatSummary(results, totalTime):
+    lines = []
+    for result in results:
+        if result["failure"]:
+            status = "failed"
+        elif result["errors"]:
+            status = "%d errors" % len(result["errors"])
+        else:
+            status = "ok"
+        lines.append("%8.2fs  %-10s %s" % (result["time"], status, result["path"]))
+    compileTime = sum(result["time"] for result in results)
+    lines.append("%8.2fs  compiled %d UFOs (%.2fs of compile time)" % (totalTime, len(results), compileTime))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
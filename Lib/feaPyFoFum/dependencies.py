@@ -0,0 +1,273 @@
+from __future__ import unicode_literals
+
+import contextlib
+import contextvars
+
+
+# -------------------
+# Dependency Tracking
+# -------------------
+
+# While a code block is executed with tracking, the
+# font is wrapped in a TrackingFont and everything
+# the block reads through it is recorded as a
+# dependency in a set. A dependency is a tuple:
+#
+# - ("font",): anything that isn't tracked in detail
+# - ("glyphOrder",): the glyph order
+# - ("glyphNames",): the set of glyph names
+# - ("unicodes",): the unicodes of all glyphs
+# - ("glyph", name): whether the glyph exists
+# - ("glyph", name, attribute): an attribute of a glyph.
+#   The attribute is one of "unicodes", "width",
+#   "height", "anchors", "lib" and "note" or "*" for
+#   anything else, including the outline.
+# - ("groups",), ("kerning",), ("lib",): a whole mapping
+# - ("groups", key), ("kerning", key), ("lib", key):
+#   one item in a mapping
+# - ("info", attribute): an attribute of the info
+#
+# The values of the dependencies can be compared
+# with cache.dependencyFingerprint.
+
+# the set of dependencies of the block executing in this context
+_activeDependencies = contextvars.ContextVar("feaPyFoFumDependencies", default=None)
+
+
+def _recordDependency(*dependency):
+    dependencies = _activeDependencies.get()
+    if dependencies is not None:
+        dependencies.add(dependency)
+
+
+def _recordKeyDependency(kind, key):
+    # copying a mapping reads all of its keys, which
+    # are covered by the whole mapping that was read.
+    dependencies = _activeDependencies.get()
+    if dependencies is not None and (kind,) not in dependencies:
+        dependencies.add((kind, key))
+
+
+def withoutRedundantDependencies(dependencies):
+    """
+    Get the dependencies without the ones that are
+    covered by others: the items of a mapping that is
+    a dependency as a whole and, if the whole font is a
+    dependency, everything else.
+    """
+    if ("font",) in dependencies:
+        return set([("font",)])
+    redundant = set()
+    for dependency in dependencies:
+        if len(dependency) == 2 and dependency[0] in _mappingKinds and (dependency[0],) in dependencies:
+            redundant.add(dependency)
+    if not redundant:
+        return dependencies
+    return set(dependencies) - redundant
+
+
+_mappingKinds = ("groups", "kerning", "lib")
+
+
+@contextlib.contextmanager
+def recordingDependencies(dependencies):
+    """
+    Record the dependencies read through tracking
+    objects into the dependencies set.
+    """
+    token = _activeDependencies.set(dependencies)
+    try:
+        yield dependencies
+    finally:
+        _activeDependencies.reset(token)
+
+
+class TrackingFont(object):
+
+    """
+    A proxy for a font that records the data that
+    is read through it. Glyphs, groups, kerning, the
+    lib and the info are wrapped in proxies too.
+    Anything that is not tracked in detail is passed
+    through to the font and makes the block depend
+    on the whole font.
+    """
+
+    __slots__ = ("_font",)
+
+    def __init__(self, font):
+        object.__setattr__(self, "_font", font)
+
+    def __repr__(self):
+        return "<TrackingFont %r>" % self._font
+
+    def __getattr__(self, attr):
+        _recordDependency("font")
+        return getattr(self._font, attr)
+
+    def __setattr__(self, attr, value):
+        _recordDependency("font")
+        setattr(self._font, attr, value)
+
+    # the cache is partitioned by path, so
+    # reading it is not a dependency.
+
+    @property
+    def path(self):
+        return self._font.path
+
+    @property
+    def glyphOrder(self):
+        _recordDependency("glyphOrder")
+        return self._font.glyphOrder
+
+    # glyphs
+
+    def keys(self):
+        _recordDependency("glyphNames")
+        return self._font.keys()
+
+    def __len__(self):
+        _recordDependency("glyphNames")
+        return len(self._font)
+
+    def __iter__(self):
+        _recordDependency("glyphNames")
+        for glyph in self._font:
+            yield _TrackingGlyph(glyph)
+
+    def __contains__(self, name):
+        _recordDependency("glyph", name)
+        return name in self._font
+
+    def __getitem__(self, name):
+        _recordDependency("glyph", name)
+        return _TrackingGlyph(self._font[name])
+
+    def get(self, name, default=None):
+        _recordDependency("glyph", name)
+        if name not in self._font:
+            return default
+        return _TrackingGlyph(self._font[name])
+
+    # other data
+
+    @property
+    def groups(self):
+        return _TrackingMapping("groups", self._font.groups)
+
+    @property
+    def kerning(self):
+        return _TrackingMapping("kerning", self._font.kerning)
+
+    @property
+    def lib(self):
+        return _TrackingMapping("lib", self._font.lib)
+
+    @property
+    def info(self):
+        return _TrackingInfo(self._font.info)
+
+
+_trackedGlyphAttributes = dict(
+    unicodes="unicodes",
+    unicode="unicodes",
+    width="width",
+    height="height",
+    anchors="anchors",
+    lib="lib",
+    note="note"
+)
+
+
+class _TrackingGlyph(object):
+
+    __slots__ = ("_glyph",)
+
+    def __init__(self, glyph):
+        object.__setattr__(self, "_glyph", glyph)
+
+    def __repr__(self):
+        return "<TrackingGlyph %r>" % self._glyph
+
+    def __getattr__(self, attr):
+        glyph = self._glyph
+        if attr == "name":
+            return glyph.name
+        _recordDependency("glyph", glyph.name, _trackedGlyphAttributes.get(attr, "*"))
+        return getattr(glyph, attr)
+
+    def __setattr__(self, attr, value):
+        glyph = self._glyph
+        _recordDependency("glyph", glyph.name, "*")
+        setattr(glyph, attr, value)
+
+    def __len__(self):
+        _recordDependency("glyph", self._glyph.name, "*")
+        return len(self._glyph)
+
+    def __iter__(self):
+        _recordDependency("glyph", self._glyph.name, "*")
+        return iter(self._glyph)
+
+
+class _TrackingMapping(object):
+
+    __slots__ = ("_kind", "_mapping")
+
+    def __init__(self, kind, mapping):
+        object.__setattr__(self, "_kind", kind)
+        object.__setattr__(self, "_mapping", mapping)
+
+    def __repr__(self):
+        return "<TrackingMapping %s>" % self._kind
+
+    def __getattr__(self, attr):
+        # keys, items, values and anything
+        # else read the whole mapping.
+        _recordDependency(self._kind)
+        return getattr(self._mapping, attr)
+
+    def __getitem__(self, key):
+        _recordKeyDependency(self._kind, key)
+        return self._mapping[key]
+
+    def get(self, key, default=None):
+        _recordKeyDependency(self._kind, key)
+        return self._mapping.get(key, default)
+
+    def __contains__(self, key):
+        _recordKeyDependency(self._kind, key)
+        return key in self._mapping
+
+    def __setitem__(self, key, value):
+        _recordDependency(self._kind)
+        self._mapping[key] = value
+
+    def __delitem__(self, key):
+        _recordDependency(self._kind)
+        del self._mapping[key]
+
+    def __len__(self):
+        _recordDependency(self._kind)
+        return len(self._mapping)
+
+    def __iter__(self):
+        _recordDependency(self._kind)
+        return iter(self._mapping)
+
+
+class _TrackingInfo(object):
+
+    __slots__ = ("_info",)
+
+    def __init__(self, info):
+        object.__setattr__(self, "_info", info)
+
+    def __getattr__(self, attr):
+        _recordDependency("info", attr)
+        return getattr(self._info, attr)
+
+    def __setattr__(self, attr, value):
+        _recordDependency("info", attr)
+        setattr(self._info, attr, value)
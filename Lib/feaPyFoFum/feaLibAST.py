@@ -0,0 +1,426 @@
+from __future__ import unicode_literals
+
+import re
+import contextlib
+from io import StringIO
+
+from fontTools.feaLib.parser import Parser
+from fontTools.feaLib.lexer import Lexer, NonIncludingLexer
+from fontTools.feaLib.error import FeatureLibError
+
+
+# --------
+# Splicing
+# --------
+
+# In AST mode, writer.write() doesn't format the
+# content. It stores the writer and its content
+# under a placeholder comment and returns that.
+# The compiled text is parsed with a parser that
+# converts the content of a writer to AST statements
+# when it reaches the placeholder, so that classes,
+# mark classes and lookups defined before it can be
+# used, and splices the statements in place of the
+# comment when the text has been parsed.
+
+class ASTSplices(object):
+
+    """
+    The writer content written during a compile in
+    AST mode, keyed by placeholder comment.
+    """
+
+    def __init__(self):
+        self.content = {}
+
+    def add(self, writer):
+        placeholder = "# feaPyFoFum AST %d" % len(self.content)
+        # later changes to the writer must not
+        # change what was written.
+        self.content[placeholder] = (writer, list(writer._content))
+        return placeholder
+
+
+def parseWithSplices(text, splices, glyphNames=(), includeDir=None):
+    """
+    Parse the compiled text into a FeatureFile with
+    the writer content in splices in place of the
+    placeholders.
+    """
+    parser = _SplicingParser(StringIO(text), splices, glyphNames=glyphNames, includeDir=includeDir)
+    return parser.parse()
+
+
+class _SplicingParser(Parser):
+
+    def __init__(self, featurefile, splices, **kwargs):
+        # the parser advances the lexer on init
+        self._splices = splices
+        self._spliced = {}
+        self._blocks = []
+        Parser.__init__(self, featurefile, **kwargs)
+
+    def advance_lexer_(self, comments=False):
+        Parser.advance_lexer_(self, comments)
+        if self.cur_token_type_ is Lexer.COMMENT:
+            placeholder = self.cur_token_.rstrip()
+            content = self._splices.content.get(placeholder)
+            if content is not None:
+                writer, records = content
+                context = ASTContext(self, self._blocks)
+                self._spliced[placeholder] = writer._writeAST(context, records)
+
+    def parse_block_(self, block, vertical, *args, **kwargs):
+        if isinstance(block, self.ast.FeatureBlock):
+            tag = block.name.strip()
+        elif self._blocks:
+            tag = self._blocks[-1]
+        else:
+            tag = None
+        self._blocks.append(tag)
+        try:
+            return Parser.parse_block_(self, block, vertical, *args, **kwargs)
+        finally:
+            self._blocks.pop()
+
+    def parse(self):
+        doc = Parser.parse(self)
+        if self._spliced:
+            doc.statements = self._spliceStatements(doc.statements)
+        return doc
+
+    def _spliceStatements(self, statements):
+        spliced = []
+        for statement in statements:
+            if isinstance(statement, self.ast.Comment):
+                replacement = self._spliced.get(statement.text.rstrip())
+                if replacement is not None:
+                    spliced.extend(replacement)
+                    continue
+            elif isinstance(statement, self.ast.Block):
+                statement.statements = self._spliceStatements(statement.statements)
+            spliced.append(statement)
+        return spliced
+
+
+# ----------
+# Converting
+# ----------
+
+class ASTFallback(Exception):
+
+    """
+    Raised when a record can't be converted directly.
+    The record is formatted and parsed instead.
+    """
+
+
+# the tokens of the feaLib lexer
+_glyphNameRE = re.compile(r"[A-Za-z_+*:.^~!][A-Za-z0-9_.+*:^~!/-]*")
+_classNameRE = re.compile(r"@[A-Za-z0-9_.\-]+")
+_numberRE = re.compile(r"-[0-9]+|0|[1-9][0-9]*")
+_valueRecordRE = re.compile(r"<\s*(\S+)\s+(\S+)\s+(\S+)\s+(\S+)\s*>")
+
+_verticalFeatureTags = {"vkrn", "vpal", "vhal", "valt"}
+
+# the tag of the feature that wraps
+# records parsed inside of a lookup.
+_fallbackFeatureTag = "zzzz"
+
+
+class ASTContext(object):
+
+    """
+    Converts writer records to fontTools.feaLib.ast
+    statements the way the parser would parse the
+    formatted records. Classes, mark classes and
+    lookups are resolved in and defined in the symbol
+    tables of the parser. blocks lists the tags of
+    the features around the content, None for a
+    lookup outside of a feature.
+    """
+
+    Fallback = ASTFallback
+
+    def __init__(self, parser=None, blocks=()):
+        if parser is None:
+            parser = Parser(StringIO(""), followIncludes=False)
+        self.parser = parser
+        self.ast = parser.ast
+        self._blocks = list(blocks)
+
+    # blocks
+
+    @contextlib.contextmanager
+    def block(self, tag=None):
+        if tag is None and self._blocks:
+            tag = self._blocks[-1]
+        self._blocks.append(tag)
+        for table in self.parser.symbol_tables_:
+            table.enter_scope()
+        try:
+            yield
+        finally:
+            for table in self.parser.symbol_tables_:
+                table.exit_scope()
+            self._blocks.pop()
+
+    @property
+    def vertical(self):
+        return bool(self._blocks) and self._blocks[-1] in _verticalFeatureTags
+
+    def featureBlock(self, name):
+        return self.ast.FeatureBlock(self.tag(name))
+
+    def lookupBlock(self, name):
+        if not _glyphNameRE.fullmatch(name):
+            raise ASTFallback
+        return self.ast.LookupBlock(name)
+
+    def defineLookup(self, name, block):
+        self.parser.lookups_.define(name, block)
+
+    def subtable(self):
+        return self.ast.SubtableStatement()
+
+    # parsing
+
+    def parse(self, text):
+        """
+        Parse formatted records in place of the content.
+        """
+        if self._blocks:
+            tag = self._blocks[-1] or _fallbackFeatureTag
+            text = "feature %s {\n%s\n} %s;" % (tag, text, tag)
+        parser = _FragmentParser(text, self.parser)
+        try:
+            statements = parser.parse().statements
+        except FeatureLibError as error:
+            # the location in the fragment means nothing
+            raise FeatureLibError(error.args[0], self.parser.cur_token_location_)
+        if self._blocks:
+            statements = statements[0].statements
+        return statements
+
+    # names and values
+
+    def tag(self, name):
+        if len(name) > 4 or not _glyphNameRE.fullmatch(name):
+            raise ASTFallback
+        return (name + "    ")[:4]
+
+    def glyphName(self, name, inClass=False):
+        if not _glyphNameRE.fullmatch(name):
+            raise ASTFallback
+        parser = self.parser
+        glyphNames = parser.glyphNames_
+        if "-" in name and inClass and name not in glyphNames:
+            # a range or an ambiguous name
+            raise ASTFallback
+        if glyphNames and name not in glyphNames:
+            parser.check_glyph_name_in_glyph_set(name)
+        return name
+
+    def classReference(self, name):
+        if not _classNameRE.fullmatch(name):
+            raise ASTFallback
+        definition = self.parser.glyphclasses_.resolve(name[1:])
+        if definition is None:
+            raise ASTFallback
+        if isinstance(definition, self.ast.MarkClass):
+            return self.ast.MarkClassName(definition)
+        return self.ast.GlyphClassName(definition)
+
+    def markClass(self, name):
+        if not _classNameRE.fullmatch(name):
+            raise ASTFallback
+        markClass = self.parser.glyphclasses_.resolve(name[1:])
+        if not isinstance(markClass, self.ast.MarkClass):
+            raise ASTFallback
+        return markClass
+
+    def glyphClass(self, members, acceptGlyphName=True):
+        if isinstance(members, str):
+            if members.startswith("@"):
+                return self.classReference(members)
+            if not acceptGlyphName:
+                raise ASTFallback
+            return self.ast.GlyphName(self.glyphName(members))
+        glyphClass = self.ast.GlyphClass()
+        for member in members:
+            if member.startswith("@"):
+                glyphClass.add_class(self.classReference(member))
+            else:
+                glyphClass.append(self.glyphName(member, inClass=True))
+        return glyphClass
+
+    def glyphSequence(self, members):
+        return [self.glyphClass(member) for member in members]
+
+    def number(self, value):
+        if type(value) is int:
+            return value
+        if isinstance(value, str) and _numberRE.fullmatch(value):
+            return int(value)
+        raise ASTFallback
+
+    def valueRecord(self, value):
+        vertical = self.vertical
+        if isinstance(value, str):
+            if _numberRE.fullmatch(value):
+                if vertical:
+                    return self.ast.ValueRecord(yAdvance=int(value), vertical=vertical)
+                return self.ast.ValueRecord(xAdvance=int(value), vertical=vertical)
+            match = _valueRecordRE.fullmatch(value)
+            if match is None:
+                raise ASTFallback
+            value = match.groups()
+        elif not isinstance(value, tuple) or len(value) != 4:
+            raise ASTFallback
+        xPlacement, yPlacement, xAdvance, yAdvance = [self.number(i) for i in value]
+        return self.ast.ValueRecord(xPlacement, yPlacement, xAdvance, yAdvance, vertical=vertical)
+
+    def anchor(self, anchor):
+        return self.ast.Anchor(int(anchor[0]), int(anchor[1]))
+
+    # records
+
+    def convert(self, record):
+        """
+        Get the statement for the record, None if
+        there is none, or raise ASTFallback.
+        """
+        method = getattr(self, "_" + record.identifier, None)
+        if method is None:
+            raise ASTFallback
+        return method(*record)
+
+    def _blankLine(self):
+        return None
+
+    def _comment(self, comment):
+        return self.ast.Comment(comment)
+
+    def _classDefinition(self, name, members):
+        if not _classNameRE.fullmatch(name):
+            raise ASTFallback
+        glyphs = self.glyphClass(members, acceptGlyphName=False)
+        definition = self.ast.GlyphClassDefinition(name[1:], glyphs)
+        self.parser.glyphclasses_.define(name[1:], definition)
+        return definition
+
+    def _markClassDefinition(self, members, anchor, name):
+        if not _classNameRE.fullmatch(name):
+            raise ASTFallback
+        glyphs = self.glyphClass(members)
+        if not glyphs.glyphSet():
+            raise ASTFallback
+        anchor = self.anchor(anchor)
+        name = name[1:]
+        parser = self.parser
+        markClass = parser.doc_.markClasses.get(name)
+        if markClass is None:
+            markClass = self.ast.MarkClass(name)
+            parser.doc_.markClasses[name] = markClass
+            parser.glyphclasses_.define(name, markClass)
+        definition = self.ast.MarkClassDefinition(markClass, anchor, glyphs)
+        markClass.addDefinition(definition)
+        return definition
+
+    def _lookupReference(self, name):
+        lookup = self.parser.lookups_.resolve(name)
+        if lookup is None:
+            raise ASTFallback
+        return self.ast.LookupReferenceStatement(lookup)
+
+    def _substitution(self, target, substitution, backtrack, lookahead, choice):
+        if substitution is None:
+            # ignore rules
+            raise ASTFallback
+        forceChain = backtrack is not None or lookahead is not None
+        prefix = self.glyphSequence(backtrack or [])
+        suffix = self.glyphSequence(lookahead or [])
+        old = self.glyphSequence(target)
+        if choice:
+            if len(old) != 1 or len(old[0].glyphSet()) != 1:
+                raise ASTFallback
+            return self.ast.AlternateSubstStatement(prefix, old[0], suffix, self.glyphClass(list(substitution)))
+        if "NULL" in substitution:
+            raise ASTFallback
+        new = self.glyphSequence(substitution)
+        if len(old) == 1 and len(new) == 1:
+            count = len(new[0].glyphSet())
+            if count != 1 and count != len(old[0].glyphSet()):
+                raise ASTFallback
+            return self.ast.SingleSubstStatement(old, new, prefix, suffix, forceChain=forceChain)
+        if len(old) == 1 and len(new) > 1:
+            count = len(old[0].glyphSet())
+            for glyphs in new:
+                size = len(glyphs.glyphSet())
+                if size == 0 or (size != 1 and size != count):
+                    raise ASTFallback
+            return self.ast.MultipleSubstStatement(prefix, old[0], suffix, new, forceChain=forceChain)
+        if len(old) > 1 and len(new) == 1:
+            glyphs = new[0].glyphSet()
+            if len(glyphs) == 1:
+                return self.ast.LigatureSubstStatement(prefix, old, suffix, glyphs[0], forceChain=forceChain)
+        raise ASTFallback
+
+    def _positionSingle(self, target, value, backtrack, lookahead):
+        if value is None or backtrack is not None or lookahead is not None or len(target) != 1:
+            raise ASTFallback
+        return self.ast.SinglePosStatement([(self.glyphClass(target[0]), self.valueRecord(value))], [], [], forceChain=False)
+
+    def positionPair(self, target, value, enumerate):
+        if value is None or isinstance(target, str) or len(target) != 2:
+            raise ASTFallback
+        first, second = target
+        return self.ast.PairPosStatement(
+            self.glyphClass(first),
+            self.valueRecord(value),
+            self.glyphClass(second),
+            None,
+            enumerated=bool(enumerate)
+        )
+
+    def _positionMarkToBase(self, target, anchor, markClass):
+        return self.ast.MarkBasePosStatement(self.glyphClass(target), [(self.anchor(anchor), self.markClass(markClass))])
+
+    def _positionMarkToMark(self, target, anchor, markClass):
+        return self.ast.MarkMarkPosStatement(self.glyphClass(target), [(self.anchor(anchor), self.markClass(markClass))])
+
+    def _positionMarkToLigature(self, target, anchor_data):
+        marks = [[(self.anchor(anchor), self.markClass(markClass))] for anchor, markClass in anchor_data]
+        if not marks:
+            marks = [[]]
+        return self.ast.MarkLigPosStatement(self.glyphClass(target), marks)
+
+
+class _FragmentParser(Parser):
+
+    """
+    Parses formatted records with the symbol
+    tables and the glyph names of parser.
+    """
+
+    def __init__(self, text, parser):
+        self._parser = parser
+        lexer = parser.lexer_
+        Parser.__init__(
+            self,
+            StringIO(text),
+            followIncludes=not isinstance(lexer, NonIncludingLexer),
+            includeDir=getattr(lexer, "includeDir", None)
+        )
+        self.glyphNames_ = parser.glyphNames_
+        self.anchors_ = parser.anchors_
+        self.glyphclasses_ = parser.glyphclasses_
+        self.lookups_ = parser.lookups_
+        self.valuerecords_ = parser.valuerecords_
+        self.symbol_tables_ = parser.symbol_tables_
+        self.doc_.markClasses = parser.doc_.markClasses
+
+    def check_glyph_name_in_glyph_set(self, *names):
+        # missing glyphs are reported by the parser
+        # at the location of the placeholder.
+        self._parser.check_glyph_name_in_glyph_set(*names)
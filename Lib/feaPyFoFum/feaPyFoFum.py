@@ -2,9 +2,26 @@ from __future__ import unicode_literals
 
 import os
 import sys
+import gc
+import pickle
+import time
+import tempfile
 import traceback
 import re
+import threading
+import contextlib
+import contextvars
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from io import StringIO
+from array import array
+from collections import namedtuple, deque
+from .cache import BytecodeCache
+from .glyphIndex import GlyphIndex
+from .snapshot import FontSnapshot
+from .profiling import CompileProfile
+from .dependencies import TrackingFont, recordingDependencies
 
 
 class FeaPyFoFumError(Exception):
@@ -15,7 +32,7 @@ class FeaPyFoFumError(Exception):
 # External API
 # ------------
 
-def compileFeatures(text, font, verbose=False, compileReferencedFiles=False):
+def compileFeatures(text, font, verbose=False, compileReferencedFiles=False, cache=None, workers=None, bytecodeCache=None, snapshot=False, profile=False, errors=None):
     """
     Compile the dynamic features in the given text.
 
@@ -31,191 +48,1019 @@ def compileFeatures(text, font, verbose=False, compileReferencedFiles=False):
     files will be compiled and the references will be updated.
     The locations of the referenced files are assumed to be
     relative to the directory containing the font.
+
+    If workers is greater than 1, the referenced files
+    will be compiled concurrently in that many processes.
+    The code blocks in the referenced files are then
+    given a FontSnapshot of the font, which is what is
+    sent to the processes.
+
+    If a CodeBlockCache is given as cache, the output of
+    code blocks will be stored in it and reused when
+    neither the code blocks nor the font have changed.
+
+    Code blocks are compiled through a BytecodeCache.
+    If none is given as bytecodeCache, a shared
+    in-memory cache will be used.
+
+    If snapshot is True, the code blocks will be given
+    a FontSnapshot of the font instead of the font.
+    A snapshot is faster to read from and to send to
+    worker processes, but it only has the data listed
+    in the FontSnapshot documentation.
+
+    If profile is True or a CompileProfile, the time
+    spent in each code block will be measured and a
+    tuple of the compiled text and the CompileProfile
+    will be returned. While profiling, the cache is
+    not used and referenced files are compiled in
+    this process, so that every block is executed
+    and measured.
+
+    If a list is given as errors, a (fileName, line, text)
+    tuple will be added to it for every code block that
+    wrote to stderr, including the blocks in referenced
+    files. line is the line of the block's # >>> marker.
     """
-    if not compileReferencedFiles:
-        text = _compileFeatureText(
-            text,
-            font,
-            verbose=verbose
-        )[0]
-    else:
-        relativePath = None
-        if font.path:
-            relativePath = os.path.dirname(font.path)
-        text, referencedFiles = _compileFeatureText(
+    if profile is True:
+        profile = CompileProfile()
+    elif not isinstance(profile, CompileProfile):
+        profile = None
+    if profile is not None:
+        cache = None
+        workers = None
+    token = _activeProfile.set(profile)
+    errorsToken = _collectedErrors.set(errors)
+    try:
+        lines = iterCompileFeatures(
             text,
             font,
-            relativePath=relativePath,
-            verbose=verbose
+            verbose=verbose,
+            compileReferencedFiles=compileReferencedFiles,
+            cache=cache,
+            workers=workers,
+            bytecodeCache=bytecodeCache,
+            snapshot=snapshot
         )
-        for inPath, outPath in referencedFiles:
-            _compileReferencedFeatureFile(
-                inPath,
-                outPath,
+        text = "\n".join(lines)
+    finally:
+        _activeProfile.reset(token)
+        _collectedErrors.reset(errorsToken)
+    if profile is not None:
+        return text, profile
+    return text
+
+
+def compileFeaturesForFonts(text, fonts, verbose=False, cache=None, workers=None, bytecodeCache=None, snapshot=False):
+    """
+    Compile the dynamic features in the given text
+    for each of the given fonts. This returns a list
+    of compiled texts in the same order as the fonts.
+
+    The text is split into static lines and code blocks
+    and the code blocks are compiled only once. After
+    that the code blocks are executed for each font.
+    If workers is greater than 1, the fonts will be
+    processed concurrently in that many processes and
+    the code blocks will be given FontSnapshots of the
+    fonts, which is what is sent to the processes.
+
+    Referenced files are not compiled. The other
+    arguments are the same as the arguments for
+    compileFeatures.
+    """
+    template = FeaPyTemplate(text, bytecodeCache=bytecodeCache)
+    if snapshot:
+        fonts = [FontSnapshot(font) for font in fonts]
+    if workers is None or workers < 2 or len(fonts) < 2:
+        texts = [
+            template.render(font, verbose=verbose, cache=cache)
+            for font in fonts
+        ]
+    else:
+        fonts = [_snapshotFont(font) for font in fonts]
+        with _makeProcessPool(workers, template=template, fonts=fonts) as pool:
+            futures = [
+                pool.submit(_renderTemplateInWorker, index, verbose, cache)
+                for index in range(len(fonts))
+            ]
+            texts = [future.result() for future in futures]
+    if cache is not None and cache.enabled:
+        cache.trim()
+    return texts
+
+
+def compileFeaturesTo(source, font, out, verbose=False, compileReferencedFiles=False, cache=None, workers=None, bytecodeCache=None, snapshot=False):
+    """
+    Compile the dynamic features in source and write
+    the result to the file object out as it is compiled.
+
+    The source may be a string or a file object. File
+    objects are read lazily, line by line. The arguments
+    are the same as the arguments for compileFeatures
+    and the written text is the same as the text that
+    compileFeatures would return.
+    """
+    lines = iterCompileFeatures(
+        source,
+        font,
+        verbose=verbose,
+        compileReferencedFiles=compileReferencedFiles,
+        cache=cache,
+        workers=workers,
+        bytecodeCache=bytecodeCache,
+        snapshot=snapshot
+    )
+    _writeLines(lines, out)
+
+
+def iterCompileFeatures(source, font, verbose=False, compileReferencedFiles=False, cache=None, workers=None, bytecodeCache=None, snapshot=False):
+    """
+    Compile the dynamic features in source and yield
+    the compiled lines, without line endings, as they
+    are compiled.
+
+    The source may be a string or a file object. The
+    arguments are the same as the arguments for
+    compileFeatures.
+
+    If source is a file object, referenced files are
+    compiled after the last line has been yielded.
+    """
+    if snapshot:
+        font = FontSnapshot(font)
+    blockCache = None
+    if cache is not None and cache.enabled:
+        blockCache = cache.session(font)
+    glyphIndex = GlyphIndex(font)
+    if isinstance(source, str):
+        lines = source.splitlines()
+    else:
+        lines = _iterLines(source)
+    relativePath = None
+    if compileReferencedFiles and font.path:
+        relativePath = os.path.dirname(font.path)
+    if relativePath is None:
+        for line in _iterCompileFeatureLines(lines, font, verbose=verbose, blockCache=blockCache, bytecodeCache=bytecodeCache, glyphIndex=glyphIndex):
+            yield line
+    else:
+        # the graph can only be built before the text is
+        # compiled if the text can be read more than once.
+        referencedFiles = None
+        if isinstance(source, str):
+            referencedFiles = _buildIncludeGraph(_findReferencedFilesInLines(lines, relativePath), relativePath)
+        pool = None
+        futures = None
+        if workers is not None and workers > 1 and referencedFiles:
+            pool = _makeProcessPool(workers, font=_snapshotFont(font))
+            futures = _submitReferencedFeatureFiles(pool, referencedFiles, relativePath, blockCache, bytecodeCache)
+        try:
+            rootReferencedFiles = []
+            compiledLines = _iterCompileFeatureLines(
+                lines,
+                font,
+                relativePath=relativePath,
+                verbose=verbose,
+                blockCache=blockCache,
+                bytecodeCache=bytecodeCache,
+                referencedFiles=rootReferencedFiles,
+                glyphIndex=glyphIndex
+            )
+            for line in compiledLines:
+                yield line
+            if referencedFiles is None:
+                referencedFiles = _buildIncludeGraph(rootReferencedFiles, relativePath)
+            if pool is not None:
+                _collectReferencedFeatureFiles(futures)
+            else:
+                _compileReferencedFeatureFiles(
+                    referencedFiles,
+                    relativePath,
+                    font,
+                    workers=workers,
+                    blockCache=blockCache,
+                    bytecodeCache=bytecodeCache,
+                    glyphIndex=glyphIndex
+                )
+        finally:
+            if pool is not None:
+                pool.shutdown()
+    if blockCache is not None:
+        cache.trim()
+
+
+def compileFeaturesToAST(text, font, verbose=False, compileReferencedFiles=False, workers=None, bytecodeCache=None, snapshot=False, errors=None):
+    """
+    Compile the dynamic features in the given text and
+    parse the result into a fontTools.feaLib.ast.FeatureFile.
+
+    The content of the writers is converted to AST
+    statements directly, without being formatted and
+    parsed, and spliced into the parsed static parts
+    of the text. For this, writer.write() returns a
+    placeholder comment instead of the text while the
+    text is compiled, so code blocks must print what
+    it returns as it is.
+
+    The glyph names are checked against the glyphs
+    in the font. Referenced files are compiled to
+    text, as in compileFeatures, and are parsed
+    through the include statements. The output of
+    code blocks is never cached. The other arguments
+    are the same as the arguments for compileFeatures.
+    """
+    from .feaLibAST import ASTSplices, parseWithSplices
+
+    if snapshot:
+        font = FontSnapshot(font)
+    glyphIndex = GlyphIndex(font)
+    relativePath = None
+    if compileReferencedFiles and font.path:
+        relativePath = os.path.dirname(font.path)
+    splices = ASTSplices()
+    errorsToken = _collectedErrors.set(errors)
+    try:
+        token = _activeSplices.set(splices)
+        try:
+            text, referencedFiles = _compileFeatureText(
+                text,
+                font,
+                relativePath=relativePath,
+                verbose=verbose,
+                bytecodeCache=bytecodeCache,
+                glyphIndex=glyphIndex
+            )
+        finally:
+            _activeSplices.reset(token)
+        if relativePath is not None:
+            _compileReferencedFeatureFiles(
+                _buildIncludeGraph(referencedFiles, relativePath),
                 relativePath,
                 font,
-                verbose=False
+                workers=workers,
+                bytecodeCache=bytecodeCache,
+                glyphIndex=glyphIndex
             )
-    return text
+    finally:
+        _collectedErrors.reset(errorsToken)
+    includeDir = None
+    if font.path:
+        includeDir = os.path.dirname(font.path)
+    return parseWithSplices(text, splices, glyphNames=font.keys(), includeDir=includeDir)
+
+
+# ---------
+# Templates
+# ---------
+
+class FeaPyTemplate(object):
+
+    """
+    A feature text that has been parsed once so that
+    it can be rendered for a font over and over again.
+
+    The static lines are stored as joined segments and
+    the code blocks are extracted and compiled when the
+    template is created. Rendering only executes the
+    code blocks. fileName is the path tracebacks will
+    refer to. Code is compiled through bytecodeCache or,
+    if it is None, a shared in-memory BytecodeCache.
+    """
+
+    def __init__(self, text, fileName=None, bytecodeCache=None):
+        if bytecodeCache is None:
+            bytecodeCache = _defaultBytecodeCache
+        self.bytecodeCache = bytecodeCache
+        self._segments = []
+        staticLines = []
+        for item in _iterParseFeatureLines(text.splitlines(), fileName):
+            if not isinstance(item, _CodeBlock):
+                staticLines.append(item)
+                continue
+            if staticLines:
+                self._segments.append("\n".join(staticLines))
+                staticLines = []
+            try:
+                item.compiledCode = bytecodeCache.compile(item.code, item.fileName, item.lineOffset)
+            except Exception:
+                # this will be reported when the block is executed
+                pass
+            self._segments.append(item)
+        if staticLines:
+            self._segments.append("\n".join(staticLines))
+
+    def render(self, font, verbose=False, cache=None):
+        """
+        Render the template for the font. The arguments
+        are the same as the arguments for compileFeatures.
+        The cache is not trimmed, that is left to
+        the caller.
+        """
+        blockCache = None
+        if cache is not None and cache.enabled:
+            blockCache = cache.session(font)
+        pieces = _iterExecuteParsedFeatures(
+            self._segments,
+            font,
+            _makeNamespace(font),
+            verbose=verbose,
+            blockCache=blockCache,
+            bytecodeCache=self.bytecodeCache
+        )
+        return "\n".join(pieces)
 
 
 # ------------------
 # .fea File Creation
 # ------------------
 
-def _compileFeatureText(text, font, relativePath=None, verbose=False, recursionDepth=0):
+def _compileFeatureText(text, font, relativePath=None, verbose=False, blockCache=None, bytecodeCache=None, fileName=None, glyphIndex=None):
     """
     Compile the completed feature text.
     If the relativePath is given files referenced
-    with include statements will be processed
+    with include statements will be redirected
+    to their compiled versions. fileName is
+    the path tracebacks will refer to.
     """
     referencedFiles = []
-    if relativePath is not None:
-        # find referenced files and update them to the new paths
-        # XXX the relative path stuff here is potentially problematic.
-        # XXX the .fea spec is vague about how paths should be resolved.
-        if recursionDepth <= 5:
-            fileMapping = _getReferencedFileMapping(text)
-            for referenceInPath, referencedData in fileMapping.items():
-                referenceInPath = os.path.normpath(os.path.join(relativePath, referenceInPath))
-                referenceOutPath = os.path.normpath(os.path.join(relativePath, referencedData["outPath"]))
-                referencedFiles.append((referenceInPath, referenceOutPath))
-                text = text.replace(referencedData["target"], referencedData["replacement"])
-        else:
-            raise FeaPyFoFumError("Maximum reference file recursion depth exceeded.")
-    # compile
-    namespace = {}
-    text = _executeFeatureText(text, font, namespace, verbose=verbose)
-    return text, referencedFiles
+    lines = _iterCompileFeatureLines(
+        text.splitlines(),
+        font,
+        relativePath=relativePath,
+        verbose=verbose,
+        blockCache=blockCache,
+        bytecodeCache=bytecodeCache,
+        fileName=fileName,
+        referencedFiles=referencedFiles,
+        glyphIndex=glyphIndex
+    )
+    text = "\n".join(lines)
+    return text, _uniqueReferencedFiles(referencedFiles)
+
+
+def _iterCompileFeatureLines(lines, font, relativePath=None, verbose=False, blockCache=None, bytecodeCache=None, fileName=None, referencedFiles=None, glyphIndex=None):
+    """
+    Compile the lines and yield the compiled lines.
+    If the relativePath is given files referenced
+    with include statements will be redirected
+    to their compiled versions and added to
+    referencedFiles, if it is given. glyphIndex
+    is shared by all files in a compile.
+    """
+    namespace = _makeNamespace(font, glyphIndex)
+    return _iterExecuteFeatureLines(
+        lines,
+        font,
+        namespace,
+        verbose=verbose,
+        blockCache=blockCache,
+        bytecodeCache=bytecodeCache,
+        fileName=fileName,
+        relativePath=relativePath,
+        referencedFiles=referencedFiles
+    )
 
 
-def _compileReferencedFeatureFile(inPath, outPath, relativePath, font, verbose=False, recursionDepth=0):
+def _compileReferencedFeatureFile(inPath, outPath, relativePath, font, verbose=False, blockCache=None, bytecodeCache=None, glyphIndex=None):
     """
     Compile the file given in inPath and write it to outPath.
+    Files referenced by this file are not compiled.
+    The file is read and written line by line.
     """
     if not os.path.exists(inPath):
         # XXX silently fail here?
         return
-    # compile and write this file
-    with open(inPath, "r") as f:
-        text = f.read()
-    text, referencedFiles = _compileFeatureText(
-        text,
-        font,
-        relativePath,
-        verbose=verbose,
-        recursionDepth=recursionDepth
+    # compile and write this file. the output is written
+    # to a temporary file first so that a failure doesn't
+    # leave a partially written file behind.
+    with open(inPath, "r") as inFile, _atomicOutput(outPath) as outFile:
+        lines = _iterCompileFeatureLines(
+            _iterLines(inFile),
+            font,
+            relativePath,
+            verbose=verbose,
+            blockCache=blockCache,
+            bytecodeCache=bytecodeCache,
+            fileName=inPath,
+            glyphIndex=glyphIndex
+        )
+        _writeLines(lines, outFile)
+
+
+def _compileReferencedFeatureFiles(referencedFiles, relativePath, font, workers=None, blockCache=None, bytecodeCache=None, glyphIndex=None):
+    """
+    Compile the (inPath, outPath) pairs in referencedFiles,
+    in that many processes if workers is greater than 1.
+    """
+    activeWorkerPool = _activeWorkerPool.get()
+    if workers is not None and workers > 1 and referencedFiles:
+        pool = _makeProcessPool(workers, font=_snapshotFont(font))
+        try:
+            futures = _submitReferencedFeatureFiles(pool, referencedFiles, relativePath, blockCache, bytecodeCache)
+            _collectReferencedFeatureFiles(futures)
+        finally:
+            pool.shutdown()
+    elif activeWorkerPool is not None and len(referencedFiles) > 1:
+        # the blocks are executed in the processes of
+        # the WorkerPool, so threads are enough here.
+        workerPool = activeWorkerPool[0]
+        with ThreadPoolExecutor(max_workers=workerPool.workers) as threads:
+            futures = [
+                threads.submit(
+                    contextvars.copy_context().run,
+                    _compileReferencedFeatureFileCollectingErrors,
+                    inPath,
+                    outPath,
+                    relativePath,
+                    font,
+                    False,
+                    blockCache,
+                    bytecodeCache,
+                    glyphIndex
+                )
+                for inPath, outPath in referencedFiles
+            ]
+            _collectReferencedFeatureFiles(futures)
+    else:
+        for inPath, outPath in referencedFiles:
+            _compileReferencedFeatureFile(
+                inPath,
+                outPath,
+                relativePath,
+                font,
+                verbose=False,
+                blockCache=blockCache,
+                bytecodeCache=bytecodeCache,
+                glyphIndex=glyphIndex
+            )
+
+
+def _iterLines(f):
+    """
+    Iterate over the lines in the file object,
+    splitting them in the same way that
+    str.splitlines does.
+    """
+    for line in f:
+        for subLine in line.splitlines():
+            yield subLine
+
+
+def _getNewFileMode():
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+# the mode of files created with open
+_newFileMode = _getNewFileMode()
+
+
+@contextlib.contextmanager
+def _atomicOutput(path):
+    """
+    Open a temporary file next to path for writing
+    and move it into place if the block finishes
+    without an error. The temporary file has a unique
+    name, so processes writing the same file at the
+    same time, for example a file included by several
+    masters, don't get in each other's way: the file
+    is always the complete output of one of them.
+    """
+    fd, tempPath = tempfile.mkstemp(dir=os.path.dirname(path) or os.curdir)
+    try:
+        with os.fdopen(fd, "w") as f:
+            yield f
+        # mkstemp only gives access to the owner
+        os.chmod(tempPath, _newFileMode)
+        os.replace(tempPath, path)
+    except BaseException:
+        if os.path.exists(tempPath):
+            os.remove(tempPath)
+        raise
+
+
+def _writeLines(lines, f):
+    """
+    Write the lines to the file object with
+    the same result as writing "\n".join(lines).
+    """
+    first = True
+    for line in lines:
+        if not first:
+            f.write("\n")
+        f.write(line)
+        first = False
+
+
+# -------------------
+# Parallel Processing
+# -------------------
+
+_workerState = {}
+
+
+def _initializeWorker(stateData):
+    _workerState.update(pickle.loads(stateData))
+
+
+def _processContext():
+    """
+    Get the multiprocessing context worker processes
+    are started in. A process forked while another
+    thread holds a lock, for example _captureLock,
+    inherits the lock held and waits for it forever,
+    so the processes are forked from a fork server,
+    which has no other threads, or spawned where there
+    is no fork server.
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+
+def _makeProcessPool(workers, **state):
+    """
+    Make a process pool in which each process has
+    access to the given state, for example a snapshot
+    of the font, in _workerState. The state is pickled
+    once and unpickled in each process.
+    """
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=_processContext(),
+        initializer=_initializeWorker,
+        initargs=(pickle.dumps(state, pickle.HIGHEST_PROTOCOL),)
     )
-    with open(outPath, "w") as f:
-        f.write(text)
-    # recurse through the referenced files
-    for referenceInPath, referenceOutPath in referencedFiles:
+
+
+def _snapshotFont(font):
+    """
+    Get a FontSnapshot of the font to send to
+    worker processes, unless it is one already.
+    """
+    if isinstance(font, FontSnapshot):
+        return font
+    return FontSnapshot(font)
+
+
+def _compileReferencedFeatureFileInWorker(inPath, outPath, relativePath, verbose, blockCache, bytecodeCache, compiledFileSuffix):
+    """
+    Compile a referenced file and return the
+    errors written by the code blocks in it.
+    The context of the compile isn't available in
+    the worker, so the suffix of the compiled
+    files is given as compiledFileSuffix.
+    """
+    font = _workerState["font"]
+    # the index is shared by the files compiled in this process
+    glyphIndex = _workerState.get("glyphIndex")
+    if glyphIndex is None:
+        glyphIndex = _workerState["glyphIndex"] = GlyphIndex(font)
+    token = _compiledFileSuffix.set(compiledFileSuffix)
+    try:
+        return _compileReferencedFeatureFileCollectingErrors(
+            inPath,
+            outPath,
+            relativePath,
+            font,
+            verbose,
+            blockCache,
+            bytecodeCache,
+            glyphIndex
+        )
+    finally:
+        _compiledFileSuffix.reset(token)
+
+
+def _compileReferencedFeatureFileCollectingErrors(inPath, outPath, relativePath, font, verbose, blockCache, bytecodeCache, glyphIndex):
+    """
+    Compile a referenced file and return the errors
+    written by the code blocks in it, rather than
+    adding them to the errors of the compile.
+    """
+    errors = []
+    token = _collectedErrors.set(errors)
+    try:
         _compileReferencedFeatureFile(
-            referenceInPath,
-            referenceOutPath,
+            inPath,
+            outPath,
             relativePath,
             font,
             verbose=verbose,
-            recursionDepth=recursionDepth + 1
+            blockCache=blockCache,
+            bytecodeCache=bytecodeCache,
+            glyphIndex=glyphIndex
         )
+    finally:
+        _collectedErrors.reset(token)
+    return errors
+
+
+def _renderTemplateInWorker(index, verbose, cache):
+    template = _workerState["template"]
+    font = _workerState["fonts"][index]
+    return template.render(font, verbose=verbose, cache=cache)
 
 
-def _getReferencedFileMapping(text):
-    """
-    Get a mapping of referenced files in the text.
-    The returned value has this form:
-
-        {
-            originalPath : {
-                outPath : new path
-                target : original include statement
-                replacement : new include statement
-            }
-        }
-
-    All paths are relative.
-    """
-    referencedFiles = _findReferenceFiles(text)
-    mapping = {}
-    for include in referencedFiles:
-        includeStart = include.index("(") + 1
-        includeEnd = include.index(")")
-        inPath = include[includeStart:includeEnd]
-        outPath, ext = os.path.splitext(inPath)
-        outPath += "-c"
-        outPath += ext
-        mapping[inPath] = dict(
-            outPath=outPath,
-            target=include,
-            replacement=include[:includeStart] + outPath + include[includeEnd:]
+def _submitReferencedFeatureFiles(pool, referencedFiles, relativePath, blockCache=None, bytecodeCache=None):
+    """
+    Submit the referenced files for compilation in
+    the pool. Each file is compiled in a fresh namespace
+    no matter where it is compiled, so the results are
+    the same as they would be if everything was
+    compiled serially. This returns a list of futures.
+    """
+    return [
+        pool.submit(
+            _compileReferencedFeatureFileInWorker,
+            inPath,
+            outPath,
+            relativePath,
+            False,
+            blockCache,
+            bytecodeCache,
+            _compiledFileSuffix.get()
         )
-    return mapping
+        for inPath, outPath in referencedFiles
+    ]
 
 
-def _findReferenceFiles(text):
+def _collectReferencedFeatureFiles(futures):
     """
-    Find all include statements in the text.
+    Wait for the files submitted to the pool and
+    collect the errors of their code blocks.
     """
-    text = _stripComments(text)
-    pattern = re.compile(
-        "include\s*\("
-        "[^\)]+"
-        "\s*\)"
-        "\s*;"
-    )
-    return pattern.findall(text)
+    # raise any errors in reference order
+    collected = _collectedErrors.get()
+    for future in futures:
+        workerErrors = future.result()
+        if collected is not None:
+            collected.extend(workerErrors)
+
+
+# ---------------
+# Reference Files
+# ---------------
+
+def _buildIncludeGraph(referencedFiles, relativePath, getReferencedFiles=None):
+    """
+    Find all files referenced by the given list of
+    (inPath, outPath) tuples, directly or through other
+    referenced files. The returned value is a list of
+    (inPath, outPath) tuples in the order in which the
+    files are first referenced. Each file is listed once,
+    no matter how many files include it.
+
+    getReferencedFiles may be given to override how the
+    files referenced by a file are found. It will be
+    called with a path and must return a list of
+    (inPath, outPath) tuples or None if the file
+    doesn't exist.
+
+    A FeaPyFoFumError will be raised if a file
+    references itself through any chain of files.
+    """
+    if getReferencedFiles is None:
+        getReferencedFiles = lambda path: _readReferencedFiles(path, relativePath)
+    graph = []
+    visited = set()
+
+    def visit(referencedFiles, chain):
+        for inPath, outPath in referencedFiles:
+            if inPath in chain:
+                chain = chain[chain.index(inPath):] + [inPath]
+                chain = [os.path.relpath(path, relativePath) for path in chain]
+                raise FeaPyFoFumError("Circular file reference: %s" % " -> ".join(chain))
+            if inPath in visited:
+                continue
+            visited.add(inPath)
+            graph.append((inPath, outPath))
+            children = getReferencedFiles(inPath)
+            if children:
+                visit(children, chain + [inPath])
+
+    visit(referencedFiles, [])
+    return graph
+
+
+def _readReferencedFiles(path, relativePath):
+    """
+    Get the files referenced by the file at path.
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return _findReferencedFilesInLines(_iterLines(f), relativePath)
 
 
-def _stripComments(text):
+def _findReferencedFilesInLines(lines, relativePath):
     """
-    Strip comments from the text.
+    Get a list of (inPath, outPath) tuples for
+    the files referenced in the lines.
     """
-    stripped = [line.split("#")[0] for line in text.splitlines()]
-    return "\n".join(stripped)
+    referencedFiles = []
+    for kind, line in _iterScanFeatureLines(lines, relativePath, referencedFiles):
+        pass
+    return _uniqueReferencedFiles(referencedFiles)
+
+
+def _uniqueReferencedFiles(referencedFiles):
+    unique = []
+    found = set()
+    for inPath, outPath in referencedFiles:
+        if inPath not in found:
+            found.add(inPath)
+            unique.append((inPath, outPath))
+    return unique
+
+
+# --------
+# Scanning
+# --------
+
+_scanPattern = re.compile(
+    r'(?P<string>")'
+    r'|(?P<comment>#)'
+    r'|(?P<include>\binclude(?P<open>\s*\(\s*)(?P<path>[^)#"]+?)(?P<close>\s*\)\s*;))'
+)
+
+
+def _iterScanFeatureLines(lines, relativePath=None, referencedFiles=None, rewriteInclude=None):
+    """
+    Scan the lines in a single pass and yield (kind, line)
+    tuples. kind is "open" and "close" for the markers of
+    code blocks, "code" for the lines in code blocks and
+    None for all other lines.
+
+    Comments and strings, including strings that continue
+    on the next line, are skipped, so an include statement
+    or a # in them is left alone. If relativePath is given,
+    the include statements are redirected to the compiled
+    files and the (inPath, outPath) tuples for the files
+    are added to referencedFiles. Other changes can be
+    made by giving rewriteInclude instead, which will be
+    called with the match of each include statement in
+    _scanPattern and must return the statement to
+    replace it with.
+    """
+    if rewriteInclude is None and relativePath is not None:
+        rewriteInclude = lambda match: _redirectInclude(match, relativePath, referencedFiles)
+    inCodeBlock = False
+    inString = False
+    for line in lines:
+        if inCodeBlock or not inString:
+            stripped = line.strip()
+            if stripped == "# >>>":
+                inCodeBlock = True
+                yield "open", line
+                continue
+            if inCodeBlock:
+                if stripped == "# <<<":
+                    inCodeBlock = False
+                    yield "close", line
+                else:
+                    yield "code", line
+                continue
+        # lines with balanced quotes and no comment
+        # can't start or end a string.
+        if (
+            inString
+            or ('"' in line and ("#" in line or line.count('"') % 2))
+            or (rewriteInclude is not None and "include" in line)
+        ):
+            line, inString = _scanLine(line, inString, rewriteInclude)
+        yield None, line
+
+
+def _scanLine(line, inString, rewriteInclude):
+    """
+    Scan one line and return the line with the include
+    statements rewritten and whether a string continues
+    on the next line.
+    """
+    pieces = []
+    position = 0
+    copied = 0
+    if inString:
+        position = line.find('"')
+        if position == -1:
+            return line, True
+        position += 1
+        inString = False
+    while True:
+        match = _scanPattern.search(line, position)
+        if match is None or match.group("comment") is not None:
+            break
+        if match.group("string") is not None:
+            position = line.find('"', match.end())
+            if position == -1:
+                inString = True
+                break
+            position += 1
+        else:
+            position = match.end()
+            if rewriteInclude is not None:
+                pieces.append(line[copied:match.start()])
+                pieces.append(rewriteInclude(match))
+                copied = position
+    if not pieces:
+        return line, inString
+    pieces.append(line[copied:])
+    return "".join(pieces), inString
+
+
+def _redirectInclude(match, relativePath, referencedFiles):
+    """
+    Get the include statement matched by match pointing
+    to the compiled file and add the (inPath, outPath)
+    tuple for the file to referencedFiles. The name of
+    the compiled file is the name of the file with
+    _compiledFileSuffix before the extension.
+    """
+    # XXX the relative path stuff here is potentially problematic.
+    # XXX the .fea spec is vague about how paths should be resolved.
+    inPath = match.group("path")
+    outPath, ext = os.path.splitext(inPath)
+    outPath += _compiledFileSuffix.get()
+    outPath += ext
+    if referencedFiles is not None:
+        referencedFiles.append((
+            os.path.normpath(os.path.join(relativePath, inPath)),
+            os.path.normpath(os.path.join(relativePath, outPath))
+        ))
+    return "include" + match.group("open") + outPath + match.group("close")
 
 
 # --------------
 # .fea Execution
 # --------------
 
-def _executeFeatureText(text, font, namespace, verbose=False):
+def _makeNamespace(font, glyphIndex=None):
+    """
+    Make the namespace the code blocks in a file are
+    executed in. The glyph index is added here rather
+    than before every block, as the font and the writer
+    are, so that blocks may assign to glyphs themselves.
     """
-    Compile the text in a feature file by retaining
+    if glyphIndex is None:
+        glyphIndex = GlyphIndex(font)
+    return dict(glyphs=glyphIndex)
+
+
+def _iterExecuteFeatureLines(lines, font, namespace, verbose=False, blockCache=None, bytecodeCache=None, fileName=None, relativePath=None, referencedFiles=None):
+    """
+    Compile the lines in a feature file by retaining
     static lines and executing dynamic lines into
-    static lines.
+    static lines. The lines are yielded as they
+    are compiled. If relativePath is given, the include
+    statements are redirected while the lines are parsed.
+    """
+    items = _iterParseFeatureLines(lines, fileName, relativePath, referencedFiles)
+    return _iterExecuteParsedFeatures(
+        items,
+        font,
+        namespace,
+        verbose=verbose,
+        blockCache=blockCache,
+        bytecodeCache=bytecodeCache
+    )
+
+
+def _iterParseFeatureLines(lines, fileName=None, relativePath=None, referencedFiles=None):
     """
-    processed = []
+    Split the lines into static lines and code blocks.
+    Static lines are yielded as strings and code blocks
+    are yielded as _CodeBlock objects. If relativePath
+    is given, the include statements in the static lines
+    are redirected as in _iterScanFeatureLines.
+    """
+    if fileName is None:
+        fileName = "<features>"
     codeBlock = None
-    for lineNumber, line in enumerate(text.splitlines()):
-        stripeddLine = line.strip()
-        if stripeddLine == "# >>>":
+    scanned = _iterScanFeatureLines(lines, relativePath, referencedFiles)
+    for lineNumber, (kind, line) in enumerate(scanned):
+        if kind == "open":
             codeBlock = []
-        elif stripeddLine == "# <<<":
-            processed += _executeCodeBlock(codeBlock, font, namespace, verbose)
+            # the code starts on the next line
+            lineOffset = lineNumber + 1
+        elif kind == "close":
+            yield _CodeBlock(codeBlock, fileName, lineOffset)
             codeBlock = None
-        elif codeBlock is not None:
+        elif kind == "code":
             codeBlock.append(line)
         else:
-            processed.append(line)
-    return "\n".join(processed)
+            yield line
+
+
+class _CodeBlock(object):
+
+    """
+    A code block and the code extracted from it.
+    """
+
+    __slots__ = ("lines", "code", "whitespace", "constantIndent", "fileName", "lineOffset", "compiledCode")
+
+    def __init__(self, lines, fileName, lineOffset):
+        self.lines = lines
+        self.code, self.whitespace, self.constantIndent = _extractCodeFromCodeBlock(lines)
+        self.fileName = fileName
+        self.lineOffset = lineOffset
+        self.compiledCode = None
+
+    def __getstate__(self):
+        # code objects can't be pickled
+        return [getattr(self, attr) for attr in self.__slots__ if attr != "compiledCode"]
+
+    def __setstate__(self, state):
+        for attr, value in zip(self.__slots__, state):
+            setattr(self, attr, value)
+        self.compiledCode = None
+        self.compiledCode = None
+
+
+def _iterExecuteParsedFeatures(items, font, namespace, verbose=False, blockCache=None, bytecodeCache=None):
+    """
+    Execute the items produced by _iterParseFeatureLines
+    and yield the compiled lines.
+    """
+    cacheChain = None
+    if blockCache is not None:
+        cacheChain = blockCache.chain(font)
+    dependencies = _collectedDependencies.get()
+    # profiles and AST splices need the
+    # blocks to be executed in this process.
+    session = None
+    activeWorkerPool = _activeWorkerPool.get()
+    if activeWorkerPool is not None and _activeProfile.get() is None and _activeSplices.get() is None:
+        workerPool, fontData = activeWorkerPool
+        session = workerPool._session(fontData, bytecodeCache)
+    try:
+        for item in items:
+            if isinstance(item, _CodeBlock):
+                compiledLines = _executeCodeBlock(
+                    item,
+                    font,
+                    namespace,
+                    verbose,
+                    cacheChain,
+                    bytecodeCache=bytecodeCache,
+                    dependencies=dependencies,
+                    session=session
+                )
+                for compiledLine in compiledLines:
+                    yield compiledLine
+            else:
+                yield item
+    finally:
+        if session is not None:
+            session.close()
 
 
-def _executeCodeBlock(codeBlock, font, namespace, verbose):
+def _executeCodeBlock(codeBlock, font, namespace, verbose, cacheChain=None, bytecodeCache=None, dependencies=None, session=None):
     """
     Process the code block and return the resulting lines.
+    If dependencies is given, the font data read by the
+    block is added to it. If a worker session is given,
+    the block is executed in its worker process. Output
+    that was too large to keep in memory is read from
+    its temporary file as the lines are iterated.
     """
-    # extract the code
-    code, whitespace, constantIndent = _extractCodeFromCodeBlock(codeBlock)
+    constantIndent = codeBlock.constantIndent
+    # the block is tracked when its output is cached
+    # or when the dependencies are being collected.
+    blockDependencies = dependencies
+    # look for cached output
+    output = None
+    errors = ""
+    if cacheChain is not None:
+        output = cacheChain.get(codeBlock.code, codeBlock.whitespace, constantIndent)
+        blockDependencies = cacheChain.blockDependencies
+        if output is not None:
+            cacheChain.addPending(codeBlock)
     # execute
-    writer = FeaSyntaxWriter(whitespace=whitespace)
-    namespace["font"] = font
-    namespace["writer"] = writer
-    output, errors = _executeCodeInNamespace(code, namespace)
+    if output is None:
+        if cacheChain is not None:
+            # blocks that were skipped may have defined
+            # things in the namespace that this one needs.
+            for pendingCodeBlock in cacheChain.popPending():
+                _executeCodeWithFont(pendingCodeBlock, font, namespace, bytecodeCache=bytecodeCache, dependencies=blockDependencies, session=session)
+        output, errors = _executeCodeWithFont(codeBlock, font, namespace, bytecodeCache=bytecodeCache, dependencies=blockDependencies, session=session, spillOutput=True)
+        # output that was too large to keep in memory
+        # is read back from its file and not cached.
+        if cacheChain is not None and not errors and not isinstance(output, _SpilledOutput):
+            cacheChain.set(output)
+    if dependencies is not None and blockDependencies is not dependencies:
+        dependencies.update(blockDependencies)
+    if errors:
+        collected = _collectedErrors.get()
+        if collected is not None:
+            collected.append((codeBlock.fileName, codeBlock.lineOffset, errors))
     # compile the text
     lines = []
     if verbose or errors:
         lines.append(constantIndent + "# >>>")
-        for line in codeBlock:
+        for line in codeBlock.lines:
             lines.append(line)
         lines.append(constantIndent + "# <<<")
         lines.append("")
@@ -223,11 +1068,63 @@ def _executeCodeBlock(codeBlock, font, namespace, verbose):
             for line in errors.splitlines():
                 lines.append(constantIndent + "# " + line)
             lines.append("")
+    if isinstance(output, _SpilledOutput):
+        return itertools.chain(lines, _iterIndentedLines(output.iterLines(), constantIndent))
     for line in output.splitlines():
         lines.append(constantIndent + line)
     return lines
 
 
+def _iterIndentedLines(lines, indent):
+    for line in lines:
+        yield indent + line
+
+
+def _executeCodeWithFont(codeBlock, font, namespace, bytecodeCache=None, dependencies=None, session=None, spillOutput=False):
+    """
+    Insert the font and a new writer into the
+    namespace and execute the code block. If
+    dependencies is given, the font is wrapped in
+    a TrackingFont and the data the block reads is
+    recorded in it. If a worker session is given,
+    this happens in its worker process instead.
+    spillOutput is passed to _executeCodeInNamespace
+    unless the block is profiled.
+    """
+    if session is not None:
+        output, errors, blockDependencies = session.execute(codeBlock, dependencies is not None)
+        if dependencies is not None:
+            dependencies.update(blockDependencies)
+        return output, errors
+    writer = FeaSyntaxWriter(whitespace=codeBlock.whitespace)
+    writer._splices = _activeSplices.get()
+    if dependencies is not None:
+        font = TrackingFont(font)
+    namespace["font"] = font
+    namespace["writer"] = writer
+    profile = _activeProfile.get()
+    blockProfile = None
+    if profile is not None:
+        blockProfile = profile._beginBlock(codeBlock)
+    recording = contextlib.nullcontext()
+    if dependencies is not None:
+        recording = recordingDependencies(dependencies)
+    with recording:
+        output, errors = _executeCodeInNamespace(
+            codeBlock.code,
+            namespace,
+            bytecodeCache=bytecodeCache,
+            fileName=codeBlock.fileName,
+            lineOffset=codeBlock.lineOffset,
+            compiledCode=codeBlock.compiledCode,
+            blockProfile=blockProfile,
+            spillOutput=spillOutput and blockProfile is None
+        )
+    if profile is not None:
+        profile._endBlock(blockProfile, output, errors, writer)
+    return output, errors
+
+
 def _extractCodeFromCodeBlock(codeBlock):
     """
     Extract the executable lines, whitespace type
@@ -237,6 +1134,8 @@ def _extractCodeFromCodeBlock(codeBlock):
     lines = []
     for line in codeBlock:
         if not line:
+            # keep the line so that line numbers are retained
+            lines.append(line)
             continue
         stripped = line.strip()
         if stripped != "#":
@@ -256,39 +1155,228 @@ def _extractCodeFromCodeBlock(codeBlock):
     return lines, whitespace, constantIndent
 
 
-def _executeCodeInNamespace(code, namespace):
+_defaultBytecodeCache = BytecodeCache()
+
+
+# the CompileProfile of the compile running in this context
+_activeProfile = contextvars.ContextVar("feaPyFoFumProfile", default=None)
+# the list errors are collected in for the compile running in this context
+_collectedErrors = contextvars.ContextVar("feaPyFoFumErrors", default=None)
+# the set the dependencies of the blocks are collected in for the compile running in this context
+_collectedDependencies = contextvars.ContextVar("feaPyFoFumCollectedDependencies", default=None)
+# the ASTSplices the writers write to for the compile running in this context
+_activeSplices = contextvars.ContextVar("feaPyFoFumSplices", default=None)
+# the (WorkerPool, font data) the blocks are executed with for the compile running in this context
+_activeWorkerPool = contextvars.ContextVar("feaPyFoFumWorkerPool", default=None)
+# what is added to the names of compiled referenced files for the compile running in this context
+_compiledFileSuffix = contextvars.ContextVar("feaPyFoFumCompiledFileSuffix", default="-c")
+
+
+def _executeCodeInNamespace(code, namespace, bytecodeCache=None, fileName="", lineOffset=0, compiledCode=None, blockProfile=None, spillOutput=False):
     """
     Execute the code in the given namespace.
+    The code is compiled as if it starts on the line
+    after lineOffset in the file fileName, unless
+    the compiled code is given as compiledCode.
+    If blockProfile is given, the compile and
+    execution times will be stored in it. If
+    spillOutput is True, output that is too large
+    to keep in memory is returned as a _SpilledOutput
+    instead of a string.
     """
+    if bytecodeCache is None:
+        bytecodeCache = _defaultBytecodeCache
+    profiler = None
+    if blockProfile is not None:
+        profiler = blockProfile._profiler
     # This was adapted from DrawBot's scriptTools.py.
-    saveStdout = sys.stdout
-    saveStderr = sys.stderr
-    tempStdout = StringIO()
+    tempStdout = _OutputSpool()
     tempStderr = StringIO()
-    try:
-        sys.stdout = tempStdout
-        sys.stderr = tempStderr
+    with _capturedOutput(tempStdout, tempStderr):
+        start = time.perf_counter()
         try:
-            code = compile(code, "", "exec", 0)
+            if compiledCode is not None:
+                code = compiledCode
+            else:
+                code = bytecodeCache.compile(code, fileName, lineOffset)
         except Exception:
-            traceback.print_exc(0)
+            traceback.print_exc(0, file=tempStderr)
+            if blockProfile is not None:
+                blockProfile.compileTime = time.perf_counter() - start
         else:
+            compiled = time.perf_counter()
+            if profiler is not None:
+                profiler.enable()
             try:
                 exec(code, namespace)
             except Exception:
                 etype, value, tb = sys.exc_info()
                 if tb.tb_next is not None:
                     tb = tb.tb_next
-                traceback.print_exception(etype, value, tb)
+                traceback.print_exception(etype, value, tb, file=tempStderr)
                 etype = value = tb = None
-    finally:
-        sys.stdout = saveStdout
-        sys.stderr = saveStderr
-    output = tempStdout.getvalue()
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+            if blockProfile is not None:
+                blockProfile.compileTime = compiled - start
+                blockProfile.executeTime = time.perf_counter() - compiled
+    if spillOutput and tempStdout.file is not None:
+        output = _SpilledOutput(tempStdout.file)
+    else:
+        output = tempStdout.getvalue()
+        if tempStdout.file is not None:
+            tempStdout.file.close()
     errors = tempStderr.getvalue()
     return output, errors
 
 
+# ----------------
+# Output Capturing
+# ----------------
+
+# sys.stdout and sys.stderr are shared by all threads,
+# so they are never pointed at the capturing streams.
+# Instead, while anything is being executed, they are
+# replaced with proxies that write to the capturing
+# streams of the current context, falling back to
+# the original streams everywhere else.
+
+_capturedStdout = contextvars.ContextVar("feaPyFoFumStdout", default=None)
+_capturedStderr = contextvars.ContextVar("feaPyFoFumStderr", default=None)
+_captureLock = threading.Lock()
+_captureCount = 0
+
+
+class _ContextLocalStream(object):
+
+    def __init__(self, original, variable):
+        self._original = original
+        self._variable = variable
+
+    def _stream(self):
+        stream = self._variable.get()
+        if stream is None:
+            stream = self._original
+        return stream
+
+    def write(self, text):
+        return self._stream().write(text)
+
+    def writelines(self, lines):
+        return self._stream().writelines(lines)
+
+    def flush(self):
+        return self._stream().flush()
+
+    def __getattr__(self, attr):
+        return getattr(self._stream(), attr)
+
+
+def _installStreamProxies():
+    global _captureCount
+    with _captureLock:
+        # something else may have replaced the streams
+        # since they were installed, so always check.
+        if not isinstance(sys.stdout, _ContextLocalStream):
+            sys.stdout = _ContextLocalStream(sys.stdout, _capturedStdout)
+        if not isinstance(sys.stderr, _ContextLocalStream):
+            sys.stderr = _ContextLocalStream(sys.stderr, _capturedStderr)
+        _captureCount += 1
+
+
+def _uninstallStreamProxies():
+    global _captureCount
+    with _captureLock:
+        _captureCount -= 1
+        if _captureCount:
+            return
+        if isinstance(sys.stdout, _ContextLocalStream):
+            sys.stdout = sys.stdout._original
+        if isinstance(sys.stderr, _ContextLocalStream):
+            sys.stderr = sys.stderr._original
+
+
+@contextlib.contextmanager
+def _capturedOutput(stdout, stderr):
+    """
+    Capture everything written to sys.stdout and
+    sys.stderr in the current thread or context.
+    """
+    _installStreamProxies()
+    stdoutToken = _capturedStdout.set(stdout)
+    stderrToken = _capturedStderr.set(stderr)
+    try:
+        yield
+    finally:
+        _capturedStdout.reset(stdoutToken)
+        _capturedStderr.reset(stderrToken)
+        _uninstallStreamProxies()
+
+
+class _OutputSpool(object):
+
+    """
+    A capturing stream that keeps the text in memory
+    until it is longer than maxMemorySize characters
+    and then moves it to a temporary file. Blocks that
+    write very large output, for example with a
+    streaming writer, then don't need memory for all
+    of it.
+    """
+
+    maxMemorySize = 1024 * 1024
+
+    def __init__(self):
+        self._buffer = StringIO()
+        self._size = 0
+        self.file = None
+
+    def write(self, text):
+        if self.file is None:
+            self._size += len(text)
+            if self._size <= self.maxMemorySize:
+                return self._buffer.write(text)
+            self.file = tempfile.TemporaryFile("w+", encoding="utf-8")
+            self.file.write(self._buffer.getvalue())
+            self._buffer = None
+        return self.file.write(text)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        if self.file is None:
+            return self._buffer.getvalue()
+        self.file.seek(0)
+        return self.file.read()
+
+
+class _SpilledOutput(object):
+
+    """
+    The output of a code block that was moved to a
+    temporary file. The file is closed, and removed,
+    once the lines have been read.
+    """
+
+    def __init__(self, f):
+        self._file = f
+
+    def iterLines(self):
+        f = self._file
+        try:
+            f.seek(0)
+            for line in _iterLines(f):
+                yield line
+        finally:
+            f.close()
+
+
 # -----------
 # .fea Writer
 # -----------
@@ -297,83 +1385,261 @@ needSpaceBefore = "feature lookup script language".split(" ")
 needSpaceAfter = "feature lookup script language".split(" ")
 
 
+# Writer content is stored as compact records. Each
+# record type is a tuple with named fields in the
+# order of the arguments of the writer method that
+# formats it: FeaSyntaxWriter._<identifier>.
+
+def _recordType(identifier, fields, contextual=False):
+    base = namedtuple("_%s%sRecord" % (identifier[0].upper(), identifier[1:]), fields)
+    attributes = dict(
+        __slots__=(),
+        identifier=identifier,
+        methodName="_" + identifier,
+        contextual=contextual
+    )
+    return type(base.__name__, (base,), attributes)
+
+
+_BlankLineRecord = _recordType("blankLine", "")
+_CommentRecord = _recordType("comment", "comment")
+_FileReferenceRecord = _recordType("fileReference", "path")
+_LanguageSystemRecord = _recordType("languageSystem", "script language")
+_ScriptRecord = _recordType("script", "name")
+_LanguageRecord = _recordType("language", "name includeDefault")
+_ClassDefinitionRecord = _recordType("classDefinition", "name members")
+_MarkClassDefinitionRecord = _recordType("markClassDefinition", "members anchor name")
+_FeatureRecord = _recordType("feature", "name writer")
+_LookupRecord = _recordType("lookup", "name writer")
+_LookupFlagRecord = _recordType("lookupflag", "flags")
+_FeatureReferenceRecord = _recordType("featureReference", "name")
+_LookupReferenceRecord = _recordType("lookupReference", "name")
+_SubstitutionRecord = _recordType("substitution", "target substitution backtrack lookahead choice", contextual=True)
+_PositionSingleRecord = _recordType("positionSingle", "target value backtrack lookahead", contextual=True)
+_PositionPairRecord = _recordType("positionPair", "target value backtrack lookahead enumerate", contextual=True)
+_PositionMarkToBaseRecord = _recordType("positionMarkToBase", "target anchor markClass")
+_PositionMarkToMarkRecord = _recordType("positionMarkToMark", "target anchor markClass")
+_PositionMarkToLigatureRecord = _recordType("positionMarkToLigature", "target anchor_data")
+_SubtableRecord = _recordType("subtable", "")
+_StylisticSetNamesRecord = _recordType("stylisticSetNames", "names")
+
+
+# garbage collection is paused for the whole interpreter,
+# so pauses in several threads are counted and it is
+# enabled again when the last one ends, if it was
+# enabled when the first one began.
+
+_pauseLock = threading.Lock()
+_pauseCount = 0
+_pausedEnabled = False
+
+
+@contextlib.contextmanager
+def _pausedGarbageCollection():
+    """
+    Records are containers, so storing a large number
+    of them triggers garbage collections that traverse
+    everything stored so far. The bulk methods create
+    no reference cycles, so collecting can wait.
+    """
+    global _pauseCount, _pausedEnabled
+    with _pauseLock:
+        if not _pauseCount:
+            _pausedEnabled = gc.isenabled()
+            gc.disable()
+        _pauseCount += 1
+    try:
+        yield
+    finally:
+        with _pauseLock:
+            _pauseCount -= 1
+            if not _pauseCount and _pausedEnabled:
+                gc.enable()
+
+
+class _ContentStream(object):
+
+    """
+    The content of a streaming writer. Records added
+    to it are formatted by the writer and written to
+    the lines right away instead of being stored. The
+    streams of the nested writers share the lines and
+    the rule counts with the stream of their parent.
+    """
+
+    def __init__(self, writer, lines, ruleCounts):
+        self.writer = writer
+        self.lines = lines
+        self.ruleCounts = ruleCounts
+        # (record, line count after the opening line)
+        # of the feature or lookup being written
+        self.openBlock = None
+        self.started = False
+        self.finished = False
+
+    def append(self, record):
+        self.writer._streamRecords((record,))
+
+    def extend(self, records):
+        self.writer._streamRecords(records)
+
+
+class _LineStream(object):
+
+    """
+    Lines written to a file object, separated by
+    line breaks. The break after the last line is
+    left to whoever ends the output.
+    """
+
+    def __init__(self, f):
+        self.file = f
+        self.count = 0
+
+    def write(self, lines):
+        if not lines:
+            return
+        text = "\n".join(lines)
+        if self.count:
+            text = "\n" + text
+        self.file.write(text)
+        self.count += len(lines)
+
+
 class FeaSyntaxWriter(object):
 
-    def __init__(self, whitespace="\t"):
+    """
+    If autoSubtables is True, subtable breaks will be
+    written between class pair positioning rules when
+    the estimated size of the current subtable would
+    exceed maxSubtableSize bytes. A break is only written
+    before the first pair of a left class, so the pairs
+    should be grouped by left class, as kerningFromFont
+    does, and a subtable may exceed the size if a single
+    left class needs more. Features and lookups take
+    these settings from the writer that creates them.
+    """
+
+    def __init__(self, whitespace="\t", autoSubtables=False, maxSubtableSize=0xFFFF):
+        self.autoSubtables = autoSubtables
+        self.maxSubtableSize = maxSubtableSize
         self._featureName = None
+        self._lookupName = None
         self._whitespace = whitespace
         self._indent = 0
         self._content = []
         self._text = []
-        self._identifierStack = []
+        # only the last identifier is needed to place the
+        # breaks. keeping all of them would make the memory
+        # of a streaming writer grow with every rule.
+        self._identifierStack = deque(maxlen=1)
         self._inScript = False
         self._inLanguage = False
+        self._contextualMarkers = False
+        # class definitions are shared with the
+        # nested writers for the size estimates
+        self._classes = {}
+        self._subtableEstimates = []
+        self._subtableEstimate = None
+        self._subtableIndex = 0
+        self._splices = None
 
     # -----
     # Write
     # -----
 
     def write(self):
+        if isinstance(self._content, _ContentStream):
+            # everything else was written already
+            self._finishStream()
+            return ""
+        if self._splices is not None:
+            # AST mode, see compileFeaturesToAST
+            return self._splices.add(self)
+        out = []
+        self._subtableEstimates = []
+        self._render(out)
+        return "\n".join(out)
+
+    def subtableEstimates(self):
+        """
+        Get the estimated sizes of the class pair positioning
+        subtables written during the last write call. Each
+        estimate is a dict with these keys:
+
+        - lookup: the name of the lookup or feature
+        - subtable: the index of the subtable in the lookup
+        - pairs: the number of class pairs
+        - leftClasses: the number of left classes
+        - rightClasses: the number of right classes
+        - size: the estimated size in bytes
+        - automatic: True if the subtable was started
+          by an automatic subtable break
+        """
+        return [estimate.asDict() for estimate in self._subtableEstimates]
+
+    def _render(self, out):
+        """
+        Append the lines for the content to out.
+        Nested feature and lookup writers append
+        to the same list, so every line is built
+        once no matter how deep the nesting is.
+        """
+        self._beginRender(self._content)
+        # compile the text
+        for record in self._content:
+            method = getattr(self, record.methodName)
+            method(out, *record)
+        self._closeSubtableEstimate()
+        self._writeFinalBreak(out)
+
+    def _beginRender(self, content):
         # determine if contextual markers
         # need to be applied to all rules
         needContextualMarkers = False
-        for item in self._content:
-            if "backtrack" in item:
-                if item["backtrack"] is not None or item["lookahead"] is not None:
+        for record in content:
+            if record.contextual:
+                if record.backtrack is not None or record.lookahead is not None:
                     needContextualMarkers = True
                     break
-        if needContextualMarkers:
-            for item in self._content:
-                if "backtrack" in item:
-                    if item["backtrack"] is None:
-                        item["backtrack"] = []
-                    if item["lookahead"] is None:
-                        item["lookahead"] = []
-        # compile the text
-        text = []
-        for item in self._content:
-            kwargs = dict(item)
-            identifier = kwargs.pop("identifier")
-            methodName = "_" + identifier
-            method = getattr(self, methodName)
-            text += method(**kwargs)
-        text += self._handleFinalBreak()
-        return "\n".join(text)
+        self._contextualMarkers = needContextualMarkers
+        self._subtableEstimate = None
+        self._subtableIndex = 0
+
+    def _applyContextualMarkers(self, backtrack, lookahead):
+        # if any rule needs contextual markers,
+        # all rules need contextual markers.
+        if self._contextualMarkers:
+            if backtrack is None:
+                backtrack = []
+            if lookahead is None:
+                lookahead = []
+        return backtrack, lookahead
 
     # white space
 
-    def _handleBreakBefore(self, identifier):
-        text = []
+    def _writeBreakBefore(self, out, identifier, indent=""):
         # always need break
         if identifier in needSpaceBefore:
-            text.append("")
+            out.append(indent)
             # need two empty lines
             if self._indent == 0 and identifier in ("feature", "lookup"):
-                text.append("")
+                out.append(indent)
         # sequence break
         elif self._identifierStack and identifier != self._identifierStack[-1]:
-            text.append("")
-        return text
+            out.append(indent)
 
-    def _handleFinalBreak(self):
-        text = []
+    def _writeFinalBreak(self, out):
         if not self._identifierStack:
             pass
         elif self._identifierStack[-1] in needSpaceAfter:
-            text = [""]
-        return text
+            out.append("")
 
     def _indentLevel(self):
         return self._inScript + self._inLanguage + self._indent
 
-    def _indentText(self, text):
-        indentLevel = self._indentLevel()
-        indent = self._whitespace * indentLevel
-        new = []
-        for i in text:
-            new.append(indent + i)
-        del text[:]
-        text += new
+    def _indentString(self):
+        return self._whitespace * self._indentLevel()
 
     # flattening
 
@@ -386,6 +1652,200 @@ class FeaSyntaxWriter(object):
         members = [self._flattenClass(i) for i in members]
         return " ".join(members)
 
+    # bulk
+
+    def _bulkItems(self, keys, values):
+        """
+        Get (key, value) pairs for the bulk methods.
+        keys may be a mapping, an iterable of pairs
+        or, if values is given, a sequence that
+        parallels values.
+        """
+        if values is not None:
+            if hasattr(keys, "__len__") and hasattr(values, "__len__") and len(keys) != len(values):
+                raise FeaPyFoFumError("The sequences must have the same length: %d, %d" % (len(keys), len(values)))
+            return zip(keys, values)
+        if hasattr(keys, "items"):
+            return keys.items()
+        return keys
+
+    # ---
+    # AST
+    # ---
+
+    def writeAST(self, parser=None):
+        """
+        Get the content as a list of fontTools.feaLib.ast
+        statements, the statements that parsing the text
+        returned by write would give. Classes, mark classes
+        and lookups are resolved in and defined in the
+        symbol tables of the given fontTools.feaLib
+        Parser, as if the text was parsed by it at its
+        current position, or in new ones if no parser
+        is given.
+        """
+        from .feaLibAST import ASTContext
+
+        return self._writeAST(ASTContext(parser))
+
+    def _writeAST(self, context, content=None):
+        statements = []
+        self._subtableEstimates = []
+        self._renderAST(statements, context, content)
+        return statements
+
+    def _renderAST(self, statements, context, content=None):
+        """
+        Append the statements for the content to
+        statements. Records that can't be converted
+        directly are formatted and parsed instead.
+        """
+        if content is None:
+            content = self._content
+        self._beginRender(content)
+        contextualMarkers = self._contextualMarkers
+        for record in content:
+            try:
+                method = getattr(self, record.methodName + "AST", None)
+                if method is not None:
+                    method(statements, context, *record)
+                    continue
+                if contextualMarkers and record.contextual:
+                    backtrack, lookahead = self._applyContextualMarkers(record.backtrack, record.lookahead)
+                    record = record._replace(backtrack=backtrack, lookahead=lookahead)
+                statement = context.convert(record)
+                if statement is not None:
+                    statements.append(statement)
+            except context.Fallback:
+                out = []
+                getattr(self, record.methodName)(out, *record)
+                statements.extend(context.parse("\n".join(out)))
+        self._closeSubtableEstimate()
+
+    def _featureAST(self, statements, context, name, writer):
+        block = context.featureBlock(name)
+        with context.block(name):
+            self._renderNestedAST(block.statements, context, writer)
+        statements.append(block)
+
+    def _lookupAST(self, statements, context, name, writer):
+        block = context.lookupBlock(name)
+        with context.block():
+            self._renderNestedAST(block.statements, context, writer)
+        statements.append(block)
+        context.defineLookup(name, block)
+
+    def _renderNestedAST(self, statements, context, writer):
+        writer._subtableEstimates = self._subtableEstimates
+        writer._renderAST(statements, context)
+
+    def _positionPairAST(self, statements, context, target, value, backtrack=None, lookahead=None, enumerate=False):
+        if backtrack is not None or lookahead is not None or self._contextualMarkers:
+            raise context.Fallback
+        statement = context.positionPair(target, value, enumerate)
+        # the same pairs are estimated as in _positionPair
+        if not enumerate and value is not None and self._estimateClassPair(target, value):
+            statements.append(context.subtable())
+        statements.append(statement)
+
+    def _subtableAST(self, statements, context):
+        self._closeSubtableEstimate()
+        statements.append(context.subtable())
+
+    # ---------
+    # Streaming
+    # ---------
+
+    def stream(self, out=None, contextualMarkers=False):
+        """
+        Write the content to out, a file object, as it is
+        added instead of storing it until write is called,
+        so that the memory used by the writer stays the same
+        no matter how many rules are added. If out is None,
+        sys.stdout is used, which is the output of the code
+        block the writer was given to. This must be called
+        before anything is added. Features and lookups
+        created afterwards write to the same file.
+
+        The rules can't be looked at before they are written,
+        so contextualMarkers declares if all substitution and
+        positioning rules are written with contextual markers.
+        It must be True if any of the rules has a backtrack
+        or a lookahead. Features and lookups take it from the
+        writer that creates them. Calling stream on one of
+        them, before anything is added to it, with only
+        contextualMarkers changes it for that writer.
+
+        write finishes the output and returns an empty
+        string, so printing it ends the output with a line
+        break, as printing the text of a writer would.
+        """
+        content = self._content
+        if isinstance(content, _ContentStream):
+            if out is not None or content.started:
+                raise FeaPyFoFumError("The writer is already streaming.")
+            self._contextualMarkers = contextualMarkers
+            return
+        if content:
+            raise FeaPyFoFumError("The writer must be streaming before anything is added to it.")
+        if out is None:
+            out = sys.stdout
+        self._content = _ContentStream(self, _LineStream(out), {})
+        self._contextualMarkers = contextualMarkers
+        self._subtableEstimates = []
+        self._subtableEstimate = None
+        self._subtableIndex = 0
+
+    def _streamRecords(self, records):
+        content = self._content
+        if content.finished:
+            raise FeaPyFoFumError("The writer was already written.")
+        content.started = True
+        self._closeStreamedBlock()
+        ruleCounts = content.ruleCounts
+        out = []
+        try:
+            for record in records:
+                if record.contextual and not self._contextualMarkers:
+                    if record.backtrack is not None or record.lookahead is not None:
+                        raise FeaPyFoFumError("Rules with a backtrack or a lookahead need a writer streaming with contextualMarkers=True.")
+                identifier = record.identifier
+                ruleCounts[identifier] = ruleCounts.get(identifier, 0) + 1
+                if identifier in ("feature", "lookup"):
+                    # the content of the nested writer
+                    # follows until something else is added
+                    self._openBlock(out, identifier, record.name)
+                    content.openBlock = (record, content.lines.count + len(out))
+                else:
+                    getattr(self, record.methodName)(out, *record)
+        finally:
+            content.lines.write(out)
+
+    def _closeStreamedBlock(self):
+        content = self._content
+        if content.openBlock is None:
+            return
+        record, start = content.openBlock
+        content.openBlock = None
+        record.writer._finishStream()
+        out = []
+        # an empty writer still takes up a line
+        if content.lines.count == start:
+            out.append("")
+        self._closeBlock(out, record.identifier, record.name)
+        content.lines.write(out)
+
+    def _finishStream(self):
+        content = self._content
+        if content.finished:
+            return
+        self._closeStreamedBlock()
+        self._closeSubtableEstimate()
+        out = []
+        self._writeFinalBreak(out)
+        content.lines.write(out)
+        content.finished = True
+
     # ---------
     # Appending
     # ---------
@@ -393,34 +1853,25 @@ class FeaSyntaxWriter(object):
     # blank line
 
     def blankLine(self):
-        d = dict(
-            identifier="blankLine"
-        )
-        self._content.append(d)
+        self._content.append(_BlankLineRecord())
 
-    def _blankLine(self, comment):
-        text = self._handleBreakBefore("blankLine")
-        text.append("")
+    def _blankLine(self, out):
+        self._writeBreakBefore(out, "blankLine")
+        out.append("")
         self._identifierStack.append("blankLine")
-        return text
 
     # comment
 
     def comment(self, comment):
         if not comment.startswith("# "):
             comment = "# " + comment
-        d = dict(
-            identifier="comment",
-            comment=comment
-        )
-        self._content.append(d)
+        self._content.append(_CommentRecord(comment))
 
-    def _comment(self, comment):
-        text = self._handleBreakBefore("comment")
-        text.append(comment)
-        self._indentText(text)
+    def _comment(self, out, comment):
+        indent = self._indentString()
+        self._writeBreakBefore(out, "comment", indent)
+        out.append(indent + comment)
         self._identifierStack.append("comment")
-        return text
 
     # file reference
 
@@ -430,18 +1881,13 @@ class FeaSyntaxWriter(object):
         )
 
     def fileReference(self, path):
-        d = dict(
-            identifier="fileReference",
-            path=path
-        )
-        self._content.append(d)
+        self._content.append(_FileReferenceRecord(path))
 
-    def _fileReference(self, path):
-        text = self._handleBreakBefore("fileReference")
-        text.append(self.formatFileReference(path))
-        self._indentText(text)
+    def _fileReference(self, out, path):
+        indent = self._indentString()
+        self._writeBreakBefore(out, "fileReference", indent)
+        out.append(indent + self.formatFileReference(path))
         self._identifierStack.append("fileReference")
-        return text
 
     # language system
 
@@ -452,20 +1898,14 @@ class FeaSyntaxWriter(object):
         )
 
     def languageSystem(self, script, language):
-        d = dict(
-            identifier="languageSystem",
-            script=script,
-            language=language
-        )
-        self._content.append(d)
+        self._content.append(_LanguageSystemRecord(script, language))
 
-    def _languageSystem(self, script, language):
+    def _languageSystem(self, out, script, language):
         language = language.strip()
-        text = self._handleBreakBefore("languageSystem")
-        text.append(self.formatLanguageSystem(script, language))
-        self._indentText(text)
+        indent = self._indentString()
+        self._writeBreakBefore(out, "languageSystem", indent)
+        out.append(indent + self.formatLanguageSystem(script, language))
         self._identifierStack.append("languageSystem")
-        return text
 
     # script
 
@@ -475,28 +1915,23 @@ class FeaSyntaxWriter(object):
         )
 
     def script(self, name):
-        d = dict(
-            identifier="script",
-            name=name
-        )
-        self._content.append(d)
+        self._content.append(_ScriptRecord(name))
         # shift the indents
         self._inScript = True
         self._inLanguage = False
 
-    def _script(self, name):
+    def _script(self, out, name):
         # shift the indents back
         self._inScript = False
         self._inLanguage = False
         # write
-        text = self._handleBreakBefore("script")
-        text.append(self.formatScript(name))
-        self._indentText(text)
+        indent = self._indentString()
+        self._writeBreakBefore(out, "script", indent)
+        out.append(indent + self.formatScript(name))
         # shift the following lines
         self._inScript = True
         # done
         self._identifierStack.append("script")
-        return text
 
     # language
 
@@ -506,30 +1941,24 @@ class FeaSyntaxWriter(object):
         )
 
     def language(self, name, includeDefault=True):
-        d = dict(
-            identifier="language",
-            name=name,
-            includeDefault=includeDefault
-        )
-        self._content.append(d)
+        self._content.append(_LanguageRecord(name, includeDefault))
         # shift the indents
         self._inLanguage = True
 
-    def _language(self, name, includeDefault=True):
+    def _language(self, out, name, includeDefault=True):
         # shift the indent back
         self._inLanguage = False
         # write
         if name is None:
             name = "dflt"
         name = name.strip()
-        text = self._handleBreakBefore("language")
-        text.append(self.formatLanguage(name))
-        self._indentText(text)
+        indent = self._indentString()
+        self._writeBreakBefore(out, "language", indent)
+        out.append(indent + self.formatLanguage(name))
         # shift the following lines
         self._inLanguage = True
         # done
         self._identifierStack.append("language")
-        return text
 
     # class definitiion
 
@@ -540,19 +1969,27 @@ class FeaSyntaxWriter(object):
         )
 
     def classDefinition(self, name, members):
-        d = dict(
-            identifier="classDefinition",
-            name=name,
-            members=members
-        )
-        self._content.append(d)
+        self._content.append(_ClassDefinitionRecord(name, members))
+        self._classes[name] = members
 
-    def _classDefinition(self, name, members):
-        text = self._handleBreakBefore("classDefinition")
-        text.append(self.formatClassDefinition(name, members))
-        self._indentText(text)
+    def classDefinitions(self, names, members=None):
+        """
+        Add many class definitions at once. names may be
+        a mapping of names to members, an iterable of
+        (name, members) pairs or a sequence of names that
+        parallels the members sequence.
+        """
+        new = _ClassDefinitionRecord
+        with _pausedGarbageCollection():
+            records = [new(name, m) for name, m in self._bulkItems(names, members)]
+            self._content.extend(records)
+            self._classes.update(records)
+
+    def _classDefinition(self, out, name, members):
+        indent = self._indentString()
+        self._writeBreakBefore(out, "classDefinition", indent)
+        out.append(indent + self.formatClassDefinition(name, members))
         self._identifierStack.append("classDefinition")
-        return text
 
     # markClass definition
 
@@ -564,20 +2001,13 @@ class FeaSyntaxWriter(object):
         )
 
     def markClassDefinition(self, members, anchor, name):
-        d = dict(
-            identifier="markClassDefinition",
-            members=members,
-            anchor=anchor,
-            name=name,
-        )
-        self._content.append(d)
+        self._content.append(_MarkClassDefinitionRecord(members, anchor, name))
 
-    def _markClassDefinition(self, members, anchor, name):
-        text = self._handleBreakBefore("markClassDefinition")
-        text.append(self.formatMarkClassDefinition(members, anchor, name))
-        self._indentText(text)
+    def _markClassDefinition(self, out, members, anchor, name):
+        indent = self._indentString()
+        self._writeBreakBefore(out, "markClassDefinition", indent)
+        out.append(indent + self.formatMarkClassDefinition(members, anchor, name))
         self._identifierStack.append("markClassDefinition")
-        return text
 
     def _formatAnchorDefinition(self, anchor):
         return "<anchor {x} {y}>".format(
@@ -588,54 +2018,60 @@ class FeaSyntaxWriter(object):
     # feature
 
     def feature(self, name):
-        writer = self.__class__(whitespace=self._whitespace)
+        writer = self._nestedWriter()
         writer._featureName = name
         writer._indent = self._indent + 1
-        d = dict(
-            identifier="feature",
-            name=name,
-            writer=writer
+        self._content.append(_FeatureRecord(name, writer))
+        return writer
+
+    def _feature(self, out, name, writer):
+        self._openBlock(out, "feature", name)
+        self._writeNested(out, writer)
+        self._closeBlock(out, "feature", name)
+
+    def _nestedWriter(self):
+        writer = self.__class__(
+            whitespace=self._whitespace,
+            autoSubtables=self.autoSubtables,
+            maxSubtableSize=self.maxSubtableSize
         )
-        self._content.append(d)
+        writer._classes = self._classes
+        content = self._content
+        if isinstance(content, _ContentStream):
+            writer._content = _ContentStream(writer, content.lines, content.ruleCounts)
+            writer._contextualMarkers = self._contextualMarkers
+            writer._subtableEstimates = self._subtableEstimates
         return writer
 
-    def _feature(self, name, writer):
-        text = self._handleBreakBefore("feature")
-        s = ["feature %s {" % name]
-        self._indentText(s)
-        text.extend(s)
-        text.append(writer.write())
-        s = ["} %s;" % name]
-        self._indentText(s)
-        text.extend(s)
-        self._identifierStack.append("feature")
-        return text
+    def _openBlock(self, out, identifier, name):
+        self._writeBreakBefore(out, identifier)
+        out.append(self._indentString() + "%s %s {" % (identifier, name))
+
+    def _closeBlock(self, out, identifier, name):
+        out.append(self._indentString() + "} %s;" % name)
+        self._identifierStack.append(identifier)
+
+    def _writeNested(self, out, writer):
+        start = len(out)
+        writer._subtableEstimates = self._subtableEstimates
+        writer._render(out)
+        # an empty writer still takes up a line
+        if len(out) == start:
+            out.append("")
 
     # lookup
 
     def lookup(self, name):
-        writer = self.__class__(whitespace=self._whitespace)
+        writer = self._nestedWriter()
+        writer._lookupName = name
         writer._indent = self._indentLevel() + 1
-        d = dict(
-            identifier="lookup",
-            name=name,
-            writer=writer
-        )
-        self._content.append(d)
+        self._content.append(_LookupRecord(name, writer))
         return writer
 
-    def _lookup(self, name, writer):
-        text = self._handleBreakBefore("lookup")
-        # start
-        s = ["lookup %s {" % name]
-        self._indentText(s)
-        text.extend(s)
-        text.append(writer.write())
-        s = ["} %s;" % name]
-        self._indentText(s)
-        text.extend(s)
-        self._identifierStack.append("lookup")
-        return text
+    def _lookup(self, out, name, writer):
+        self._openBlock(out, "lookup", name)
+        self._writeNested(out, writer)
+        self._closeBlock(out, "lookup", name)
 
     def lookupflag(self, flags):
         """
@@ -644,18 +2080,13 @@ class FeaSyntaxWriter(object):
         """
         # XXX all lookup flags need to be regestered at once for a given lookup
         # XXX maybe this could be more flexible and different flags could be added att diferent times (?)
-        d = dict(
-            identifier="lookupflag",
-            flags=flags
-        )
-        self._content.append(d)
+        self._content.append(_LookupFlagRecord(flags))
 
-    def _lookupflag(self, flags):
-        text = self._handleBreakBefore("lookupflag")
-        text.append("lookupflag %s;" % " ".join(flags))
-        self._indentText(text)
+    def _lookupflag(self, out, flags):
+        indent = self._indentString()
+        self._writeBreakBefore(out, "lookupflag", indent)
+        out.append(indent + "lookupflag %s;" % " ".join(flags))
         self._identifierStack.append("lookupflag")
-        return text
 
     # feature reference
 
@@ -665,18 +2096,13 @@ class FeaSyntaxWriter(object):
         )
 
     def featureReference(self, name):
-        d = dict(
-            identifier="featureReference",
-            name=name
-        )
-        self._content.append(d)
+        self._content.append(_FeatureReferenceRecord(name))
 
-    def _featureReference(self, name):
-        text = self._handleBreakBefore("featureReference")
-        text.append(self.formatFeatureReference(name))
-        self._indentText(text)
+    def _featureReference(self, out, name):
+        indent = self._indentString()
+        self._writeBreakBefore(out, "featureReference", indent)
+        out.append(indent + self.formatFeatureReference(name))
         self._identifierStack.append("featureReference")
-        return text
 
     # lookup reference
 
@@ -686,18 +2112,13 @@ class FeaSyntaxWriter(object):
         )
 
     def lookupReference(self, name):
-        d = dict(
-            identifier="lookupReference",
-            name=name
-        )
-        self._content.append(d)
+        self._content.append(_LookupReferenceRecord(name))
 
-    def _lookupReference(self, name):
-        text = self._handleBreakBefore("lookupReference")
-        text.append(self.formatLookupReference(name))
-        self._indentText(text)
+    def _lookupReference(self, out, name):
+        indent = self._indentString()
+        self._writeBreakBefore(out, "lookupReference", indent)
+        out.append(indent + self.formatLookupReference(name))
         self._identifierStack.append("lookupReference")
-        return text
 
     # substitution
 
@@ -749,20 +2170,44 @@ class FeaSyntaxWriter(object):
             target = [target]
         if isinstance(substitution, str):
             substitution = [substitution]
-        d = dict(
-            identifier="substitution",
-            target=target,
-            substitution=substitution,
-            backtrack=backtrack,
-            lookahead=lookahead,
-            choice=choice
+        self._content.append(
+            _SubstitutionRecord(
+                target,
+                substitution,
+                backtrack,
+                lookahead,
+                choice
+            )
         )
-        self._content.append(d)
 
-    def _substitution(self, target, substitution, backtrack=None, lookahead=None, choice=False):
-        text = self._handleBreakBefore("substitution")
-        text.append(
-            self.formatSubstitution(
+    def substitutions(self, targets, substitutions=None, backtrack=None, lookahead=None, choice=False):
+        """
+        Add many substitution rules at once. targets may
+        be a mapping of targets to substitutions, an
+        iterable of (target, substitution) pairs or a
+        sequence of targets that parallels the substitutions
+        sequence. backtrack, lookahead and choice apply
+        to all of the rules.
+        """
+        new = _SubstitutionRecord
+        with _pausedGarbageCollection():
+            self._content.extend([
+                new(
+                    [target] if isinstance(target, str) else target,
+                    [substitution] if isinstance(substitution, str) else substitution,
+                    backtrack,
+                    lookahead,
+                    choice
+                )
+                for target, substitution in self._bulkItems(targets, substitutions)
+            ])
+
+    def _substitution(self, out, target, substitution, backtrack=None, lookahead=None, choice=False):
+        backtrack, lookahead = self._applyContextualMarkers(backtrack, lookahead)
+        indent = self._indentString()
+        self._writeBreakBefore(out, "substitution", indent)
+        out.append(
+            indent + self.formatSubstitution(
                 target,
                 substitution,
                 backtrack=backtrack,
@@ -770,9 +2215,7 @@ class FeaSyntaxWriter(object):
                 choice=choice
             )
         )
-        self._indentText(text)
         self._identifierStack.append("substitution")
-        return text
 
     # ignore substitution
 
@@ -826,28 +2269,48 @@ class FeaSyntaxWriter(object):
     def positionSingle(self, target, value, backtrack=None, lookahead=None):
         if isinstance(target, str):
             target = [target]
-        d = dict(
-            identifier="positionSingle",
-            target=target,
-            value=value,
-            backtrack=backtrack,
-            lookahead=lookahead
+        self._content.append(
+            _PositionSingleRecord(
+                target,
+                value,
+                backtrack,
+                lookahead
+            )
         )
-        self._content.append(d)
 
-    def _positionSingle(self, target, value, backtrack=None, lookahead=None):
-        text = self._handleBreakBefore("positionSingle")
-        text.append(
-            self.formatPositionSingle(
+    def positionSingles(self, targets, values=None, backtrack=None, lookahead=None):
+        """
+        Add many single positioning rules at once. targets
+        may be a mapping of targets to values, an iterable
+        of (target, value) pairs or a sequence of targets
+        that parallels the values sequence. backtrack and
+        lookahead apply to all of the rules.
+        """
+        new = _PositionSingleRecord
+        with _pausedGarbageCollection():
+            self._content.extend([
+                new(
+                    [target] if isinstance(target, str) else target,
+                    value,
+                    backtrack,
+                    lookahead
+                )
+                for target, value in self._bulkItems(targets, values)
+            ])
+
+    def _positionSingle(self, out, target, value, backtrack=None, lookahead=None):
+        backtrack, lookahead = self._applyContextualMarkers(backtrack, lookahead)
+        indent = self._indentString()
+        self._writeBreakBefore(out, "positionSingle", indent)
+        out.append(
+            indent + self.formatPositionSingle(
                 target,
                 value,
                 backtrack=backtrack,
                 lookahead=lookahead
             )
         )
-        self._indentText(text)
         self._identifierStack.append("positionSingle")
-        return text
 
     # ignore position single
 
@@ -872,20 +2335,46 @@ class FeaSyntaxWriter(object):
         return self._formatPositionBasic(target, value, backtrack, lookahead, enumerate)
 
     def positionPair(self, target, value, backtrack=None, lookahead=None, enumerate=False):
-        d = dict(
-            identifier="positionPair",
-            target=target,
-            value=value,
-            backtrack=backtrack,
-            lookahead=lookahead,
-            enumerate=enumerate
+        self._content.append(
+            _PositionPairRecord(
+                target,
+                value,
+                backtrack,
+                lookahead,
+                enumerate
+            )
         )
-        self._content.append(d)
 
-    def _positionPair(self, target, value, backtrack=None, lookahead=None, enumerate=False):
-        text = self._handleBreakBefore("positionPair")
-        text.append(
-            self.formatPositionPair(
+    def positionPairs(self, pairs, values=None, backtrack=None, lookahead=None, enumerate=False):
+        """
+        Add many pair positioning rules at once. pairs may
+        be a mapping of pairs to values, such as font.kerning,
+        an iterable of (pair, value) pairs or a sequence of
+        pairs that parallels the values sequence. backtrack,
+        lookahead and enumerate apply to all of the rules.
+        """
+        new = _PositionPairRecord
+        with _pausedGarbageCollection():
+            self._content.extend([
+                new(
+                    pair,
+                    value,
+                    backtrack,
+                    lookahead,
+                    enumerate
+                )
+                for pair, value in self._bulkItems(pairs, values)
+            ])
+
+    def _positionPair(self, out, target, value, backtrack=None, lookahead=None, enumerate=False):
+        if not enumerate and backtrack is None and lookahead is None and value is not None:
+            if self._estimateClassPair(target, value):
+                self._writeSubtable(out)
+        backtrack, lookahead = self._applyContextualMarkers(backtrack, lookahead)
+        indent = self._indentString()
+        self._writeBreakBefore(out, "positionPair", indent)
+        out.append(
+            indent + self.formatPositionPair(
                 target,
                 value,
                 backtrack=backtrack,
@@ -893,9 +2382,123 @@ class FeaSyntaxWriter(object):
                 enumerate=enumerate
             )
         )
-        self._indentText(text)
         self._identifierStack.append("positionPair")
-        return text
+
+    # kerning
+
+    def kerningFromFont(self, font, pruneZeros=True):
+        """
+        Write class definitions for the kerning groups
+        and pair positioning rules for the kerning in font.
+
+        Glyph pairs are written first, then exceptions with
+        a glyph on the left and a class on the right, then
+        exceptions with a class on the left and a glyph on
+        the right, both as enum rules, and class pairs last.
+        The first rule that matches a pair wins, so this is
+        the precedence given in the UFO specification. Within
+        each of these, the pairs are sorted by name. If
+        pruneZeros is True, pairs with a value of zero are
+        left out unless they override a nonzero class pair.
+        """
+        # this allocates a lot of small containers,
+        # see _pausedGarbageCollection.
+        with _pausedGarbageCollection():
+            self._kerningFromFont(font, pruneZeros)
+
+    def _kerningFromFont(self, font, pruneZeros):
+        groups = font.groups
+        groupNames = set(groups.keys())
+        # items reads the kerning as a whole, where
+        # copying the mapping would read every pair.
+        kerning = dict(font.kerning.items())
+        # find the groups used on either side
+        leftGroups = set()
+        rightGroups = set()
+        for left, right in kerning:
+            if left in groupNames:
+                leftGroups.add(left)
+            if right in groupNames:
+                rightGroups.add(right)
+        leftGroupOf = _kerningGroupMembership(groups, leftGroups)
+        rightGroupOf = _kerningGroupMembership(groups, rightGroups)
+        # Pairs are packed into integers that sort in the
+        # same order as the names in the pair, with the index
+        # of the value in the low bits. Sorting an array of
+        # integers is much faster than sorting tuples of
+        # strings and takes a fraction of the memory.
+        sideNames = sorted(set(left for left, right in kerning) | set(right for left, right in kerning))
+        sideCount = len(sideNames)
+        sideIndexes = dict((name, i) for i, name in enumerate(sideNames))
+        values = list(set(kerning.values()))
+        valueIndexes = dict((value, i) for i, value in enumerate(values))
+        valueBits = len(values).bit_length()
+        if (sideCount * sideCount) << valueBits < 2 ** 63:
+            keyArray = lambda: array("q")
+        else:
+            keyArray = list
+        # sort the pairs by specificity
+        glyphPairs = keyArray()
+        glyphClassPairs = keyArray()
+        classGlyphPairs = keyArray()
+        classPairs = keyArray()
+        usedGroups = set()
+        for pair, value in kerning.items():
+            left, right = pair
+            leftIsGroup = left in leftGroups
+            rightIsGroup = right in rightGroups
+            if pruneZeros and not value:
+                if leftIsGroup and rightIsGroup:
+                    continue
+                fallbacks = []
+                if not leftIsGroup:
+                    fallbacks.append((leftGroupOf.get(left), right))
+                if not rightIsGroup:
+                    fallbacks.append((left, rightGroupOf.get(right)))
+                if not leftIsGroup and not rightIsGroup:
+                    fallbacks.append((leftGroupOf.get(left), rightGroupOf.get(right)))
+                if not any(kerning.get(fallback) for fallback in fallbacks):
+                    continue
+            key = ((sideIndexes[left] * sideCount + sideIndexes[right]) << valueBits) | valueIndexes[value]
+            if leftIsGroup and rightIsGroup:
+                classPairs.append(key)
+                usedGroups.add(left)
+                usedGroups.add(right)
+            elif leftIsGroup:
+                classGlyphPairs.append(key)
+                usedGroups.add(left)
+            elif rightIsGroup:
+                glyphClassPairs.append(key)
+                usedGroups.add(right)
+            else:
+                glyphPairs.append(key)
+        # class definitions
+        classNames = dict((name, _kerningClassName(name)) for name in usedGroups)
+        self.classDefinitions(
+            [classNames[name] for name in sorted(classNames)],
+            [groups[name] for name in sorted(classNames)]
+        )
+        # rules
+        outputNames = [classNames.get(name, name) for name in sideNames]
+        valueStrings = [_formatKerningValue(value) for value in values]
+        valueMask = (1 << valueBits) - 1
+        rules = (
+            (glyphPairs, False),
+            (glyphClassPairs, True),
+            (classGlyphPairs, True),
+            (classPairs, False)
+        )
+        for keys, enumerateRules in rules:
+            keys = sorted(keys)
+            pairs = []
+            for key in keys:
+                left, right = divmod(key >> valueBits, sideCount)
+                pairs.append((outputNames[left], outputNames[right]))
+            self.positionPairs(
+                pairs,
+                [valueStrings[key & valueMask] for key in keys],
+                enumerate=enumerateRules
+            )
 
     # position mark to base
 
@@ -911,26 +2514,19 @@ class FeaSyntaxWriter(object):
         'anchor' should be a tuples representing anchor position (x, y)
         'markClass' should be a string
         """
-        d = dict(
-            identifier="positionMarkToBase",
-            target=target,
-            anchor=anchor,
-            markClass=markClass,
-        )
-        self._content.append(d)
+        self._content.append(_PositionMarkToBaseRecord(target, anchor, markClass))
 
-    def _positionMarkToBase(self, target, anchor, markClass):
-        text = self._handleBreakBefore("positionMarkToBase")
-        text.append(
-            self.formatPositionMarkToBase(
+    def _positionMarkToBase(self, out, target, anchor, markClass):
+        indent = self._indentString()
+        self._writeBreakBefore(out, "positionMarkToBase", indent)
+        out.append(
+            indent + self.formatPositionMarkToBase(
                 target,
                 anchor,
                 markClass
             )
         )
-        self._indentText(text)
         self._identifierStack.append("positionMarkToBase")
-        return text
 
     # position mark to mark
 
@@ -946,26 +2542,19 @@ class FeaSyntaxWriter(object):
         'anchor' should be a tuples representing anchor position (x, y)
         'markClass' should be a string
         """
-        d = dict(
-            identifier="positionMarkToMark",
-            target=target,
-            anchor=anchor,
-            markClass=markClass,
-        )
-        self._content.append(d)
+        self._content.append(_PositionMarkToMarkRecord(target, anchor, markClass))
 
-    def _positionMarkToMark(self, target, anchor, markClass):
-        text = self._handleBreakBefore("positionMarkToMark")
-        text.append(
-            self.formatPositionMarkToMark(
+    def _positionMarkToMark(self, out, target, anchor, markClass):
+        indent = self._indentString()
+        self._writeBreakBefore(out, "positionMarkToMark", indent)
+        out.append(
+            indent + self.formatPositionMarkToMark(
                 target,
                 anchor,
                 markClass
             )
         )
-        self._indentText(text)
         self._identifierStack.append("positionMarkToMark")
-        return text
 
     # position mark to ligature
 
@@ -980,24 +2569,18 @@ class FeaSyntaxWriter(object):
         'target' argument should be a glyph name of a list of glyph names
         'anchor_data' should be a list of tuples representing anchor positions and the associtated markClass like [((x, y), @markClassName)]
         """
-        d = dict(
-            identifier="positionMarkToLigature",
-            target=target,
-            anchor_data=anchor_data
-        )
-        self._content.append(d)
+        self._content.append(_PositionMarkToLigatureRecord(target, anchor_data))
 
-    def _positionMarkToLigature(self, target, anchor_data):
-        text = self._handleBreakBefore("positionMarkToLigature")
-        text.append(
-            self.formatPositionMarkToLigature(
+    def _positionMarkToLigature(self, out, target, anchor_data):
+        indent = self._indentString()
+        self._writeBreakBefore(out, "positionMarkToLigature", indent)
+        out.append(
+            indent + self.formatPositionMarkToLigature(
                 target,
                 anchor_data
             )
         )
-        self._indentText(text)
         self._identifierStack.append("positionMarkToLigature")
-        return text
 
     def _formatPositionMarkBasic(self, kind, target, anchor_data):
         marks = ["{anchor} mark {markClass}".format(anchor=self._formatAnchorDefinition(anchor), markClass=markClass) for anchor, markClass in anchor_data]
@@ -1010,17 +2593,80 @@ class FeaSyntaxWriter(object):
     # subtable
 
     def subtable(self):
-        d = dict(
-            identifier="subtable",
-        )
-        self._content.append(d)
+        self._content.append(_SubtableRecord())
+
+    def _subtable(self, out):
+        self._closeSubtableEstimate()
+        self._writeSubtable(out)
 
-    def _subtable(self):
-        text = self._handleBreakBefore("subtable")
-        text.append("subtable;")
-        self._indentText(text)
+    def _writeSubtable(self, out):
+        indent = self._indentString()
+        self._writeBreakBefore(out, "subtable", indent)
+        out.append(indent + "subtable;")
         self._identifierStack.append("subtable")
-        return text
+
+    # subtable size estimates
+
+    def _classSize(self, side):
+        """
+        Get the number of glyphs in side if
+        it is a class. Otherwise, get None.
+        """
+        if isinstance(side, str):
+            if not side.startswith("@"):
+                return None
+            members = self._classes.get(side)
+            if members is None or isinstance(members, str):
+                return 1
+            return len(members)
+        return len(side)
+
+    def _estimateClassPair(self, target, value):
+        """
+        Add the pair to the estimate of the current
+        subtable. Returns True if an automatic subtable
+        break needs to be written before the pair.
+        """
+        if isinstance(target, str) or len(target) != 2:
+            return False
+        left, right = target
+        leftSize = self._classSize(left)
+        if leftSize is None:
+            return False
+        rightSize = self._classSize(right)
+        if rightSize is None:
+            return False
+        left = self._flattenClass(left)
+        right = self._flattenClass(right)
+        valueSize = 2
+        if not isinstance(value, str) or value.startswith("<"):
+            valueSize = 8
+        needBreak = False
+        estimate = self._subtableEstimate
+        if estimate is None:
+            estimate = self._startSubtableEstimate(False)
+        elif self.autoSubtables and left not in estimate.leftClasses and estimate.sizeWith(left, leftSize, right, rightSize, valueSize) > self.maxSubtableSize:
+            # a left class must not be split between subtables:
+            # its glyphs are in the coverage of the first one,
+            # so the pairs in the later ones would never apply.
+            self._closeSubtableEstimate()
+            estimate = self._startSubtableEstimate(True)
+            needBreak = True
+        estimate.add(left, leftSize, right, rightSize, valueSize)
+        return needBreak
+
+    def _startSubtableEstimate(self, automatic):
+        name = self._lookupName
+        if name is None:
+            name = self._featureName
+        self._subtableEstimate = _PairPosSubtableEstimate(name, self._subtableIndex, automatic)
+        return self._subtableEstimate
+
+    def _closeSubtableEstimate(self):
+        if self._subtableEstimate is not None:
+            self._subtableEstimates.append(self._subtableEstimate)
+            self._subtableEstimate = None
+        self._subtableIndex += 1
 
     # stylistic set
 
@@ -1045,15 +2691,138 @@ class FeaSyntaxWriter(object):
         return text
 
     def stylisticSetNames(self, *names):
-        d = dict(
-            identifier="stylisticSetNames",
-            names=names
-        )
-        self._content.append(d)
+        self._content.append(_StylisticSetNamesRecord(names))
 
-    def _stylisticSetNames(self, names):
-        text = self._handleBreakBefore("stylisticSetNames")
-        text.extend(self.formatStylisticSetNames(*names).splitlines())
-        self._indentText(text)
+    def _stylisticSetNames(self, out, names):
+        indent = self._indentString()
+        self._writeBreakBefore(out, "stylisticSetNames", indent)
+        for line in self.formatStylisticSetNames(*names).splitlines():
+            out.append(indent + line)
         self._identifierStack.append("stylisticSetNames")
-        return text
+
+
+def _kerningClassName(groupName):
+    """
+    Get the .fea class name for a kerning group.
+    """
+    if groupName.startswith("@"):
+        return groupName
+    if groupName.startswith("public."):
+        groupName = groupName[len("public."):]
+    return "@" + groupName
+
+
+def _kerningGroupMembership(groups, groupNames):
+    """
+    Map glyph names to the first of groupNames,
+    in sorted order, that contains them.
+    """
+    membership = {}
+    for groupName in sorted(groupNames):
+        for glyphName in groups[groupName]:
+            membership.setdefault(glyphName, groupName)
+    return membership
+
+
+def _formatKerningValue(value):
+    if isinstance(value, str):
+        return value
+    return str(int(round(value)))
+
+
+class _PairPosSubtableEstimate(object):
+
+    """
+    A running estimate of the size of a class pair
+    positioning subtable (GPOS lookup type 2, format 2).
+    The class matrix has a record for every combination
+    of a left class and a right class, including the
+    implied class 0 on the right, so it grows with the
+    product of the class counts. The coverage and the
+    class definitions are estimated at two bytes per
+    glyph, which errs on the high side when they can
+    be stored as ranges.
+    """
+
+    __slots__ = (
+        "lookupName",
+        "index",
+        "automatic",
+        "pairCount",
+        "leftClasses",
+        "rightClasses",
+        "leftGlyphCount",
+        "rightGlyphCount",
+        "valueSize"
+    )
+
+    def __init__(self, lookupName, index, automatic):
+        self.lookupName = lookupName
+        self.index = index
+        self.automatic = automatic
+        self.pairCount = 0
+        self.leftClasses = set()
+        self.rightClasses = set()
+        self.leftGlyphCount = 0
+        self.rightGlyphCount = 0
+        self.valueSize = 2
+
+    def _size(self, leftClassCount, rightClassCount, leftGlyphCount, rightGlyphCount, valueSize):
+        header = 16
+        matrix = leftClassCount * (rightClassCount + 1) * valueSize
+        coverage = 4 + 2 * leftGlyphCount
+        classDefs = 6 + 2 * leftGlyphCount + 6 + 2 * rightGlyphCount
+        return header + matrix + coverage + classDefs
+
+    def size(self):
+        return self._size(
+            len(self.leftClasses),
+            len(self.rightClasses),
+            self.leftGlyphCount,
+            self.rightGlyphCount,
+            self.valueSize
+        )
+
+    def sizeWith(self, left, leftSize, right, rightSize, valueSize):
+        """
+        Get the size the subtable would have
+        if the given pair was added.
+        """
+        leftClassCount = len(self.leftClasses)
+        leftGlyphCount = self.leftGlyphCount
+        if left not in self.leftClasses:
+            leftClassCount += 1
+            leftGlyphCount += leftSize
+        rightClassCount = len(self.rightClasses)
+        rightGlyphCount = self.rightGlyphCount
+        if right not in self.rightClasses:
+            rightClassCount += 1
+            rightGlyphCount += rightSize
+        return self._size(
+            leftClassCount,
+            rightClassCount,
+            leftGlyphCount,
+            rightGlyphCount,
+            max(valueSize, self.valueSize)
+        )
+
+    def add(self, left, leftSize, right, rightSize, valueSize):
+        self.pairCount += 1
+        if left not in self.leftClasses:
+            self.leftClasses.add(left)
+            self.leftGlyphCount += leftSize
+        if right not in self.rightClasses:
+            self.rightClasses.add(right)
+            self.rightGlyphCount += rightSize
+        self.valueSize = max(valueSize, self.valueSize)
+
+    def asDict(self):
+        return dict(
+            lookup=self.lookupName,
+            subtable=self.index,
+            pairs=self.pairCount,
+            leftClasses=len(self.leftClasses),
+            rightClasses=len(self.rightClasses),
+            size=self.size(),
+            automatic=self.automatic
+        )
@@ -0,0 +1,182 @@
+from __future__ import unicode_literals
+
+from bisect import bisect_left
+
+from .dependencies import _recordDependency
+
+
+# -----------
+# Glyph Index
+# -----------
+
+class GlyphIndex(object):
+
+    """
+    Lookups into the glyph names of a font.
+
+    An index is made for every compile and it is
+    available to code blocks as glyphs. The tables
+    are built the first time they are needed and
+    shared by all code blocks and referenced files
+    in the compile, so the glyph set is only scanned
+    once no matter how many blocks look through it.
+
+    Results are tuples of glyph names in glyph order.
+    Glyphs that are in the font but not in the glyph
+    order follow the glyph order in sorted order.
+
+    The index is not updated when the font changes.
+
+    When code blocks are tracked, the lookups are
+    recorded as dependencies on the glyph names and
+    the glyph order, and the unicodes for withUnicode
+    and forUnicode.
+    """
+
+    def __init__(self, font):
+        self.font = font
+        self._names = None
+        self._nameSet = None
+        self._order = None
+        self._suffixes = None
+        self._baseNames = None
+        self._unicodes = None
+        self._sortedNames = None
+        self._prefixes = {}
+
+    def __repr__(self):
+        return "<GlyphIndex %d glyphs>" % len(self)
+
+    # -----
+    # Names
+    # -----
+
+    def _getNames(self):
+        _recordNameDependencies()
+        if self._names is None:
+            font = self.font
+            available = set(font.keys())
+            names = []
+            for name in getattr(font, "glyphOrder", None) or []:
+                if name in available:
+                    names.append(name)
+                    available.remove(name)
+            names.extend(sorted(available))
+            self._nameSet = frozenset(names)
+            self._names = tuple(names)
+        return self._names
+
+    names = property(_getNames, doc="All glyph names in glyph order.")
+
+    def __len__(self):
+        return len(self._getNames())
+
+    def __iter__(self):
+        return iter(self._getNames())
+
+    def __contains__(self, name):
+        self._getNames()
+        return name in self._nameSet
+
+    def _getOrder(self):
+        if self._order is None:
+            self._order = dict((name, i) for i, name in enumerate(self._getNames()))
+        return self._order
+
+    # ------
+    # Tables
+    # ------
+
+    def withSuffix(self, suffix):
+        """
+        Get the names that end with suffix. The suffix
+        must start at a period in the name: ".alt"
+        matches "a.alt" and "a.sc.alt" but "alt" matches
+        the same names as ".alt".
+        """
+        _recordNameDependencies()
+        if self._suffixes is None:
+            suffixes = {}
+            for name in self._getNames():
+                index = name.find(".", 1)
+                while index != -1:
+                    suffixes.setdefault(name[index:], []).append(name)
+                    index = name.find(".", index + 1)
+            self._suffixes = _freeze(suffixes)
+        if not suffix.startswith("."):
+            suffix = "." + suffix
+        return self._suffixes.get(suffix, ())
+
+    def withBaseName(self, baseName):
+        """
+        Get the names that have baseName before the first
+        period, including baseName itself: "a" matches
+        "a", "a.alt" and "a.sc".
+        """
+        _recordNameDependencies()
+        if self._baseNames is None:
+            baseNames = {}
+            for name in self._getNames():
+                baseNames.setdefault(_baseName(name), []).append(name)
+            self._baseNames = _freeze(baseNames)
+        return self._baseNames.get(baseName, ())
+
+    def withUnicode(self, value):
+        """
+        Get the names of the glyphs that have
+        the unicode value value.
+        """
+        _recordNameDependencies()
+        _recordDependency("unicodes")
+        if self._unicodes is None:
+            unicodes = {}
+            for name in self._getNames():
+                for unicode in self.font[name].unicodes:
+                    unicodes.setdefault(unicode, []).append(name)
+            self._unicodes = _freeze(unicodes)
+        return self._unicodes.get(value, ())
+
+    def forUnicode(self, value):
+        """
+        Get the name of the first glyph that has
+        the unicode value value or None.
+        """
+        names = self.withUnicode(value)
+        if not names:
+            return None
+        return names[0]
+
+    def withPrefix(self, prefix):
+        """
+        Get the names that start with prefix.
+        """
+        _recordNameDependencies()
+        names = self._prefixes.get(prefix)
+        if names is None:
+            if self._sortedNames is None:
+                self._sortedNames = sorted(self._getNames())
+            sortedNames = self._sortedNames
+            names = []
+            index = bisect_left(sortedNames, prefix)
+            while index < len(sortedNames) and sortedNames[index].startswith(prefix):
+                names.append(sortedNames[index])
+                index += 1
+            names.sort(key=self._getOrder().__getitem__)
+            names = self._prefixes[prefix] = tuple(names)
+        return names
+
+
+def _recordNameDependencies():
+    _recordDependency("glyphNames")
+    _recordDependency("glyphOrder")
+
+
+def _baseName(name):
+    index = name.find(".", 1)
+    if index == -1:
+        return name
+    return name[:index]
+
+
+def _freeze(table):
+    return dict((key, tuple(value)) for key, value in table.items())
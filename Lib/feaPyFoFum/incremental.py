@@ -0,0 +1,243 @@
+from __future__ import unicode_literals
+
+import os
+import time
+import hashlib
+import contextlib
+
+from .feaPyFoFum import (
+    FeaPyFoFumError,
+    _buildIncludeGraph,
+    _compileFeatureText,
+    _compileReferencedFeatureFile,
+    _findReferencedFilesInLines,
+    _collectedDependencies
+)
+from .cache import dependencyFingerprint
+from .glyphIndex import GlyphIndex
+
+
+# ---------------------
+# Incremental Compiling
+# ---------------------
+
+class IncrementalCompiler(object):
+
+    """
+    A compiler that keeps track of what it compiled
+    and only recompiles what changed.
+
+    The font must be a font object that supports
+    the RoboFab API and it must have a path.
+    Referenced files are always compiled.
+
+    If text is None, the feature text will be read
+    from the font every time the compiler updates.
+
+    A manifest of the hash and modification time of
+    every referenced file, the include graph and the
+    font data read by the code blocks in each file is
+    kept between updates. A referenced file is
+    recompiled when it changed, when it was newly
+    referenced, when its compiled file went missing
+    or when the font data its code blocks read
+    changed. Each file is compiled in a fresh
+    namespace and the include statements are rewritten
+    based on the file names alone, so a file that
+    includes a changed file doesn't need to be
+    recompiled unless it changed itself.
+
+    After an update, the compiled text is available
+    as the text attribute and the paths of the files
+    compiled during the update are available as the
+    compiledFiles attribute. The feature text is
+    listed as None.
+    """
+
+    def __init__(self, font, text=None, verbose=False, cache=None):
+        if not font.path:
+            raise FeaPyFoFumError("The font must have a path.")
+        self.font = font
+        self.sourceText = text
+        self.verbose = verbose
+        self.cache = cache
+        self.relativePath = os.path.dirname(font.path)
+        self.text = None
+        self.compiledFiles = []
+        self._dependencies = {}
+        self._rootText = None
+        self._manifest = {}
+        self._graph = []
+
+    # --------
+    # Manifest
+    # --------
+
+    def _getManifestEntry(self, path):
+        """
+        Get the manifest entry for the path,
+        updating it if the file changed.
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self._manifest.pop(path, None)
+            return None
+        entry = self._manifest.get(path)
+        if entry is not None and entry.modified == stat.st_mtime and entry.size == stat.st_size:
+            return entry
+        with open(path, "r") as f:
+            text = f.read()
+        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        if entry is not None and entry.digest == digest:
+            entry.modified = stat.st_mtime
+            entry.size = stat.st_size
+            return entry
+        compiledDigest = None
+        if entry is not None:
+            compiledDigest = entry.compiledDigest
+        entry = _ManifestEntry(
+            modified=stat.st_mtime,
+            size=stat.st_size,
+            digest=digest,
+            referencedFiles=_findReferencedFilesInLines(text.splitlines(), self.relativePath),
+            compiledDigest=compiledDigest
+        )
+        self._manifest[path] = entry
+        return entry
+
+    def _getReferencedFiles(self, path):
+        entry = self._getManifestEntry(path)
+        if entry is None:
+            return None
+        return entry.referencedFiles
+
+    # ---------
+    # Compiling
+    # ---------
+
+    def update(self):
+        """
+        Recompile everything that changed since the last
+        update. Returns True if anything was compiled.
+        """
+        font = self.font
+        # the values of the dependencies are computed
+        # once per update and shared by all files.
+        values = {}
+
+        def fontChanged(path):
+            record = self._dependencies.get(path)
+            if record is None:
+                return True
+            dependencies, fingerprint = record
+            return dependencyFingerprint(font, dependencies, values) != fingerprint
+
+        text = self.sourceText
+        if text is None:
+            text = font.features.text or ""
+        # find the files that changed since they were last
+        # compiled. an update that failed may have read
+        # files that it didn't get to compile.
+        referencedFiles = _findReferencedFilesInLines(text.splitlines(), self.relativePath)
+        graph = _buildIncludeGraph(referencedFiles, self.relativePath, self._getReferencedFiles)
+        compile = []
+        for inPath, outPath in graph:
+            entry = self._manifest.get(inPath)
+            if entry is None:
+                continue
+            if entry.compiledDigest != entry.digest or not os.path.exists(outPath) or fontChanged(inPath):
+                compile.append((inPath, outPath, entry))
+        # forget files that are no longer referenced
+        referenced = set(inPath for inPath, outPath in graph)
+        for path in list(self._manifest.keys()):
+            if path not in referenced:
+                del self._manifest[path]
+        for path in list(self._dependencies.keys()):
+            if path is not None and path not in referenced:
+                del self._dependencies[path]
+        self._graph = graph
+        # compile
+        blockCache = None
+        if self.cache is not None and self.cache.enabled:
+            blockCache = self.cache.session(font)
+        glyphIndex = GlyphIndex(font)
+        compiledFiles = []
+        if text != self._rootText or fontChanged(None):
+            with self._recordingDependencies(None, values):
+                self.text = _compileFeatureText(
+                    text,
+                    font,
+                    relativePath=self.relativePath,
+                    verbose=self.verbose,
+                    blockCache=blockCache,
+                    glyphIndex=glyphIndex
+                )[0]
+            self._rootText = text
+            compiledFiles.append(None)
+        for inPath, outPath, entry in compile:
+            digest = entry.digest
+            with self._recordingDependencies(inPath, values):
+                _compileReferencedFeatureFile(
+                    inPath,
+                    outPath,
+                    self.relativePath,
+                    font,
+                    blockCache=blockCache,
+                    glyphIndex=glyphIndex
+                )
+            entry.compiledDigest = digest
+            compiledFiles.append(inPath)
+        if blockCache is not None:
+            self.cache.trim()
+        self.compiledFiles = compiledFiles
+        return bool(compiledFiles)
+
+    @contextlib.contextmanager
+    def _recordingDependencies(self, path, values):
+        """
+        Collect the dependencies of the code blocks
+        compiled in the context and store them for the
+        file at path, None for the feature text.
+        """
+        dependencies = set()
+        token = _collectedDependencies.set(dependencies)
+        try:
+            yield
+        finally:
+            _collectedDependencies.reset(token)
+        # this is only reached if the compile succeeded
+        fingerprint = dependencyFingerprint(self.font, dependencies, values)
+        self._dependencies[path] = (dependencies, fingerprint)
+
+    def watch(self, callback=None, interval=0.25):
+        """
+        Update repeatedly until interrupted. callback
+        will be called with this object after every
+        update that compiled something. interval is
+        the number of seconds between updates.
+        """
+        try:
+            while True:
+                if self.update() and callback is not None:
+                    callback(self)
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            pass
+
+
+class _ManifestEntry(object):
+
+    """
+    compiledDigest is the digest of the file when
+    it was last compiled, None if it never was.
+    """
+
+    __slots__ = ("modified", "size", "digest", "referencedFiles", "compiledDigest")
+
+    def __init__(self, modified, size, digest, referencedFiles, compiledDigest=None):
+        self.modified = modified
+        self.size = size
+        self.digest = digest
+        self.referencedFiles = referencedFiles
+        self.compiledDigest = compiledDigest
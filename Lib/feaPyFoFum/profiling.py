@@ -0,0 +1,191 @@
+from __future__ import unicode_literals
+
+import os
+import pstats
+import cProfile
+from io import StringIO
+
+
+# ---------
+# Profiling
+# ---------
+
+class CompileProfile(object):
+
+    """
+    A report of the time spent in each code block
+    during a compile. After the compile, blocks is
+    a list of BlockProfile objects in the order the
+    blocks were executed.
+
+    If profileSlowest is greater than zero, every block
+    is run under cProfile and the statistics are kept
+    for that many of the slowest blocks. cProfile makes
+    the blocks run slower, so the times are only useful
+    for comparing the blocks with each other.
+    """
+
+    def __init__(self, profileSlowest=0):
+        self.profileSlowest = profileSlowest
+        self.blocks = []
+
+    def __repr__(self):
+        return "<CompileProfile %d blocks>" % len(self.blocks)
+
+    def __iter__(self):
+        return iter(self.blocks)
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def _beginBlock(self, codeBlock):
+        blockProfile = BlockProfile(codeBlock.fileName, codeBlock.lineOffset)
+        if self.profileSlowest > 0:
+            blockProfile._profiler = cProfile.Profile()
+        return blockProfile
+
+    def _endBlock(self, blockProfile, output, errors, writer):
+        blockProfile.outputLines = len(output.splitlines())
+        blockProfile.outputBytes = len(output.encode("utf-8"))
+        blockProfile.ruleCounts = _countRules(writer)
+        blockProfile.errors = errors
+        profiler = blockProfile._profiler
+        blockProfile._profiler = None
+        if profiler is not None:
+            try:
+                blockProfile.stats = pstats.Stats(profiler)
+            except TypeError:
+                # nothing was executed
+                profiler = None
+        if profiler is not None:
+            # only keep the statistics for the slowest blocks
+            profiled = [block for block in self.blocks if block.stats is not None]
+            profiled.append(blockProfile)
+            if len(profiled) > self.profileSlowest:
+                min(profiled, key=_blockTime).stats = None
+        self.blocks.append(blockProfile)
+
+    # -------
+    # Reading
+    # -------
+
+    def totalTime(self):
+        """
+        Get the total compile and execution
+        time of all blocks in seconds.
+        """
+        return sum(_blockTime(block) for block in self.blocks)
+
+    def slowest(self, count=None):
+        """
+        Get the count slowest blocks, slowest first.
+        If count is None, all blocks are returned.
+        """
+        blocks = sorted(self.blocks, key=_blockTime, reverse=True)
+        if count is not None:
+            blocks = blocks[:count]
+        return blocks
+
+    def format(self, count=None):
+        """
+        Format the count slowest blocks as a table.
+        If count is None, all blocks are included.
+        """
+        lines = ["%10s %10s %8s %10s  %s" % ("compile", "execute", "lines", "bytes", "block")]
+        for block in self.slowest(count):
+            location = "%s:%d" % (os.path.basename(block.fileName), block.line)
+            if block.errors:
+                location += " (error)"
+            lines.append(
+                "%9.2fms %9.2fms %8d %10d  %s" % (
+                    block.compileTime * 1000,
+                    block.executeTime * 1000,
+                    block.outputLines,
+                    block.outputBytes,
+                    location
+                )
+            )
+        lines.append("total: %.2fms in %d blocks" % (self.totalTime() * 1000, len(self.blocks)))
+        return "\n".join(lines)
+
+
+class BlockProfile(object):
+
+    """
+    The profile of one code block.
+
+    - fileName: the file the block is in
+    - line: the line of the block's # >>> marker
+    - compileTime: seconds spent compiling the code
+    - executeTime: seconds spent executing the code
+    - outputLines: the number of lines written
+    - outputBytes: the number of bytes written
+    - ruleCounts: a dict of the number of records
+      stored in the writer and the writers nested
+      in it, by writer method
+    - errors: the text written to stderr
+    - stats: a pstats.Stats object if the block was
+      run under cProfile and is one of the slowest
+      blocks, otherwise None
+    """
+
+    __slots__ = (
+        "fileName",
+        "line",
+        "compileTime",
+        "executeTime",
+        "outputLines",
+        "outputBytes",
+        "ruleCounts",
+        "errors",
+        "stats",
+        "_profiler"
+    )
+
+    def __init__(self, fileName, line):
+        self.fileName = fileName
+        self.line = line
+        self.compileTime = 0
+        self.executeTime = 0
+        self.outputLines = 0
+        self.outputBytes = 0
+        self.ruleCounts = {}
+        self.errors = ""
+        self.stats = None
+        self._profiler = None
+
+    def __repr__(self):
+        return "<BlockProfile %s:%d>" % (self.fileName, self.line)
+
+    def formatStats(self, sortBy="cumulative", count=20):
+        """
+        Format the cProfile statistics, if there are any.
+        """
+        if self.stats is None:
+            return ""
+        stream = StringIO()
+        self.stats.stream = stream
+        self.stats.sort_stats(sortBy).print_stats(count)
+        return stream.getvalue()
+
+
+def _blockTime(block):
+    return block.compileTime + block.executeTime
+
+
+def _countRules(writer):
+    # streaming writers don't keep their content
+    ruleCounts = getattr(writer._content, "ruleCounts", None)
+    if ruleCounts is not None:
+        return dict(ruleCounts)
+    counts = {}
+    writers = [writer]
+    while writers:
+        writer = writers.pop()
+        for record in writer._content:
+            identifier = record.identifier
+            counts[identifier] = counts.get(identifier, 0) + 1
+            nested = getattr(record, "writer", None)
+            if nested is not None:
+                writers.append(nested)
+    return counts
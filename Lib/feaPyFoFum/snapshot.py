@@ -0,0 +1,257 @@
+from __future__ import unicode_literals
+
+from collections.abc import Mapping
+
+try:
+    from fontTools.ufoLib import fontInfoAttributesVersion3
+except ImportError:
+    fontInfoAttributesVersion3 = None
+
+
+# -------------
+# Font Snapshot
+# -------------
+
+class FontSnapshot(object):
+
+    """
+    A frozen copy of the font data that code blocks
+    usually read: the glyph order, the glyph names,
+    unicodes, widths, heights, anchors and libs, the
+    groups, the kerning, the lib and the info.
+
+    A snapshot supports the parts of the RoboFab API
+    that read this data, so it can be given to code
+    blocks in place of the font. Reading from it is
+    plain attribute and dict access and it pickles
+    quickly, so it is cheap to send to worker processes.
+    Outlines and components are not part of a snapshot.
+
+    Groups are mappings of group names to tuples. The
+    mappings can't be changed. Values in the lib, the
+    glyph libs and the info are frozen all the way
+    down: dicts become mappings that can't be changed
+    and lists become tuples. The snapshot is not
+    updated when the font changes.
+    """
+
+    def __init__(self, font):
+        self.path = font.path
+        glyphs = {}
+        for name in font.keys():
+            glyphs[name] = GlyphSnapshot(font[name])
+        self._glyphs = _FrozenDict(glyphs)
+        glyphOrder = [name for name in getattr(font, "glyphOrder", None) or [] if name in glyphs]
+        remaining = set(glyphs) - set(glyphOrder)
+        self._glyphOrder = tuple(glyphOrder + sorted(remaining))
+        self.groups = _FrozenDict((name, tuple(members)) for name, members in font.groups.items())
+        self.kerning = _FrozenDict(font.kerning.items())
+        self.lib = _freeze(font.lib)
+        self.info = InfoSnapshot(font.info)
+
+    def __repr__(self):
+        return "<FontSnapshot %s>" % self.path
+
+    def __setattr__(self, attr, value):
+        if attr in self.__dict__:
+            raise AttributeError("FontSnapshot objects can't be changed.")
+        super(FontSnapshot, self).__setattr__(attr, value)
+
+    def __getstate__(self):
+        return self.__dict__
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    # glyph order
+
+    def _get_glyphOrder(self):
+        # a new list, so that code that
+        # extends it keeps working.
+        return list(self._glyphOrder)
+
+    glyphOrder = property(_get_glyphOrder)
+
+    # glyphs
+
+    def keys(self):
+        return self._glyphs.keys()
+
+    def __contains__(self, name):
+        return name in self._glyphs
+
+    def __getitem__(self, name):
+        return self._glyphs[name]
+
+    def get(self, name, default=None):
+        return self._glyphs.get(name, default)
+
+    def __len__(self):
+        return len(self._glyphs)
+
+    def __iter__(self):
+        glyphs = self._glyphs
+        for name in self._glyphOrder:
+            yield glyphs[name]
+
+
+class GlyphSnapshot(object):
+
+    """
+    A frozen copy of the data in a glyph.
+    """
+
+    __slots__ = ("name", "unicodes", "width", "height", "anchors", "lib", "note")
+
+    def __init__(self, glyph):
+        setAttr = super(GlyphSnapshot, self).__setattr__
+        setAttr("name", glyph.name)
+        setAttr("unicodes", tuple(glyph.unicodes))
+        setAttr("width", glyph.width)
+        setAttr("height", getattr(glyph, "height", None))
+        setAttr("anchors", tuple(AnchorSnapshot(anchor) for anchor in glyph.anchors))
+        setAttr("lib", _freeze(getattr(glyph, "lib", {})))
+        setAttr("note", getattr(glyph, "note", None))
+
+    def __repr__(self):
+        return "<GlyphSnapshot %s>" % self.name
+
+    def __setattr__(self, attr, value):
+        raise AttributeError("GlyphSnapshot objects can't be changed.")
+
+    def __getstate__(self):
+        return [getattr(self, attr) for attr in self.__slots__]
+
+    def __setstate__(self, state):
+        setAttr = super(GlyphSnapshot, self).__setattr__
+        for attr, value in zip(self.__slots__, state):
+            setAttr(attr, value)
+
+    def _get_unicode(self):
+        if not self.unicodes:
+            return None
+        return self.unicodes[0]
+
+    unicode = property(_get_unicode)
+
+
+class AnchorSnapshot(object):
+
+    """
+    A frozen copy of an anchor. The values can be
+    read as attributes or as items, like the
+    values of a defcon anchor.
+    """
+
+    __slots__ = ("name", "x", "y")
+
+    def __init__(self, anchor):
+        if isinstance(anchor, dict):
+            values = (anchor.get("name"), anchor.get("x"), anchor.get("y"))
+        else:
+            values = (anchor.name, anchor.x, anchor.y)
+        setAttr = super(AnchorSnapshot, self).__setattr__
+        for attr, value in zip(self.__slots__, values):
+            setAttr(attr, value)
+
+    def __repr__(self):
+        return "<AnchorSnapshot %s %s %s>" % (self.name, self.x, self.y)
+
+    def __setattr__(self, attr, value):
+        raise AttributeError("AnchorSnapshot objects can't be changed.")
+
+    def __getstate__(self):
+        return (self.name, self.x, self.y)
+
+    def __setstate__(self, state):
+        setAttr = super(AnchorSnapshot, self).__setattr__
+        for attr, value in zip(self.__slots__, state):
+            setAttr(attr, value)
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        if key not in self.__slots__:
+            return default
+        return getattr(self, key)
+
+    @property
+    def position(self):
+        return self.x, self.y
+
+
+class InfoSnapshot(object):
+
+    """
+    A frozen copy of the font info.
+    """
+
+    def __init__(self, info):
+        if fontInfoAttributesVersion3 is not None:
+            attributes = fontInfoAttributesVersion3
+        else:
+            attributes = [attr for attr in vars(info) if not attr.startswith("_")]
+        for attr in attributes:
+            self.__dict__[attr] = _freeze(getattr(info, attr, None))
+
+    def __setattr__(self, attr, value):
+        raise AttributeError("InfoSnapshot objects can't be changed.")
+
+    def __getattr__(self, attr):
+        # like the info objects, unset
+        # attributes are None
+        if attr.startswith("__"):
+            raise AttributeError(attr)
+        return None
+
+    def __getstate__(self):
+        return self.__dict__
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+
+def _freeze(value):
+    """
+    Get a copy of the value, with the dicts, lists
+    and sets in it replaced by _FrozenDicts, tuples
+    and frozensets. Anything else is kept as it is.
+    """
+    if isinstance(value, Mapping):
+        return _FrozenDict((key, _freeze(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    if isinstance(value, (set, frozenset)):
+        return frozenset(value)
+    return value
+
+
+class _FrozenDict(dict):
+
+    """
+    A dict that can't be changed.
+    """
+
+    def _readOnly(self, *args, **kwargs):
+        raise TypeError("This mapping can't be changed.")
+
+    __setitem__ = _readOnly
+    __delitem__ = _readOnly
+    clear = _readOnly
+    pop = _readOnly
+    popitem = _readOnly
+    setdefault = _readOnly
+    update = _readOnly
+    __ior__ = _readOnly
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self),))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
@@ -0,0 +1,381 @@
+from __future__ import unicode_literals
+
+import signal
+import pickle
+import weakref
+import hashlib
+import threading
+
+from .feaPyFoFum import (
+    FeaPyFoFumError,
+    compileFeatures,
+    _activeWorkerPool,
+    _executeCodeWithFont,
+    _makeNamespace,
+    _processContext
+)
+from .glyphIndex import GlyphIndex
+from .snapshot import FontSnapshot
+
+
+# -----------
+# Worker Pool
+# -----------
+
+class WorkerPool(object):
+
+    """
+    A pool of persistent processes that execute the
+    code blocks of compiles. A block that runs away,
+    uses up the memory or crashes takes down its
+    worker instead of this process.
+
+    The workers are started when they are first needed
+    and they keep running until the pool is closed, so
+    they only have to be started once. The blocks are
+    given a FontSnapshot of the font instead of the
+    font. Each worker keeps the snapshot it was last
+    sent and it is only sent again when the font data
+    changes.
+
+    The pool keeps the snapshot of a font that posts
+    Font.Changed notifications, like a defcon font,
+    until the font changes. Changes made inside lib
+    values, which don't post notifications, are not
+    noticed. Fonts without notifications are copied
+    into a new snapshot and compared with the last
+    one for every compile. To avoid this, give
+    compileFeatures a FontSnapshot and make a new one
+    when the font changes.
+
+    If timeout is given, a block that runs for more than
+    that many seconds is stopped. If maxMemory is given,
+    the address space of each worker is limited to that
+    many bytes, where the platform supports it. A block
+    that is stopped or that crashes its worker is reported
+    as an error, like a block that raises an exception,
+    and the worker is replaced.
+
+    The blocks in a file are executed by one worker, so
+    that they share a namespace. If the worker had to be
+    replaced, the blocks after the one that failed start
+    over with a new namespace.
+
+    The pool may be used by compiles running in several
+    threads at the same time. The workers are not forked
+    from this process, see _processContext, so scripts
+    that use a pool must guard their main code with
+    if __name__ == "__main__".
+    """
+
+    def __init__(self, workers=1, timeout=None, maxMemory=None):
+        self.workers = workers
+        self.timeout = timeout
+        self.maxMemory = maxMemory
+        self._context = _processContext()
+        self._condition = threading.Condition()
+        self._idle = []
+        self._workerCount = 0
+        self._closed = False
+        self._fontData = None
+        self._fontLock = threading.Lock()
+        self._snapshots = weakref.WeakKeyDictionary()
+        self._observedFonts = weakref.WeakSet()
+
+    def __repr__(self):
+        return "<WorkerPool %d workers>" % self.workers
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def compileFeatures(self, text, font, **kwargs):
+        """
+        Compile the dynamic features in the given text
+        with the code blocks executed in the workers.
+        The arguments are the same as the arguments for
+        compileFeatures, except for workers, which is
+        ignored. Referenced files are compiled at the
+        same time, as many as there are workers.
+        """
+        if self._closed:
+            raise FeaPyFoFumError("The pool is closed.")
+        kwargs["workers"] = None
+        token = _activeWorkerPool.set((self, self._getFontData(font)))
+        try:
+            return compileFeatures(text, font, **kwargs)
+        finally:
+            _activeWorkerPool.reset(token)
+
+    def close(self):
+        """
+        Stop the workers. Workers that are executing
+        blocks are stopped when the blocks are done.
+        """
+        with self._condition:
+            self._closed = True
+            idle = self._idle
+            self._idle = []
+            self._workerCount -= len(idle)
+            self._condition.notify_all()
+        for worker in idle:
+            worker.stop()
+        with self._fontLock:
+            observedFonts = list(self._observedFonts)
+            self._observedFonts.clear()
+            self._snapshots.clear()
+        for font in observedFonts:
+            font.removeObserver(self, "Font.Changed")
+
+    # font
+
+    def _getFontData(self, font):
+        snapshot = self._getSnapshot(font)
+        fontData = self._fontData
+        # a snapshot that is given again doesn't
+        # need to be pickled again to be compared.
+        if fontData is not None and fontData.snapshot is snapshot:
+            return fontData
+        data = pickle.dumps(snapshot, pickle.HIGHEST_PROTOCOL)
+        fontData = _FontData(snapshot, hashlib.sha256(data).hexdigest(), data)
+        self._fontData = fontData
+        return fontData
+
+    def _getSnapshot(self, font):
+        if isinstance(font, FontSnapshot):
+            return font
+        if not hasattr(font, "addObserver"):
+            return FontSnapshot(font)
+        with self._fontLock:
+            snapshot = self._snapshots.get(font)
+        if snapshot is not None:
+            return snapshot
+        snapshot = FontSnapshot(font)
+        with self._fontLock:
+            if font not in self._observedFonts:
+                font.addObserver(self, "_fontChanged", "Font.Changed")
+                self._observedFonts.add(font)
+            self._snapshots[font] = snapshot
+        return snapshot
+
+    def _fontChanged(self, notification):
+        with self._fontLock:
+            self._snapshots.pop(notification.object, None)
+
+    # workers
+
+    def _session(self, fontData, bytecodeCache):
+        return _WorkerSession(self, fontData, bytecodeCache)
+
+    def _acquire(self, fontData, bytecodeCache):
+        worker = None
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise FeaPyFoFumError("The pool is closed.")
+                if self._idle:
+                    # prefer a worker that has the font
+                    for worker in self._idle:
+                        if worker.fontDigest == fontData.digest:
+                            break
+                    self._idle.remove(worker)
+                    break
+                if self._workerCount < self.workers:
+                    self._workerCount += 1
+                    break
+                self._condition.wait()
+        try:
+            if worker is not None:
+                try:
+                    worker.begin(fontData, bytecodeCache)
+                    return worker
+                except (EOFError, OSError):
+                    # it died while it was idle
+                    worker.stop(kill=True)
+            worker = _Worker(self._context, self.maxMemory)
+            worker.begin(fontData, bytecodeCache)
+        except BaseException:
+            if worker is not None:
+                worker.stop(kill=True)
+            self._discard()
+            raise
+        return worker
+
+    def _release(self, worker):
+        with self._condition:
+            if not self._closed:
+                self._idle.append(worker)
+                self._condition.notify()
+                return
+            self._workerCount -= 1
+        worker.stop()
+
+    def _discard(self, worker=None):
+        if worker is not None:
+            worker.stop(kill=True)
+        with self._condition:
+            self._workerCount -= 1
+            self._condition.notify()
+
+
+class _FontData(object):
+
+    """
+    A pickled FontSnapshot and its hash.
+    """
+
+    __slots__ = ("snapshot", "digest", "data")
+
+    def __init__(self, snapshot, digest, data):
+        self.snapshot = snapshot
+        self.digest = digest
+        self.data = data
+
+
+class _WorkerSession(object):
+
+    """
+    The execution of the code blocks in a file. The
+    worker is acquired when the first block is executed
+    and returned to the pool when the session is closed.
+    """
+
+    def __init__(self, pool, fontData, bytecodeCache):
+        self.pool = pool
+        self.fontData = fontData
+        self.bytecodeCache = bytecodeCache
+        self.worker = None
+
+    def execute(self, codeBlock, track):
+        """
+        Execute the code block and return the output,
+        the errors and, if track is True, the set of
+        font data the block read.
+        """
+        if self.worker is None:
+            self.worker = self.pool._acquire(self.fontData, self.bytecodeCache)
+        try:
+            return self.worker.execute(codeBlock, track, self.pool.timeout)
+        except _WorkerFailure as failure:
+            # the namespace went with the worker
+            self.pool._discard(self.worker)
+            self.worker = None
+            return "", str(failure) + "\n", set()
+
+    def close(self):
+        if self.worker is not None:
+            self.pool._release(self.worker)
+            self.worker = None
+
+
+class _WorkerFailure(Exception):
+    pass
+
+
+class _Worker(object):
+
+    """
+    A worker process and the end of the pipe
+    that is used to talk to it.
+    """
+
+    def __init__(self, context, maxMemory):
+        self.connection, workerConnection = context.Pipe()
+        self.process = context.Process(
+            target=_workerMain,
+            args=(workerConnection, maxMemory),
+            daemon=True
+        )
+        self.process.start()
+        # processes started later must not
+        # keep the worker's end of the pipe open.
+        workerConnection.close()
+        self.fontDigest = None
+
+    def begin(self, fontData, bytecodeCache):
+        if not self.process.is_alive():
+            raise EOFError
+        if self.fontDigest != fontData.digest:
+            self.connection.send(("font",))
+            self.connection.send_bytes(fontData.data)
+            self.fontDigest = fontData.digest
+        self.connection.send(("begin", bytecodeCache))
+
+    def execute(self, codeBlock, track, timeout):
+        try:
+            self.connection.send(("execute", codeBlock, track))
+            if not self.connection.poll(timeout):
+                raise _WorkerFailure("The code block didn't finish within %s seconds, so its worker process was stopped." % timeout)
+            return self.connection.recv()
+        except (EOFError, OSError):
+            self.process.join()
+            raise _WorkerFailure("The worker process executing the code block exited with code %s." % self.process.exitcode)
+
+    def stop(self, kill=False):
+        if not kill:
+            try:
+                self.connection.send(("stop",))
+            except (EOFError, OSError):
+                pass
+            self.process.join(1)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.connection.close()
+
+
+def _workerMain(connection, maxMemory):
+    # interrupts are for the process using the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if maxMemory is not None:
+        _limitMemory(maxMemory)
+    font = None
+    glyphIndex = None
+    namespace = None
+    bytecodeCache = None
+    while True:
+        try:
+            message = connection.recv()
+        except EOFError:
+            break
+        command = message[0]
+        if command == "font":
+            font = pickle.loads(connection.recv_bytes())
+            # the index is shared by all files
+            # compiled with the same font.
+            glyphIndex = GlyphIndex(font)
+        elif command == "begin":
+            bytecodeCache = message[1]
+            namespace = _makeNamespace(font, glyphIndex)
+        elif command == "execute":
+            codeBlock, track = message[1:]
+            dependencies = None
+            if track:
+                dependencies = set()
+            output, errors = _executeCodeWithFont(
+                codeBlock,
+                font,
+                namespace,
+                bytecodeCache=bytecodeCache,
+                dependencies=dependencies
+            )
+            connection.send((output, errors, dependencies))
+        elif command == "stop":
+            break
+
+
+def _limitMemory(maxMemory):
+    try:
+        import resource
+    except ImportError:
+        # not available on Windows
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+    if hard != resource.RLIM_INFINITY:
+        maxMemory = min(maxMemory, hard)
+    try:
+        resource.setrlimit(resource.RLIMIT_AS, (maxMemory, hard))
+    except (ValueError, OSError):
+        pass
@@ -16,5 +16,10 @@ setup(
     description="A library for making .fea dynamic",
     url="https://github.com/typesupply/feaPyFoFum",
     packages=["feaPyFoFum"],
-    package_dir={"": "Lib"}
+    package_dir={"": "Lib"},
+    entry_points={
+        "console_scripts": [
+            "feapyfofum = feaPyFoFum.cli:main"
+        ]
+    }
 )
@@ -0,0 +1,417 @@
+from __future__ import print_function, absolute_import, unicode_literals
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+from defcon import Font
+import feaPyFoFum
+from feaPyFoFum import compileFeatures
+from feaPyFoFum.feaPyFoFum import FeaSyntaxWriter
+
+
+# --------------
+# Synthetic Data
+# --------------
+
+def makeFont(glyphCount, directory=None):
+    """
+    Make a font with glyphCount glyphs. A third of the
+    glyphs are base glyphs with unicodes, the rest are
+    .sc and .alt variants. Every ten base glyphs form
+    a kerning group and every pair of groups is kerned.
+    If directory is given, the font is saved in it.
+    """
+    font = Font()
+    baseCount = max(1, glyphCount // 3)
+    names = ["g%05d" % i for i in range(baseCount)]
+    names += [name + ".sc" for name in names]
+    names += [name + ".alt" for name in names[:glyphCount - len(names)]]
+    names = names[:glyphCount]
+    # without notifications, every new glyph
+    # would make the font scan its glyph order.
+    font.dispatcher.disableNotifications()
+    for i, name in enumerate(names):
+        glyph = font.newGlyph(name)
+        glyph.width = 500
+        if i < baseCount:
+            glyph.unicodes = [0xF0000 + i]
+    font.dispatcher.enableNotifications()
+    font.glyphOrder = names
+    groupNames = []
+    for i in range(0, min(baseCount, 500), 10):
+        groupName = "g%05d" % i
+        font.groups["public.kern1." + groupName] = names[i:i + 10]
+        font.groups["public.kern2." + groupName] = names[i:i + 10]
+        groupNames.append(groupName)
+    for left in groupNames:
+        for right in groupNames:
+            font.kerning["public.kern1." + left, "public.kern2." + right] = -10
+    if directory is not None:
+        font.save(os.path.join(directory, "font.ufo"))
+    return font
+
+
+blockTemplate = """
+# >>>
+# featureWriter = writer.feature("ss%(index)02d")
+# names = [name for name in font.glyphOrder if name.endswith(".sc")][:%(ruleCount)d]
+# for name in names:
+#     featureWriter.substitution(name.split(".")[0], name)
+# print(writer.write())
+# <<<
+"""
+
+
+def makeFeatureText(blockCount, ruleCount, include=None):
+    """
+    Make feature text with blockCount code blocks that
+    each write ruleCount substitutions. If include is
+    given, an include statement for it is added.
+    """
+    text = ["languagesystem DFLT dflt;"]
+    for index in range(blockCount):
+        text.append(blockTemplate % dict(index=index % 100, ruleCount=ruleCount))
+    if include is not None:
+        text.append("include(%s);" % include)
+    return "\n".join(text)
+
+
+def writeIncludedFiles(directory, includeDepth, blockCount, ruleCount):
+    """
+    Write a chain of includeDepth files that each
+    include the next one. The name of the first
+    file is returned, or None if includeDepth is 0.
+    """
+    include = None
+    for depth in reversed(range(includeDepth)):
+        fileName = "level%d.fea" % depth
+        with open(os.path.join(directory, fileName), "w") as f:
+            f.write(makeFeatureText(blockCount, ruleCount, include))
+        include = fileName
+    return include
+
+
+def _best(function, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+# --------
+# Compiler
+# --------
+
+def benchmarkCompile(glyphCount=1000, blockCount=10, ruleCount=100, includeDepth=0, repeat=3):
+    """
+    Measure the time compileFeatures needs to compile
+    feature text with blockCount blocks that write
+    ruleCount rules each for a font with glyphCount
+    glyphs. If includeDepth is greater than zero,
+    a chain of that many included files with the
+    same blocks is compiled too. The best of
+    repeat runs is returned in seconds.
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        font = makeFont(glyphCount, directory if includeDepth else None)
+        include = writeIncludedFiles(directory, includeDepth, blockCount, ruleCount)
+        text = makeFeatureText(blockCount, ruleCount, include)
+        compile = lambda: compileFeatures(text, font, compileReferencedFiles=bool(includeDepth))
+        # a failing code block is written to the output
+        # as a traceback, which is much faster to compile.
+        assert "Traceback" not in compile()
+        return _best(compile, repeat)
+    finally:
+        shutil.rmtree(directory)
+
+
+def benchmarkIncludeScan(fileCount=20, lineCount=50000, repeat=3):
+    """
+    Measure the time needed to find the include
+    statements in a chain of fileCount files with
+    lineCount lines each and build the include graph.
+    """
+    from feaPyFoFum.feaPyFoFum import _findReferencedFilesInLines, _buildIncludeGraph
+    directory = tempfile.mkdtemp()
+    try:
+        filler = ["sub a%d by b%d; # include(not.fea)" % (i, i) for i in range(lineCount)]
+        for index in range(fileCount):
+            lines = list(filler)
+            if index + 1 < fileCount:
+                lines.append("include(file%d.fea);" % (index + 1))
+            with open(os.path.join(directory, "file%d.fea" % index), "w") as f:
+                f.write("\n".join(lines))
+
+        def scan():
+            referencedFiles = _findReferencedFilesInLines(["include(file0.fea);"], directory)
+            return _buildIncludeGraph(referencedFiles, directory)
+
+        assert len(scan()) == fileCount
+        return _best(scan, repeat)
+    finally:
+        shutil.rmtree(directory)
+
+
+# ------
+# Writer
+# ------
+
+def benchmarkWriterMemory(ruleCount=1000000):
+    """
+    Measure the memory used to store ruleCount
+    pair positioning rules in a writer. For
+    comparison, the memory needed to store the
+    same rules as dicts is also measured.
+    """
+    # generate the glyph names up front so
+    # that they aren't part of the measurement
+    targets = [["a%d" % i, "b%d" % i] for i in range(ruleCount)]
+    tracemalloc.start()
+    writer = FeaSyntaxWriter()
+    for target in targets:
+        writer.positionPair(target, "-10")
+    records = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del writer
+    tracemalloc.start()
+    content = []
+    for target in targets:
+        content.append(
+            dict(
+                identifier="positionPair",
+                target=target,
+                value="-10",
+                backtrack=None,
+                lookahead=None,
+                enumerate=False
+            )
+        )
+    dicts = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del content
+    return dict(
+        ruleCount=ruleCount,
+        recordBytes=records,
+        dictBytes=dicts
+    )
+
+
+def benchmarkWriterScaling(ruleCounts=(10000, 100000, 1000000), lookupCount=10):
+    """
+    Measure the time needed to write a feature that
+    contains lookupCount lookups with a total of
+    ruleCount substitution rules for each of the
+    rule counts. The time per rule should stay
+    roughly constant as the rule count grows.
+    """
+    results = []
+    for ruleCount in ruleCounts:
+        writer = FeaSyntaxWriter()
+        featureWriter = writer.feature("test")
+        perLookup = ruleCount // lookupCount
+        for i in range(lookupCount):
+            lookupWriter = featureWriter.lookup("lookup%d" % i)
+            for j in range(perLookup):
+                lookupWriter.substitution("a%d" % j, "b%d" % j)
+        start = time.perf_counter()
+        writer.write()
+        seconds = time.perf_counter() - start
+        results.append(
+            dict(
+                ruleCount=perLookup * lookupCount,
+                seconds=seconds
+            )
+        )
+        del writer, featureWriter, lookupWriter
+    return results
+
+
+def benchmarkBulkIngestion(ruleCount=200000):
+    """
+    Measure the time needed to store ruleCount
+    substitution rules one call at a time and
+    with a single call to substitutions.
+    """
+    targets = ["a%d" % i for i in range(ruleCount)]
+    substitutions = ["b%d" % i for i in range(ruleCount)]
+    writer = FeaSyntaxWriter()
+    start = time.perf_counter()
+    for target, substitution in zip(targets, substitutions):
+        writer.substitution(target, substitution)
+    single = time.perf_counter() - start
+    del writer
+    writer = FeaSyntaxWriter()
+    start = time.perf_counter()
+    writer.substitutions(targets, substitutions)
+    bulk = time.perf_counter() - start
+    del writer
+    return dict(
+        ruleCount=ruleCount,
+        singleSeconds=single,
+        bulkSeconds=bulk
+    )
+
+
+# -----
+# Suite
+# -----
+
+def makeSuite(quick=False):
+    """
+    Get a list of (name, unit, function) for
+    the benchmarks in the suite. If quick is
+    True, smaller sizes are used.
+    """
+    if quick:
+        glyphCounts = (1000, 5000)
+        ruleCounts = (10000, 100000)
+        memoryRuleCount = 100000
+    else:
+        glyphCounts = (1000, 10000, 60000)
+        ruleCounts = (10000, 100000, 1000000)
+        memoryRuleCount = 1000000
+    suite = []
+    for glyphCount in glyphCounts:
+        suite.append((
+            "compile/glyphs=%d" % glyphCount,
+            "s",
+            lambda glyphCount=glyphCount: benchmarkCompile(glyphCount=glyphCount, blockCount=10, ruleCount=1000)
+        ))
+    for blockCount in (10, 100):
+        suite.append((
+            "compile/blocks=%d" % blockCount,
+            "s",
+            lambda blockCount=blockCount: benchmarkCompile(blockCount=blockCount, ruleCount=10)
+        ))
+    for includeDepth in (1, 5):
+        suite.append((
+            "compile/includeDepth=%d" % includeDepth,
+            "s",
+            lambda includeDepth=includeDepth: benchmarkCompile(blockCount=5, ruleCount=100, includeDepth=includeDepth)
+        ))
+    for ruleCount in ruleCounts:
+        suite.append((
+            "write/rules=%d" % ruleCount,
+            "s",
+            lambda ruleCount=ruleCount: benchmarkWriterScaling((ruleCount,))[0]["seconds"]
+        ))
+    suite.append((
+        "write/memory/rules=%d" % memoryRuleCount,
+        "bytes",
+        lambda: benchmarkWriterMemory(memoryRuleCount)["recordBytes"]
+    ))
+    suite.append((
+        "write/bulk",
+        "s",
+        lambda: benchmarkBulkIngestion()["bulkSeconds"]
+    ))
+    suite.append((
+        "includeScan",
+        "s",
+        lambda: benchmarkIncludeScan(lineCount=10000 if quick else 50000)
+    ))
+    return suite
+
+
+def runSuite(quick=False, names=None, log=None):
+    """
+    Run the benchmarks and return the results as a
+    dict that can be written as JSON. If names is
+    given, only the benchmarks whose names start
+    with one of them are run. Benchmarks that need
+    something the installed version of feaPyFoFum
+    doesn't have are left out, so that older versions
+    can be measured for a baseline.
+    """
+    results = {}
+    for name, unit, function in makeSuite(quick):
+        if names and not any(name.startswith(n) for n in names):
+            continue
+        try:
+            value = function()
+        except (ImportError, AttributeError) as e:
+            if log is not None:
+                log("%-32s %14s (%s)" % (name, "unsupported", e))
+            continue
+        results[name] = dict(value=value, unit=unit)
+        if log is not None:
+            log("%-32s %14s" % (name, _formatValue(value, unit)))
+    return dict(
+        metadata=dict(
+            python=platform.python_version(),
+            implementation=platform.python_implementation(),
+            platform=platform.platform(),
+            feaPyFoFum=feaPyFoFum.__version__,
+            quick=quick,
+            time=time.strftime("%Y-%m-%dT%H:%M:%S")
+        ),
+        results=results
+    )
+
+
+def compareResults(results, baseline, tolerance=0.2):
+    """
+    Compare results with baseline results. A list
+    of (name, baselineValue, value, ratio) is returned
+    for every benchmark that got worse by more than
+    the tolerance. Benchmarks that are only in one
+    of the results are ignored.
+    """
+    regressions = []
+    for name, result in sorted(results["results"].items()):
+        baselineResult = baseline["results"].get(name)
+        if baselineResult is None or not baselineResult["value"]:
+            continue
+        ratio = result["value"] / float(baselineResult["value"])
+        if ratio > 1 + tolerance:
+            regressions.append((name, baselineResult["value"], result["value"], ratio))
+    return regressions
+
+
+def _formatValue(value, unit):
+    if unit == "bytes":
+        return "%.1f MB" % (value / 1024.0 / 1024.0)
+    return "%.4f s" % value
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Run the feaPyFoFum benchmarks.")
+    parser.add_argument("names", nargs="*", help="only run benchmarks whose names start with these")
+    parser.add_argument("--quick", action="store_true", help="use smaller sizes")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare the results with this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown relative to the baseline")
+    args = parser.parse_args(args)
+    results = runSuite(quick=args.quick, names=args.names, log=print)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["metadata"].get("quick") != args.quick:
+            print("warning: the baseline was made with different sizes")
+        regressions = compareResults(results, baseline, args.tolerance)
+        for name, baselineValue, value, ratio in regressions:
+            print("regression: %s %.0f%% worse (%s -> %s)" % (
+                name,
+                (ratio - 1) * 100,
+                baselineValue,
+                value
+            ))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1152 @@
+from __future__ import print_function, absolute_import, unicode_literals
+
+import gc
+import os
+import pickle
+import sys
+import shutil
+import tempfile
+import threading
+from io import StringIO
+from defcon import Font
+from feaPyFoFum import compileFeatures, compileFeaturesForFonts, compileFeaturesToFont, FeaPyTemplate, compileFeaturesTo, iterCompileFeatures, CodeBlockCache, BytecodeCache, TableCache, IncrementalCompiler, GlyphIndex, CompileProfile, TrackingFont, FontSnapshot, WorkerPool
+from feaPyFoFum.dependencies import recordingDependencies
+from feaPyFoFum.feaPyFoFum import FeaPyFoFumError, FeaSyntaxWriter, _OutputSpool, _captureLock, _pausedGarbageCollection
+from feaPyFoFum.cli import main as cliMain
+
+
+def makeDirectory():
+    return tempfile.mkdtemp(prefix="feaPyFoFumTest")
+
+
+def _writeFile(directory, fileName, text):
+    with open(os.path.join(directory, fileName), "w") as f:
+        f.write(text)
+
+
+def _readFile(directory, fileName):
+    with open(os.path.join(directory, fileName)) as f:
+        return f.read()
+
+
+# -------
+# Caching
+# -------
+
+_cachedSource = """# >>>
+# with open(%r, "a") as f:
+#     f.write("x")
+# print("# " + font.info.familyName)
+# <<<
+"""
+
+
+def testCodeBlockCacheReusesOutput():
+    directory = makeDirectory()
+    try:
+        counterPath = os.path.join(directory, "counter")
+        text = _cachedSource % counterPath
+        font = Font()
+        font.info.familyName = "Before"
+        cache = CodeBlockCache(os.path.join(directory, "cache"))
+        assert compileFeatures(text, font, cache=cache) == "# Before"
+        assert compileFeatures(text, font, cache=cache) == "# Before"
+        # the second compile didn't execute the block
+        assert _readFile(directory, "counter") == "x"
+        # changing what the block read invalidates the output
+        font.info.familyName = "After"
+        assert compileFeatures(text, font, cache=cache) == "# After"
+        assert _readFile(directory, "counter") == "xx"
+        # a disabled cache is bypassed
+        assert compileFeatures(text, font, cache=CodeBlockCache(cache.directory, enabled=False)) == "# After"
+        assert _readFile(directory, "counter") == "xxx"
+    finally:
+        shutil.rmtree(directory)
+
+
+_failingSource = """languagesystem DFLT dflt;
+
+# >>>
+# x = 1
+# print(font.missing)
+# <<<
+"""
+
+
+def testBytecodeCacheHits():
+    directory = makeDirectory()
+    try:
+        cache = BytecodeCache(directory)
+        code = cache.compile("x = 1", "test.fea", 2)
+        assert cache.compile("x = 1", "test.fea", 2) is code
+        # the line offset is part of the key
+        assert cache.compile("x = 1", "test.fea", 3) is not code
+        try:
+            cache.compile("x = (", "test.fea", 2)
+        except SyntaxError as e:
+            assert e.lineno == 3
+        else:
+            raise AssertionError("The syntax error should have been raised.")
+        assert len(os.listdir(directory)) == 2
+        # another cache loads the stored code
+        otherCache = BytecodeCache(directory)
+        assert otherCache.compile("x = 1", "test.fea", 2) == code
+        assert len(os.listdir(directory)) == 2
+        # cached code reports lines in the feature text
+        for i in range(2):
+            result = compileFeatures(_failingSource, Font(), bytecodeCache=cache)
+            assert '#   File "<features>", line 5, in <module>' in result.splitlines()
+    finally:
+        shutil.rmtree(directory)
+
+
+_glyphWidthSource = """# >>>
+# with open(%r, "a") as f:
+#     f.write("x")
+# print("# %%d" %% font["a"].width)
+# <<<
+"""
+
+
+def testCacheTracksReadData():
+    font = Font()
+    font.newGlyph("a").width = 100
+    font.newGlyph("b").width = 200
+    dependencies = set()
+    with recordingDependencies(dependencies):
+        trackingFont = TrackingFont(font)
+        trackingFont["a"].width
+        trackingFont.info.familyName
+        "c" in trackingFont
+    assert dependencies == set([("glyph", "a"), ("glyph", "a", "width"), ("info", "familyName"), ("glyph", "c")])
+    directory = makeDirectory()
+    try:
+        text = _glyphWidthSource % os.path.join(directory, "counter")
+        cache = CodeBlockCache(os.path.join(directory, "cache"))
+        assert compileFeatures(text, font, cache=cache) == "# 100"
+        # changing data the block didn't read keeps the output
+        font["b"].width = 300
+        font["a"].unicodes = [0x61]
+        font.info.familyName = "Changed"
+        assert compileFeatures(text, font, cache=cache) == "# 100"
+        assert _readFile(directory, "counter") == "x"
+        font["a"].width = 150
+        assert compileFeatures(text, font, cache=cache) == "# 150"
+        assert _readFile(directory, "counter") == "xx"
+    finally:
+        shutil.rmtree(directory)
+
+
+# -------------
+# Include Graph
+# -------------
+
+_scannedSource = """include(a.fea); # include(b.fea);
+name "include(c.fea);
+still in the string"; include(d.fea);
+sub x by y; include ( e.fea ) ;
+# include(f.fea);"""
+
+
+def testIncludesInCommentsAndStrings():
+    directory = makeDirectory()
+    try:
+        font = Font()
+        font.save(os.path.join(directory, "font.ufo"))
+        for name in "abcdef":
+            _writeFile(directory, name + ".fea", "# %s" % name)
+        result = compileFeatures(_scannedSource, font, compileReferencedFiles=True)
+        assert result.splitlines() == [
+            "include(a-c.fea); # include(b.fea);",
+            "name \"include(c.fea);",
+            "still in the string\"; include(d-c.fea);",
+            "sub x by y; include ( e-c.fea ) ;",
+            "# include(f.fea);"
+        ]
+        compiled = sorted(fileName for fileName in os.listdir(directory) if fileName.endswith("-c.fea"))
+        assert compiled == ["a-c.fea", "d-c.fea", "e-c.fea"]
+    finally:
+        shutil.rmtree(directory)
+
+
+def testSharedIncludeCompiledOnce():
+    directory = makeDirectory()
+    try:
+        font = Font()
+        font.save(os.path.join(directory, "font.ufo"))
+        _writeFile(directory, "b.fea", "include(d.fea);\n# >>>\n# print('# B')\n# <<<\n")
+        _writeFile(directory, "c.fea", "include(d.fea);\n# >>>\n# print('# C')\n# <<<\n")
+        _writeFile(directory, "d.fea", _cachedSource % os.path.join(directory, "counter"))
+        font.info.familyName = "D"
+        text = "include(b.fea);\ninclude(c.fea);"
+        result = compileFeatures(text, font, compileReferencedFiles=True)
+        assert result == "include(b-c.fea);\ninclude(c-c.fea);"
+        assert _readFile(directory, "b-c.fea") == "include(d-c.fea);\n# B"
+        assert _readFile(directory, "c-c.fea") == "include(d-c.fea);\n# C"
+        assert _readFile(directory, "d-c.fea") == "# D"
+        # d.fea is included twice but compiled once
+        assert _readFile(directory, "counter") == "x"
+    finally:
+        shutil.rmtree(directory)
+
+
+def testCircularIncludes():
+    directory = makeDirectory()
+    try:
+        font = Font()
+        font.save(os.path.join(directory, "font.ufo"))
+        _writeFile(directory, "a.fea", "include(b.fea);\n")
+        _writeFile(directory, "b.fea", "include(c.fea);\n")
+        _writeFile(directory, "c.fea", "include(a.fea);\n")
+        try:
+            compileFeatures("include(a.fea);", font, compileReferencedFiles=True)
+        except FeaPyFoFumError as e:
+            assert str(e) == "Circular file reference: a.fea -> b.fea -> c.fea -> a.fea"
+        else:
+            raise AssertionError("The circular reference should have been found.")
+        # nothing is written when the graph is invalid
+        assert not os.path.exists(os.path.join(directory, "a-c.fea"))
+    finally:
+        shutil.rmtree(directory)
+
+
+# ----------------
+# Output Capturing
+# ----------------
+
+_slowSource = """# >>>
+# import time
+# for i in range(20):
+#     print("# " + font.info.styleName)
+#     time.sleep(0.001)
+# <<<
+"""
+
+
+def testConcurrentCompilesCaptureOwnOutput():
+    stdout = sys.stdout
+    results = {}
+
+    def compileFont(styleName):
+        font = Font()
+        font.info.styleName = styleName
+        results[styleName] = compileFeatures(_slowSource, font)
+
+    threads = [threading.Thread(target=compileFont, args=(styleName,)) for styleName in ("Light", "Bold")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for styleName in ("Light", "Bold"):
+        assert results[styleName] == "\n".join(["# " + styleName] * 20)
+    assert sys.stdout is stdout
+
+
+# ---------
+# Templates
+# ---------
+
+_templateSource = """languagesystem DFLT dflt;
+# >>>
+# renderCount = globals().get("renderCount", 0) + 1
+# print("# %s %d" % (font.info.styleName, renderCount))
+# <<<
+# >>>
+# print(font.missing)
+# <<<
+"""
+
+
+def testTemplateMatchesCompiledText():
+    template = FeaPyTemplate(_templateSource, fileName="<features>")
+    # the template survives pickling for other processes
+    copiedTemplate = pickle.loads(pickle.dumps(template))
+    for styleName in ("Light", "Bold"):
+        font = Font()
+        font.info.styleName = styleName
+        expected = compileFeatures(_templateSource, font)
+        assert expected.splitlines()[1] == "# %s 1" % styleName
+        # each render starts with a new namespace
+        assert template.render(font) == expected
+        assert template.render(font) == expected
+        assert copiedTemplate.render(font) == expected
+
+
+# ---------
+# Profiling
+# ---------
+
+_profiledSource = """languagesystem DFLT dflt;
+# >>>
+# feature = writer.feature("liga")
+# feature.substitution("a", "b")
+# feature.substitution("c", "d")
+# print(writer.write())
+# <<<
+# >>>
+# print(font.missing)
+# <<<
+"""
+
+
+def testProfiledBlocks():
+    font = Font()
+    expected = compileFeatures(_profiledSource, font)
+    text, profile = compileFeatures(_profiledSource, font, profile=CompileProfile(profileSlowest=1))
+    assert text == expected
+    assert [block.line for block in profile] == [2, 8]
+    first, second = profile.blocks
+    assert first.ruleCounts == dict(feature=1, substitution=2)
+    # the writer puts blank lines around the feature
+    assert first.outputLines == 7
+    assert not first.errors
+    assert "AttributeError" in second.errors
+    # only the slowest block keeps its statistics
+    assert len([block for block in profile if block.stats is not None]) == 1
+    assert profile.format().splitlines()[-1].endswith(" in 2 blocks")
+
+
+# --------------------
+# Parallel Compilation
+# --------------------
+
+_referencedFileText = """# >>>
+# print("# %s " + " ".join(sorted(font.keys())))
+# <<<
+"""
+
+
+def testParallelReferencedFilesWhileLocked():
+    directory = makeDirectory()
+    try:
+        font = Font()
+        for name in "abc":
+            font.newGlyph(name)
+        font.save(os.path.join(directory, "font.ufo"))
+        for name in "xyz":
+            _writeFile(directory, name + ".fea", _referencedFileText % name)
+        text = "include(x.fea);\ninclude(y.fea);\ninclude(z.fea);"
+        expected = compileFeatures(text, font, compileReferencedFiles=True)
+        expectedFiles = [_readFile(directory, name + "-c.fea") for name in "xyz"]
+        for name in "xyz":
+            os.remove(os.path.join(directory, name + "-c.fea"))
+        # processes forked while the capture lock is held, for
+        # example by another thread, would wait for it forever.
+        results = []
+        with _captureLock:
+            thread = threading.Thread(
+                target=lambda: results.append(compileFeatures(text, font, compileReferencedFiles=True, workers=2))
+            )
+            thread.daemon = True
+            thread.start()
+            thread.join(60)
+        assert results == [expected]
+        assert [_readFile(directory, name + "-c.fea") for name in "xyz"] == expectedFiles
+        assert expectedFiles[2] == "# z a b c"
+    finally:
+        shutil.rmtree(directory)
+
+
+_manyFontsText = """# >>>
+# print("# " + font.info.styleName + " " + " ".join(sorted(font.keys())))
+# <<<
+"""
+
+
+def testCompileForFontsWhileLocked():
+    fonts = []
+    for styleName in ("Light", "Regular", "Bold"):
+        font = Font()
+        font.info.styleName = styleName
+        for name in "abc":
+            font.newGlyph(name)
+        fonts.append(font)
+    expected = compileFeaturesForFonts(_manyFontsText, fonts)
+    assert expected[2] == "# Bold a b c"
+    results = []
+    with _captureLock:
+        thread = threading.Thread(
+            target=lambda: results.append(compileFeaturesForFonts(_manyFontsText, fonts, workers=2))
+        )
+        thread.daemon = True
+        thread.start()
+        thread.join(60)
+    assert results == [expected]
+
+
+# -----------
+# Glyph Index
+# -----------
+
+def testGlyphIndexLookups():
+    font = Font()
+    for name in ("b", "a", "a.sc", "b.sc", "a.sc.alt", "aa", "z"):
+        font.newGlyph(name)
+    font["a"].unicodes = [0x61]
+    font["a.sc"].unicodes = [0x61]
+    font.glyphOrder = ["b", "b.sc", "a", "a.sc", "a.sc.alt", "aa"]
+    index = GlyphIndex(font)
+    assert index.names == ("b", "b.sc", "a", "a.sc", "a.sc.alt", "aa", "z")
+    assert "a.sc" in index and "c" not in index
+    assert index.withSuffix(".sc") == ("b.sc", "a.sc")
+    assert index.withSuffix("alt") == ("a.sc.alt",)
+    assert index.withBaseName("a") == ("a", "a.sc", "a.sc.alt")
+    assert index.withPrefix("a") == ("a", "a.sc", "a.sc.alt", "aa")
+    assert index.withUnicode(0x61) == ("a", "a.sc")
+    assert index.forUnicode(0x61) == "a"
+    assert index.forUnicode(0x62) is None
+    # code blocks find the index as glyphs
+    text = "# >>>\n# print(\"# \" + \" \".join(glyphs.withSuffix(\".sc\")))\n# <<<"
+    assert compileFeatures(text, font) == "# b.sc a.sc"
+
+
+# ------------
+# Rule Storage
+# ------------
+
+def testCompactRuleStorage():
+    writer = FeaSyntaxWriter()
+    writer.comment("before")
+    writer.blankLine()
+    writer.substitution("a", "b")
+    for record in writer._content:
+        assert isinstance(record, tuple)
+        assert not hasattr(record, "__dict__")
+    assert writer._content[0] == ("# before",)
+    assert writer.write() == "# before\n\n\n\nsub a by b;"
+    # a contextual rule marks the rules stored before it
+    writer = FeaSyntaxWriter()
+    writer.substitution("a", "b")
+    writer.substitution("a", "b", backtrack=["c"])
+    assert writer.write() == "sub a' by b;\nsub c a' by b;"
+
+
+# ---------
+# Rendering
+# ---------
+
+def _makeNestedWriter():
+    writer = FeaSyntaxWriter()
+    writer.languageSystem("DFLT", "dflt")
+    writer.languageSystem("latn", "dflt")
+    writer.classDefinition("@lower", ["a", "b"])
+    writer.markClassDefinition(["acute"], (100, 500), "@TOP")
+    writer.comment("Features")
+    liga = writer.feature("liga")
+    liga.script("latn")
+    liga.language("TRK ", includeDefault=False)
+    liga.substitution(["f", "i"], "f_i")
+    liga.substitution("a", "b", backtrack=["c"])
+    liga.ignoreSubstitution("a", lookahead=["b"])
+    lookup = liga.lookup("alternates")
+    lookup.lookupflag(["IgnoreMarks"])
+    lookup.substitution("g", ["g.alt1", "g.alt2"], choice=True)
+    liga.lookupReference("alternates")
+    kern = writer.feature("kern")
+    kern.positionSingle("a", (0, 0, 10, 0))
+    kern.positionPair(["a", "@lower"], "-10")
+    kern.subtable()
+    kern.positionPair(["b", "c"], "-5", enumerate=True)
+    mark = writer.feature("mark")
+    mark.positionMarkToBase("a", (250, 500), "@TOP")
+    mark.positionMarkToMark("acute", (100, 700), "@TOP")
+    mark.featureReference("kern")
+    writer.fileReference("other.fea")
+    return writer
+
+
+# the output of the writer before rendering
+# was changed to happen in a single pass
+_nestedWriterText = """languagesystem DFLT dflt;
+languagesystem latn dflt;
+
+@lower = [a b];
+
+markClass [acute] <anchor 100 500> @TOP;
+
+# Features
+
+
+feature liga {
+\t
+\tscript latn;
+\t\t
+\t\tlanguage TRK;
+\t\t\t
+\t\t\tsub f' i' by f_i;
+\t\t\tsub c a' by b;
+\t\t\tignore sub a' b;
+
+\t\t\tlookup alternates {
+\t\t\t\tlookupflag IgnoreMarks;
+\t\t\t\t
+\t\t\t\tsub g from [g.alt1 g.alt2];
+\t\t\t} alternates;
+\t\t\t
+\t\t\tlookup alternates;
+} liga;
+
+
+feature kern {
+\tpos a <0 0 10 0>;
+\t
+\tpos a @lower -10;
+\t
+\tsubtable;
+\t
+\tenum pos b c -5;
+} kern;
+
+
+feature mark {
+\tposition base a <anchor 250 500> mark @TOP;
+\t
+\tposition mark acute <anchor 100 700> mark @TOP;
+\t
+\tfeature kern;
+} mark;
+
+include(other.fea);"""
+
+
+def testNestedWriterRendering():
+    assert _makeNestedWriter().write() == _nestedWriterText
+
+
+# ----------
+# Bulk Rules
+# ----------
+
+def testBulkRulesMatchSingleRules():
+    writer = FeaSyntaxWriter()
+    writer.classDefinition("@A", ["a", "b"])
+    writer.classDefinition("@B", ["c"])
+    for target, substitution in (("a", "a.sc"), ("b", "b.sc")):
+        writer.substitution(target, substitution, backtrack=["x"])
+    writer.positionSingle("a", "10")
+    writer.positionSingle("b", "20")
+    writer.positionPair(("@A", "@B"), "-10")
+    writer.positionPair(("a", "c"), "-20")
+    expected = writer.write()
+    substitutions = [("a", "a.sc"), ("b", "b.sc")]
+    for arguments in ((dict(substitutions),), (substitutions,), (["a", "b"], ["a.sc", "b.sc"])):
+        writer = FeaSyntaxWriter()
+        writer.classDefinitions(["@A", "@B"], [["a", "b"], ["c"]])
+        writer.substitutions(*arguments, backtrack=["x"])
+        writer.positionSingles(iter([("a", "10"), ("b", "20")]))
+        writer.positionPairs({("@A", "@B"): "-10", ("a", "c"): "-20"})
+        assert writer.write() == expected
+    try:
+        FeaSyntaxWriter().substitutions(["a", "b"], ["a.sc"])
+    except FeaPyFoFumError as e:
+        assert str(e) == "The sequences must have the same length: 2, 1"
+    else:
+        raise AssertionError("The lengths should have been compared.")
+
+
+def testOverlappingGarbageCollectionPauses():
+    assert gc.isenabled()
+    first = _pausedGarbageCollection()
+    second = _pausedGarbageCollection()
+    first.__enter__()
+    second.__enter__()
+    # the first pause ends while the second one continues
+    first.__exit__(None, None, None)
+    assert not gc.isenabled()
+    second.__exit__(None, None, None)
+    assert gc.isenabled()
+    # collection stays disabled if it was disabled before
+    gc.disable()
+    try:
+        with _pausedGarbageCollection():
+            pass
+        assert not gc.isenabled()
+    finally:
+        gc.enable()
+
+
+# -------
+# Kerning
+# -------
+
+def _buildFeatures(glyphNames, text):
+    from fontTools.fontBuilder import FontBuilder
+    from fontTools.feaLib.builder import addOpenTypeFeaturesFromString
+
+    builder = FontBuilder(1000, isTTF=True)
+    builder.setupGlyphOrder([".notdef"] + list(glyphNames))
+    addOpenTypeFeaturesFromString(builder.font, "languagesystem DFLT dflt;\n" + text)
+    return builder.font
+
+
+def _pairValue(ttFont, left, right):
+    """
+    Get the advance adjustment a shaper would apply to
+    the pair: the first subtable that covers the left
+    glyph and applies to the pair wins.
+    """
+    for lookup in ttFont["GPOS"].table.LookupList.Lookup:
+        for subtable in lookup.SubTable:
+            if left not in subtable.Coverage.glyphs:
+                continue
+            if subtable.Format == 1:
+                pairSet = subtable.PairSet[subtable.Coverage.glyphs.index(left)]
+                for record in pairSet.PairValueRecord:
+                    if record.SecondGlyph == right:
+                        return record.Value1.XAdvance
+            else:
+                class1 = subtable.ClassDef1.classDefs.get(left, 0)
+                class2 = subtable.ClassDef2.classDefs.get(right, 0)
+                value = subtable.Class1Record[class1].Class2Record[class2].Value1
+                return getattr(value, "XAdvance", 0) or 0
+    return None
+
+
+def testKerningFromFontPrecedence():
+    font = Font()
+    glyphNames = ["a", "e", "v", "w", "o"]
+    for name in glyphNames:
+        font.newGlyph(name)
+    font.groups["public.kern1.V"] = ["v", "w"]
+    font.groups["public.kern2.A"] = ["a", "e"]
+    font.kerning[("public.kern1.V", "public.kern2.A")] = -10
+    font.kerning[("v", "public.kern2.A")] = -20
+    font.kerning[("public.kern1.V", "a")] = -30
+    font.kerning[("o", "o")] = -5
+    writer = FeaSyntaxWriter()
+    writer.feature("kern").kerningFromFont(font)
+    ttFont = _buildFeatures(glyphNames, writer.write())
+    expected = {
+        ("v", "a"): -20,
+        ("v", "e"): -20,
+        ("w", "a"): -30,
+        ("w", "e"): -10,
+        ("o", "o"): -5
+    }
+    for (left, right), value in expected.items():
+        assert _pairValue(ttFont, left, right) == value, (left, right)
+
+
+def testAutoSubtablesKeepLeftClassesTogether():
+    glyphNames = ["l%d" % i for i in range(4)] + ["r%d" % i for i in range(40)]
+    writer = FeaSyntaxWriter(autoSubtables=True, maxSubtableSize=150)
+    kern = writer.feature("kern")
+    for i in range(4):
+        kern.classDefinition("@L%d" % i, ["l%d" % i])
+    for i in range(40):
+        kern.classDefinition("@R%d" % i, ["r%d" % i])
+    for left in range(4):
+        for right in range(40):
+            kern.positionPair(("@L%d" % left, "@R%d" % right), str(-(left * 40 + right + 1)))
+    text = writer.write()
+    assert "subtable;" in text
+    ttFont = _buildFeatures(glyphNames, text)
+    for left in range(4):
+        for right in range(40):
+            assert _pairValue(ttFont, "l%d" % left, "r%d" % right) == -(left * 40 + right + 1)
+
+
+def testKerningFromFontDependencies():
+    font = Font()
+    for name in "abc":
+        font.newGlyph(name)
+    font.groups["public.kern1.A"] = ["a", "b"]
+    for left in "abc":
+        for right in "abc":
+            font.kerning[(left, right)] = -10
+    dependencies = set()
+    with recordingDependencies(dependencies):
+        FeaSyntaxWriter().kerningFromFont(TrackingFont(font))
+        # reading a copy records the whole mapping once
+        dict(TrackingFont(font).groups)
+    assert dependencies == set([("kerning",), ("groups",)])
+
+
+# --------
+# Building
+# --------
+
+_buildSource = """languagesystem DFLT dflt;
+# >>>
+# feature = writer.feature("liga")
+# feature.substitution("a", "b")
+# print(writer.write())
+# <<<
+include(extra.fea);
+"""
+
+
+def _makeTTFont(glyphNames):
+    from fontTools.fontBuilder import FontBuilder
+
+    builder = FontBuilder(1000, isTTF=True)
+    builder.setupGlyphOrder([".notdef"] + list(glyphNames))
+    return builder.font
+
+
+def _singleSubstitutions(ttFont):
+    mapping = {}
+    for lookup in ttFont["GSUB"].table.LookupList.Lookup:
+        for subtable in lookup.SubTable:
+            mapping.update(subtable.mapping)
+    return mapping
+
+
+def testBuildingWithTableCache():
+    directory = makeDirectory()
+    try:
+        font = Font()
+        font.save(os.path.join(directory, "font.ufo"))
+        _writeFile(directory, "extra.fea", "feature salt { sub c by d; } salt;")
+        cacheDirectory = os.path.join(directory, "tables")
+        tableCache = TableCache(cacheDirectory)
+        ttFont = _makeTTFont("abcd")
+        text = compileFeaturesToFont(_buildSource, font, ttFont, tableCache=tableCache)
+        assert text.splitlines()[-1] == "include(extra.fea);"
+        expected = ttFont["GSUB"].compile(ttFont)
+        assert _singleSubstitutions(ttFont) == dict(a="b", c="d")
+        # the stored tables are reused by other caches
+        for cache in (tableCache, TableCache(cacheDirectory)):
+            ttFont = _makeTTFont("abcd")
+            compileFeaturesToFont(_buildSource, font, ttFont, tableCache=cache)
+            assert ttFont["GSUB"].compile(ttFont) == expected
+        assert len(os.listdir(cacheDirectory)) == 1
+        # included files are part of the key
+        _writeFile(directory, "extra.fea", "feature salt { sub c by a; } salt;")
+        ttFont = _makeTTFont("abcd")
+        compileFeaturesToFont(_buildSource, font, ttFont, tableCache=tableCache)
+        assert _singleSubstitutions(ttFont) == dict(a="b", c="a")
+        # and so is the glyph order
+        ttFont = _makeTTFont("abcde")
+        compileFeaturesToFont(_buildSource, font, ttFont, tableCache=tableCache)
+        assert len(os.listdir(cacheDirectory)) == 3
+    finally:
+        shutil.rmtree(directory)
+
+
+# -------------
+# AST Rendering
+# -------------
+
+def _makePairWriter():
+    writer = FeaSyntaxWriter(autoSubtables=True, maxSubtableSize=100)
+    kern = writer.feature("kern")
+    for i in range(3):
+        kern.classDefinition("@L%d" % i, ["l%d" % i])
+    for i in range(20):
+        kern.classDefinition("@R%d" % i, ["r%d" % i])
+    for left in range(3):
+        kern.positionPair(("l%d" % left, "@R0"), None)
+        kern.positionPair(("l%d" % left, "@R1"), "-5", enumerate=True)
+        for right in range(20):
+            kern.positionPair(("@L%d" % left, "@R%d" % right), None if right % 3 else "-10")
+    return writer
+
+
+def testPositionPairASTMatchesText():
+    from fontTools.feaLib.parser import Parser
+
+    text = _makePairWriter().write()
+    assert "ignore pos @L0 @R1;" in text
+    assert "subtable;" in text
+    parsed = Parser(StringIO(text)).parse().statements
+    statements = _makePairWriter().writeAST()
+    assert [statement.asFea() for statement in statements] == [statement.asFea() for statement in parsed]
+
+
+# ---------
+# Snapshots
+# ---------
+
+def _assertReadOnly(mapping, key, value):
+    try:
+        mapping[key] = value
+    except TypeError:
+        pass
+    else:
+        raise AssertionError("The mapping should be read only.")
+
+
+def testSnapshotLibsAreFrozen():
+    font = Font()
+    glyph = font.newGlyph("a")
+    font.lib["com.example.data"] = dict(names=["a", "b"], nested=dict(value=1))
+    glyph.lib["com.example.data"] = dict(names=["a"])
+    font.info.openTypeNameRecords = [
+        dict(nameID=256, platformID=3, encodingID=1, languageID=0x409, string="Test")
+    ]
+    snapshot = FontSnapshot(font)
+    # changing the font doesn't change the snapshot
+    font.lib["com.example.data"]["names"].append("c")
+    font.lib["com.example.data"]["nested"]["value"] = 2
+    glyph.lib["com.example.data"]["names"].append("b")
+    assert snapshot.lib["com.example.data"]["names"] == ("a", "b")
+    assert snapshot.lib["com.example.data"]["nested"]["value"] == 1
+    assert snapshot["a"].lib["com.example.data"]["names"] == ("a",)
+    # and the snapshot can't be changed
+    _assertReadOnly(snapshot.lib["com.example.data"]["nested"], "value", 3)
+    _assertReadOnly(snapshot["a"].lib["com.example.data"], "names", ())
+    _assertReadOnly(snapshot.info.openTypeNameRecords[0], "string", "Changed")
+    # pickling keeps the values frozen
+    copied = pickle.loads(pickle.dumps(snapshot))
+    _assertReadOnly(copied.lib["com.example.data"]["nested"], "value", 3)
+
+
+# ---------
+# Streaming
+# ---------
+
+_streamedSource = """languagesystem DFLT dflt;
+# >>>
+# print("# " + " ".join(sorted(font.keys())))
+# <<<
+feature test {
+    # >>>
+    # print("sub a by b;")
+    # <<<
+} test;
+"""
+
+
+class _ReadLog(object):
+
+    def __init__(self, text):
+        self.lines = text.splitlines(True)
+        self.readCount = 0
+
+    def __iter__(self):
+        for line in self.lines:
+            self.readCount += 1
+            yield line
+
+
+def testStreamedOutputMatches():
+    font = Font()
+    for name in "ab":
+        font.newGlyph(name)
+    expected = compileFeatures(_streamedSource, font)
+    assert expected.splitlines()[1:4] == ["# a b", "feature test {", "    sub a by b;"]
+    for source in (_streamedSource, StringIO(_streamedSource)):
+        out = StringIO()
+        compileFeaturesTo(source, font, out)
+        assert out.getvalue() == expected
+    # file objects are read as the lines are needed
+    source = _ReadLog(_streamedSource)
+    lines = iterCompileFeatures(source, font)
+    assert next(lines) == "languagesystem DFLT dflt;"
+    assert source.readCount < len(source.lines)
+    assert "\n".join(["languagesystem DFLT dflt;"] + list(lines)) == expected
+
+
+_streamingSource = """feature test {
+    # >>>
+    # writer.stream()
+    # for name in sorted(font.keys()):
+    #     writer.substitution(name, "a")
+    # print(writer.write())
+    # <<<
+} test;
+"""
+
+
+def _fillWriter(writer):
+    writer.languageSystem("DFLT", "dflt")
+    liga = writer.feature("liga")
+    liga.substitution("a", "b")
+    liga.lookup("alternates").substitution("c", "d")
+    liga.substitution("e", "f")
+    writer.feature("kern").positionPair(("a", "b"), "-10")
+    writer.comment("end")
+    return liga
+
+
+def testStreamingWriter():
+    writer = FeaSyntaxWriter()
+    _fillWriter(writer)
+    expected = writer.write()
+    out = StringIO()
+    writer = FeaSyntaxWriter()
+    writer.stream(out)
+    liga = _fillWriter(writer)
+    # the rules were written as they were added
+    assert "\tsub e by f;" in out.getvalue()
+    assert writer.write() == ""
+    assert out.getvalue() == expected
+    assert writer._content.ruleCounts == dict(languageSystem=1, feature=2, lookup=1, substitution=3, positionPair=1, comment=1)
+    for add in (lambda: writer.comment("late"), lambda: liga.substitution("g", "h")):
+        try:
+            add()
+        except FeaPyFoFumError:
+            pass
+        else:
+            raise AssertionError("Nothing can be added after the writer was written.")
+    # the markers can't be added to rules that were written
+    writer = FeaSyntaxWriter()
+    writer.stream(StringIO())
+    try:
+        writer.substitution("a", "b", backtrack=["c"])
+    except FeaPyFoFumError:
+        pass
+    else:
+        raise AssertionError("The backtrack needs contextual markers.")
+
+
+def testSpilledBlockOutput():
+    directory = makeDirectory()
+    try:
+        font = Font()
+        for i in range(100):
+            font.newGlyph("glyph%d" % i)
+        font.newGlyph("a")
+        font.save(os.path.join(directory, "font.ufo"))
+        expected = compileFeatures(_streamingSource, font)
+        maxMemorySize = _OutputSpool.maxMemorySize
+        _OutputSpool.maxMemorySize = 100
+        try:
+            cache = CodeBlockCache(os.path.join(directory, "cache"))
+            for i in range(2):
+                out = StringIO()
+                compileFeaturesTo(_streamingSource, font, out, cache=cache)
+                assert out.getvalue() == expected
+        finally:
+            _OutputSpool.maxMemorySize = maxMemorySize
+        assert "    sub glyph99 by a;" in expected.splitlines()
+    finally:
+        shutil.rmtree(directory)
+
+
+# -----------------------
+# Incremental Compilation
+# -----------------------
+
+def testIncrementalUpdateAfterFailure():
+    directory = makeDirectory()
+    try:
+        font = Font()
+        font.save(os.path.join(directory, "font.ufo"))
+        _writeFile(directory, "a.fea", "# >>>\n# print('# A1')\n# <<<\n")
+        _writeFile(directory, "b.fea", "# >>>\n# print('# B1')\n# <<<\n")
+        compiler = IncrementalCompiler(font, text="include(a.fea);\ninclude(b.fea);")
+        compiler.update()
+        assert _readFile(directory, "b-c.fea") == "# B1"
+        # a.fea is broken, so the update fails before b.fea is compiled
+        _writeFile(directory, "a.fea", "# >>>\nnot code\n# <<<\n")
+        _writeFile(directory, "b.fea", "# >>>\n# print('# B2')\n# <<<\n")
+        try:
+            compiler.update()
+        except Exception:
+            pass
+        else:
+            raise AssertionError("The update should have failed.")
+        _writeFile(directory, "a.fea", "# >>>\n# print('# A2')\n# <<<\n")
+        compiler.update()
+        assert _readFile(directory, "a-c.fea") == "# A2"
+        assert _readFile(directory, "b-c.fea") == "# B2"
+        assert not compiler.update()
+    finally:
+        shutil.rmtree(directory)
+
+
+# ----------
+# Benchmarks
+# ----------
+
+def testBenchmarkComparison():
+    from benchmark import runSuite, compareResults
+
+    results = runSuite(quick=True, names=["compile/includeDepth=1"])
+    assert list(results["results"]) == ["compile/includeDepth=1"]
+    assert results["metadata"]["quick"]
+    baseline = dict(
+        results={
+            "a": dict(value=1.0, unit="s"),
+            "b": dict(value=1.0, unit="s"),
+            "c": dict(value=0, unit="s")
+        }
+    )
+    results = dict(
+        results={
+            "a": dict(value=1.1, unit="s"),
+            "b": dict(value=1.5, unit="s"),
+            "c": dict(value=1.0, unit="s"),
+            "d": dict(value=1.0, unit="s")
+        }
+    )
+    # benchmarks without a usable baseline value are ignored
+    assert compareResults(results, baseline, tolerance=0.2) == [("b", 1.0, 1.5, 1.5)]
+
+
+# -----------------
+# Command Line Tool
+# -----------------
+
+sharedIncludeText = """
+# >>>
+# kern = writer.feature("kern")
+# value = dict(Light=-10, Bold=-20)[font.info.styleName]
+# for name in sorted(font.keys()):
+#     kern.positionPair((name, name), str(value))
+# print(writer.write())
+# <<<
+"""
+
+
+def testCommandLineSharedInclude():
+    directory = makeDirectory()
+    try:
+        _writeFile(directory, "k.fea", sharedIncludeText)
+        for styleName in ("Light", "Bold"):
+            font = Font()
+            font.info.styleName = styleName
+            for glyphName in "abc":
+                font.newGlyph(glyphName)
+            font.features.text = "include(k.fea);"
+            font.save(os.path.join(directory, styleName + ".ufo"))
+        status = cliMain([os.path.join(directory, "*.ufo"), "-j", "2"])
+        assert status == 0
+        # each UFO gets its own compiled include
+        assert "pos c c -10;" in _readFile(directory, "k-Light-c.fea")
+        assert "pos c c -20;" in _readFile(directory, "k-Bold-c.fea")
+        assert _readFile(directory, "Light-c.fea") == "include(k-Light-c.fea);"
+        assert _readFile(directory, "Bold-c.fea") == "include(k-Bold-c.fea);"
+        assert sorted(os.listdir(directory)) == [
+            "Bold-c.fea", "Bold.ufo", "Light-c.fea", "Light.ufo",
+            "k-Bold-c.fea", "k-Light-c.fea", "k.fea"
+        ]
+    finally:
+        shutil.rmtree(directory)
+
+
+_relocatedFeatures = """include(k.fea);
+# include(k.fea);
+# >>>
+# print('include(k.fea); # printed')
+# <<<
+"""
+
+
+def testCommandLineOutputDirectory():
+    directory = makeDirectory()
+    try:
+        _writeFile(directory, "k.fea", "# nothing here")
+        font = Font()
+        font.features.text = _relocatedFeatures + 'feature test { featureNames { name "include(k.fea);"; }; } test;'
+        font.save(os.path.join(directory, "A.ufo"))
+        outputDirectory = os.path.join(directory, "out")
+        status = cliMain([os.path.join(directory, "A.ufo"), "-o", outputDirectory, "-v"])
+        assert status == 0
+        lines = _readFile(outputDirectory, "A-c.fea").splitlines()
+        # the statements point to the compiled file from -o
+        assert lines[0] == "include(../k-A-c.fea);"
+        assert "include(../k.fea); # printed" in lines
+        # but comments, code and strings are left alone
+        assert lines[1] == "# include(k.fea);"
+        assert "# print('include(k.fea); # printed')" in lines
+        assert lines[-1] == 'feature test { featureNames { name "include(k.fea);"; }; } test;'
+        # UFOs with the same name would overwrite each other's files
+        otherDirectory = os.path.join(directory, "other")
+        os.mkdir(otherDirectory)
+        font.save(os.path.join(otherDirectory, "A.ufo"))
+        status = cliMain([os.path.join(directory, "A.ufo"), os.path.join(otherDirectory, "A.ufo")])
+        assert status == 1
+    finally:
+        shutil.rmtree(directory)
+
+
+# -----------
+# Worker Pool
+# -----------
+
+_poolSource = """
+# >>>
+# print("# " + " ".join(sorted(font.keys())))
+# <<<
+"""
+
+
+def testWorkerPoolStartedWhileLocked():
+    font = Font()
+    for name in "abc":
+        font.newGlyph(name)
+    # a worker forked while the capture lock is held, for
+    # example by another thread, would wait for it forever.
+    with _captureLock:
+        with WorkerPool(workers=2, timeout=10) as pool:
+            errors = []
+            text = pool.compileFeatures(_poolSource, font, errors=errors)
+    assert not errors
+    assert text == "\n# a b c"
+
+
+_crashingSource = """# >>>
+# import os
+# os._exit(3)
+# <<<
+# >>>
+# print("# after")
+# <<<"""
+
+_runawaySource = """# >>>
+# while True:
+#     pass
+# <<<"""
+
+
+def testWorkerPoolIsolatesFailures():
+    font = Font()
+    font.newGlyph("a")
+    with WorkerPool(timeout=1) as pool:
+        errors = []
+        result = pool.compileFeatures(_crashingSource, font, errors=errors)
+        message = "The worker process executing the code block exited with code 3."
+        assert result.splitlines()[-3:] == ["# " + message, "", "# after"]
+        assert errors == [("<features>", 1, message + "\n")]
+        errors = []
+        result = pool.compileFeatures(_runawaySource, font, errors=errors)
+        message = "The code block didn't finish within 1 seconds, so its worker process was stopped."
+        assert result.splitlines()[-1] == "# " + message
+        assert errors == [("<features>", 1, message + "\n")]
+        # the workers were replaced
+        assert pool.compileFeatures(_poolSource, font).splitlines()[-1] == "# a"
+
+
+_styleNameSource = """# >>>
+# print("# " + font.info.styleName)
+# <<<
+"""
+
+
+def testWorkerPoolReusesFontSnapshots():
+    font = Font()
+    font.info.styleName = "Light"
+    with WorkerPool() as pool:
+        assert pool.compileFeatures(_styleNameSource, font) == "# Light"
+        fontData = pool._fontData
+        # the font didn't change, so it isn't copied and sent again
+        assert pool.compileFeatures(_styleNameSource, font) == "# Light"
+        assert pool._fontData is fontData
+        font.info.styleName = "Bold"
+        assert pool.compileFeatures(_styleNameSource, font) == "# Bold"
+        assert pool._fontData is not fontData
+    assert not font.hasObserver(pool, "Font.Changed")
+
+
+def testWorkerPoolKeepsForkServerSettings():
+    from multiprocessing import forkserver
+
+    preload = ["os"]
+    forkserver.set_forkserver_preload(preload)
+    try:
+        with WorkerPool() as pool:
+            pool.compileFeatures(_poolSource, Font())
+        # the preload list belongs to the application
+        assert forkserver._forkserver._preload_modules == preload
+    finally:
+        forkserver.set_forkserver_preload(["__main__"])
+
+
+if __name__ == "__main__":
+    for name, function in sorted(globals().items()):
+        if name.startswith("test") and callable(function):
+            function()
+            print(name, "ok")